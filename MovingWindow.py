@@ -1,14 +1,27 @@
-import error
+from . import error
 import numpy as np
 
 class MovingWindow(object):
     
+    # Subclasses either bind function, which is called with the valid (inside the grid and not NaN) values under the
+    # window at each location, or set statistic to one of the statistics below, which are evaluated for the whole grid
+    # at once.  statistic can also be passed as a keyword argument, with percentile giving the percentile to evaluate.
+    
     function = None
+    statistic = None
+    statistics = ('mean', 'std', 'min', 'max', 'median', 'percentile', 'count')
     
     def __init__(self, *args, **kwargs):
         if kwargs.get('window_dimension') is None:
             raise error.InputError('Window dimension', 'is a required parameter')
         self.window_dimension = kwargs.get('window_dimension')
+        self.window_radius = self.window_dimension
+        
+        if kwargs.get('statistic') is not None:
+            self.statistic = kwargs.get('statistic')
+        if self.statistic is not None and self.statistic not in self.statistics:
+            raise error.InputError('Statistic', 'must be one of ' + ', '.join(self.statistics))
+        self.percentile = kwargs.get('percentile', 50.0)
         
         if self.__class__ is MovingWindow:
             raise error.Error('MovingWindow is an abstract base class')
@@ -16,48 +29,127 @@ class MovingWindow(object):
     def _build_search_kernel(self, dx):        
         return None, None
     
-    def __adjust_kernel(self, row,col,grid,searchKernelRows,searchKernelCols):
-        # Function to turn the rows and columns of the search kernel specified by searchKernelRows & ...Cols as just indices of the
-        # data that is actually within the grid
-    
-        #Get the current absolute positions within the grid
-        theseRows = searchKernelRows+row
-        theseCols = searchKernelCols+col
-    
-        #Do any points in searchKernel extend to before the start of the grid? or off the end?
-        gdIndices = (theseCols < grid.shape[1]) & (theseRows < grid.shape[0]) & (theseRows >= 0) & (theseCols >= 0)
-    
-        #Which rows are within the grid
-        goodRows = theseRows[gdIndices]
-        goodCols = theseCols[gdIndices]
+    def _build_footprint(self, dx):
+        # Boolean footprint of the search kernel, centered on the middle element.
+    
+        search_kernel_rows, search_kernel_cols = self._build_search_kernel(dx)
+        search_kernel_rows = np.asarray(search_kernel_rows, dtype = int)
+        search_kernel_cols = np.asarray(search_kernel_cols, dtype = int)
+        radius = int(max(np.max(np.abs(search_kernel_rows)), np.max(np.abs(search_kernel_cols)))) if len(search_kernel_rows) > 0 else 0
+        footprint = np.zeros((2*radius+1, 2*radius+1), dtype = bool)
+        footprint[search_kernel_rows+radius, search_kernel_cols+radius] = True
+        return footprint
+    
+    def _windows(self, grid, footprint, max_elements = 2**22):
+        # Yields (first row, last row + 1, values) for blocks of rows, where values holds the grid values under the
+        # footprint at each location in the block, with NaN for locations outside the grid.
+    
+        from numpy.lib.stride_tricks import sliding_window_view
+        (radius_rows, radius_cols) = (footprint.shape[0] // 2, footprint.shape[1] // 2)
+        padded = np.pad(grid, ((radius_rows, radius_rows), (radius_cols, radius_cols)), mode = 'constant', constant_values = np.nan)
+        windows = sliding_window_view(padded, footprint.shape)
+        rows_per_chunk = max(1, max_elements // max(1, grid.shape[1] * np.count_nonzero(footprint)))
+        for start in range(0, grid.shape[0], rows_per_chunk):
+            end = min(start + rows_per_chunk, grid.shape[0])
+            yield start, end, windows[start:end][..., footprint]
+    
+    def __window_sums(self, values, footprint):
+        # Sum of values under the footprint at each location.  Rectangular windows use a summed-area table; other
+        # footprints are correlated directly.
+    
+        if np.all(footprint):
+            (rows, cols) = footprint.shape
+            padded = np.pad(values, ((rows // 2 + 1, rows // 2), (cols // 2 + 1, cols // 2)), mode = 'constant')
+            table = padded.cumsum(axis = 0).cumsum(axis = 1)
+            return table[rows:, cols:] - table[:-rows, cols:] - table[rows:, :-cols] + table[:-rows, :-cols]
+        
+        from scipy.ndimage import correlate
+        return correlate(values, footprint.astype(np.float64), mode = 'constant', cval = 0.0)
     
-        #Now that we are all within the grid, of those points within the grid, do any include
-        #Do any points in searchKernel include nans ?
-        gdIndices = np.logical_not(np.isnan(grid[goodRows, goodCols]))
+    def __window_extreme(self, values, footprint, statistic):
+        # Minimum or maximum under the footprint, with separable filters for rectangular windows.
+        
+        from scipy import ndimage
+        fill = np.inf if statistic == 'min' else -np.inf
+        values = np.where(np.isnan(values), fill, values)
+        if np.all(footprint):
+            filter1d = ndimage.minimum_filter1d if statistic == 'min' else ndimage.maximum_filter1d
+            values = filter1d(values, footprint.shape[0], axis = 0, mode = 'constant', cval = fill)
+            values = filter1d(values, footprint.shape[1], axis = 1, mode = 'constant', cval = fill)
+        else:
+            extreme_filter = ndimage.minimum_filter if statistic == 'min' else ndimage.maximum_filter
+            values = extreme_filter(values, footprint = footprint, mode = 'constant', cval = fill)
+        values[values == fill] = np.nan
+        return values
+    
+    def _apply_statistic(self, grid, footprint):
+        
+        valid = ~np.isnan(grid)
+        statistic = self.statistic
+        
+        if statistic in ('count', 'mean', 'std'):
+            count = np.rint(self.__window_sums(valid.astype(np.float64), footprint))
+            if statistic == 'count':
+                return count
+            # Sums are taken about the grid mean to limit round-off in the summed-area table:
+            offset = np.nanmean(grid) if np.any(valid) else 0.0
+            shifted = np.where(valid, grid - offset, 0.0)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean = self.__window_sums(shifted, footprint) / count
+                if statistic == 'mean':
+                    return mean + offset
+                variance = self.__window_sums(shifted * shifted, footprint) / count - mean * mean
+                return np.sqrt(np.maximum(variance, 0.0))
+        
+        if statistic in ('min', 'max'):
+            return self.__window_extreme(grid, footprint, statistic)
+        
+        # Percentiles (linear interpolation, as np.percentile) from the sorted valid values in each window; NaN sorts last:
+        
+        q = 50.0 if statistic == 'median' else self.percentile
+        outgrid = np.empty(grid.shape, dtype = np.float64)
+        for (start, end, values) in self._windows(grid, footprint):
+            values = np.sort(values, axis = -1)
+            count = np.sum(~np.isnan(values), axis = -1)
+            position = (q / 100.0) * np.maximum(count - 1, 0)
+            lower = np.floor(position).astype(int)
+            upper = np.minimum(lower + 1, np.maximum(count - 1, 0))
+            lower_values = np.take_along_axis(values, lower[..., np.newaxis], axis = -1)[..., 0]
+            upper_values = np.take_along_axis(values, upper[..., np.newaxis], axis = -1)[..., 0]
+            result = lower_values + (upper_values - lower_values) * (position - lower)
+            result[count == 0] = np.nan
+            outgrid[start:end] = result
+        return outgrid
     
-        return goodRows[gdIndices], goodCols[gdIndices]
+    def _apply_function(self, grid, footprint):
+        
+        outgrid = np.empty(grid.shape, dtype = np.float64)
+        for (start, end, values) in self._windows(grid, footprint):
+            values = values.reshape((-1, values.shape[-1]))
+            valid = ~np.isnan(values)
+            outgrid[start:end] = np.array([self.function(v[g]) for (v, g) in zip(values, valid)]).reshape((end - start, grid.shape[1]))
+        return outgrid
 
     def apply_moving_window(self, grid, dx, dtype):
         # Function to scan the moving window specified by Kernel across the dem, a numpy grid, and apply the specified function
         # to each location. function is a method that returns a single value given any number of inputs, e.g.
-        # movingWindow(i) = function(dem[Kernel@i])
+        # movingWindow(i) = function(dem[Kernel@i]).  Values outside the grid and NaN values are left out of each window.
     
-        outgrid = np.zeros_like(grid, dtype = dtype)
+        footprint = self._build_footprint(dx)
+        grid = np.asarray(grid, dtype = np.float64)
     
-        search_kernel_rows, search_kernel_cols = self._build_search_kernel(grid)
+        if self.statistic is not None:
+            outgrid = self._apply_statistic(grid, footprint)
+        else:
+            outgrid = self._apply_function(grid, footprint)
         
-        for i in range(grid.shape[0]):
-            for j in range(grid.shape[1]):
-                these_rows,these_cols = self.__adjustKernel(i,j,grid,search_kernel_rows,search_kernel_cols) #trim the searchKernel and return it as a list of indices
-                outgrid[i,j] = self.function(grid[these_rows, these_cols]) #apply the specified function to the dem values for this search location
-    
-        return outgrid
+        return outgrid.astype(dtype)
 
 class RectangularMovingWindow(MovingWindow):
     
     def __init__(self, *args, **kwargs):
         super(RectangularMovingWindow, self).__init__(*args, **kwargs)
-        if self.__class__ is RectangularMovingWindow:
+        if self.__class__ is RectangularMovingWindow and self.statistic is None:
             raise error.Error('RectangularMovingWindow has no bound function')
         
     def _build_search_kernel(self, dx):
@@ -72,7 +164,7 @@ class CircularMovingWindow(MovingWindow):
     
     def __init__(self, *args, **kwargs):
         super(CircularMovingWindow, self).__init__(*args, **kwargs)
-        if self.__class__ is CircularMovingWindow:
+        if self.__class__ is CircularMovingWindow and self.statistic is None:
             raise error.Error('CircularMovingWindow has no bound function')
         
     def _build_search_kernel(self, dx):
@@ -81,8 +173,8 @@ class CircularMovingWindow(MovingWindow):
         pxlRadius = int(round(self.window_radius/dx)) #Is this right...
         relCoords = np.arange(1 + 2*pxlRadius)-pxlRadius #Relative coordinates of neighbors within this row, col distance
         searchKernelRow, serchKernelCol = np.meshgrid(relCoords,relCoords)
-        dists = np.sqrt(searchKernelRow**2 + searchKernelRow**2)
+        dists = np.sqrt(searchKernelRow**2 + serchKernelCol**2)
         searchKernelRow = searchKernelRow[dists<pxlRadius]
         serchKernelCol = serchKernelCol[dists<pxlRadius]
     
-        return searchKernelRow.flatten(), serchKernelCol.flatten()
\ No newline at end of file
+        return searchKernelRow.flatten(), serchKernelCol.flatten()
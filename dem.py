@@ -23,6 +23,68 @@ except:
 
 sys.setrecursionlimit(1000000)
 
+# Floating point type used to compute and store elevation-derived products (slope, hillshade, curvature, relief, chi and
+# ks) by classes that do not set their own precision.  Flow accumulation (Area) always uses float64.
+
+default_precision = float64
+
+def set_precision(dtype):
+    global default_precision
+    default_precision = np.dtype(dtype).type
+
+def _precision_error(reference, reduced):
+    
+    difference = np.abs(reduced - reference)
+    scale = np.nanmax(np.abs(reference)) if np.any(~np.isnan(reference)) else 0.0
+    maximum = np.nanmax(difference) if np.any(~np.isnan(difference)) else 0.0
+    return {'max_absolute_error': maximum, 'max_relative_error': maximum / scale if scale > 0 else 0.0, 
+            'nan_agreement': bool(np.array_equal(np.isnan(reference), np.isnan(reduced)))}
+
+# Largest relative error (to the largest magnitude of the float64 product) that precision_checks accepts at float32.
+# Second differences (Laplacian and curvatures) cancel more digits than first differences and sums along flow paths,
+# and plan curvature also divides by the gradient, which is small on near-flat cells.
+
+precision_tolerances = {'slope': 1E-5, 'hillshade': 1E-5, 'local_relief': 1E-5, 'relief': 1E-5, 'ksi': 1E-5, 'chi': 1E-5, 
+                        'laplacian': 1E-4, 'terrain_derivatives': 1E-4, 'terrain_derivatives.plan_curvature': 1E-3, 'ks_from_chi': 1E-5}
+
+def precision_checks(elevation = None, dtype = np.float32, tolerances = None):
+    # Accuracy regression checks for a reduced precision: builds each product that follows the precision policy at
+    # float64 and at dtype (by passing precision to each grid, so class and module settings are not touched) from
+    # elevation (by default a smooth synthetic 80 x 90 DEM), and raises Error.InputError naming every product whose
+    # relative error exceeds its tolerance (precision_tolerances, updated from tolerances) or whose NaNs move.  Returns
+    # the results of each check.
+    
+    if elevation is None:
+        (rows, cols) = np.mgrid[0:80, 0:90].astype(float64)
+        elevation = Elevation(nx = 90, ny = 80, dx = 10.0)
+        elevation._georef_info.geoTransform = (-5.0, 10.0, 0, 795.0, 0, -10.0)
+        elevation._griddata = 500.0 + 40.0*np.sin(rows / 7.0)*np.cos(cols / 11.0) + 0.3*np.hypot(rows - 40.0, cols - 45.0)**2 / 10.0
+    tolerances = dict(precision_tolerances, **(tolerances if tolerances is not None else dict()))
+    
+    filled = FilledElevation(elevation = elevation)
+    flow_direction = FlowDirectionD8(flooded_dem = filled)
+    area = Area(flow_direction = flow_direction)
+    flow_length = FlowLength(flow_direction = flow_direction)
+    outlet = area._rowscols_to_xy([np.unravel_index(np.nanargmax(area._griddata), area._griddata.shape)])
+    
+    checks = (('slope', MaxSlope, {'elevation': elevation}), 
+              ('hillshade', Hillshade, {'elevation': elevation, 'azimuth': 315, 'inclination': 45}), 
+              ('laplacian', Laplacian, {'elevation': elevation}), 
+              ('local_relief', LocalRelief, {'elevation': elevation, 'pixel_radius': 3}), 
+              ('relief', Relief, {'flow_direction': flow_direction, 'elevation': filled, 'flow_length': flow_length}), 
+              ('ksi', Ksi, {'area': area, 'flow_direction': flow_direction, 'theta': 0.5, 'Ao': 1.0, 'flow_length': flow_length}), 
+              ('chi', Chi, {'area': area, 'flow_direction': flow_direction, 'theta': 0.5, 'Ao': 1.0, 'outlets': outlet}),
+              ('ks_from_chi', KsFromChiWithSmoothing, {'elevation': filled, 'area': area, 'flow_direction': flow_direction, 'theta': 0.5, 'horizontal_interval': 50.0}))
+    results = dict((name, cls.precision_error(dtype, **kwargs)) for (name, cls, kwargs) in checks)
+    for product in terrain_products:
+        (reference, reduced) = [np.asarray(elevation.terrain_derivatives((product,), dtype = this_dtype)[product]._griddata, dtype = float64) for this_dtype in (float64, dtype)]
+        results['terrain_derivatives.' + product] = _precision_error(reference, reduced)
+    
+    failures = [name for (name, result) in sorted(results.items()) if not result['nan_agreement'] or result['max_relative_error'] > tolerances.get(name, tolerances[name.split('.')[0]])]
+    if len(failures) > 0:
+        raise Error.InputError('Precision', 'results at ' + np.dtype(dtype).name + ' differ from float64 beyond tolerance for ' + ', '.join(failures))
+    return results
+
         
 class GDALMixin(object):
     
@@ -335,38 +397,130 @@ class GeographicGridMixin(object):
         return int(dTheta*metersPerDegree) #convert degrees to meters
     
     
-    def _area_per_pixel(self, *args, **kwargs):
-
-        if hasattr(self, '_GeographicGridMixin__app'):
-            return self._GeographicGridMixin__app
+    def _area_per_pixel_compact(self, *args, **kwargs):
+        
+        #Returns a column (ny x 1) of the area of each pixel within the domain. Pixel area only varies with latitude, 
+        #so this broadcasts against any grid with the same georeferencing.
         
-        #Returns a grid of the area of each pixel within the domain specified by the gdalDataset
+        return self._derived_array('area_per_pixel_compact', self.__calculate_area_per_pixel_compact)
+    
+    def __calculate_area_per_pixel_compact(self):
     
         re = 6371.0 * 1000.0 #radius of the earth in meters
     
         dLong = np.abs(self._georef_info.geoTransform[1])
         dLat = np.abs(self._georef_info.geoTransform[5])
         
-        lats = self._georef_info.yllcenter + np.float64(range(self._georef_info.ny))*dLat
-        longs = self._georef_info.xllcenter + np.float64(range(self._georef_info.nx))*dLong
-            
+        lats = self._georef_info.yllcenter + np.arange(self._georef_info.ny, dtype = float64)*dLat
+        
         #Get the size of pixels in the lat and long direction
-
-        [LONG, LAT] = np.meshgrid(longs, lats)
-        LAT1 = np.radians(LAT - dLat / 2.0)
-        LAT2 = np.radians(LAT + dLat / 2.0)
-        LONG1 = np.radians(LONG - dLong / 2.0)
-        LONG2 = np.radians(LONG + dLong / 2.0)
+        LAT1 = np.radians(lats - dLat / 2.0)
+        LAT2 = np.radians(lats + dLat / 2.0)
+        
+        areas = np.flipud(np.abs((re**2)*np.radians(dLong)*(np.sin(LAT2) - np.sin(LAT1))))
+        return areas.reshape((self._georef_info.ny, 1))
+    
+    def _area_per_pixel(self, *args, **kwargs):
+        
+        #Returns a grid of the area of each pixel within the domain specified by the gdalDataset.  This is a read-only view
+        #of the compact representation, copy it before modifying it.
         
-        initialAreas = np.flipud(np.abs((re**2)*(LONG1 - LONG2)*(np.sin(LAT2) - np.sin(LAT1))))
+        return np.broadcast_to(self._area_per_pixel_compact(), (self._georef_info.ny, self._georef_info.nx))
+    
+    def _mean_pixel_dimension_compact(self, *args, **kwargs):
         
-        self.__app = initialAreas
-        return self.__app
+        return self._derived_array('mean_pixel_dimension_compact', lambda: np.sqrt(self._area_per_pixel_compact()))
     
     def _mean_pixel_dimension(self, *args, **kwargs):
         
-        return np.sqrt(self._area_per_pixel())
-
+        return np.broadcast_to(self._mean_pixel_dimension_compact(), (self._georef_info.ny, self._georef_info.nx))
+
+
+terrain_products = ('fx', 'fy', 'fxx', 'fyy', 'fxy', 'slope', 'aspect', 'hillshade', 'multidirectional_hillshade', 'laplacian',
+                    'profile_curvature', 'plan_curvature', 'contour_curvature', 'k1', 'k2')
+
+def _terrain_derivatives(grid, dx, products, **kwargs):
+    # Computes the requested terrain_products of grid in one pass over blocks of rows.  fx, fy, fxx, fyy and fxy are
+    # evaluated once per block with centered differences (x along columns, y along rows, the edges padded with their
+    # own values as in assignBCs) and every product is made from them, so temporaries are a few blocks in size.  dx may
+    # be a scalar or an array that broadcasts against grid (e.g. _mean_pixel_dimension_compact).
+    #
+    # hillshade uses azimuth and inclination (degrees, as in Hillshade); multidirectional_hillshade averages hillshades
+    # for the azimuths in azimuths (default 225, 270, 315 and 360).  dtype = np.float32 computes in single precision.
+    # Returns a dict of product name to array.
+    
+    dtype = np.dtype(kwargs.get('dtype', float64))
+    maximum_chunk_bytes = kwargs.get('maximum_chunk_bytes', 2**26)
+    for product in products:
+        if product not in terrain_products:
+            raise Error.InputError('Product', product + ' is not one of ' + ', '.join(terrain_products))
+    
+    needs_second = any(product in products for product in terrain_products[2:5] + terrain_products[9:])
+    needs_first = any(product not in ('fxx', 'fyy', 'fxy', 'laplacian') for product in products)
+    if 'hillshade' in products or 'multidirectional_hillshade' in products:
+        inclination = kwargs.get('inclination', 45.0)
+        elevRad = (90 - inclination)*np.pi/180
+        azimuths = (kwargs.get('azimuth', 315.0),) if 'hillshade' in products else ()
+        multidirectional_azimuths = tuple(kwargs.get('azimuths', (225.0, 270.0, 315.0, 360.0))) if 'multidirectional_hillshade' in products else ()
+    
+    (ny, nx) = grid.shape
+    dx = np.asarray(dx, dtype = dtype)
+    outputs = dict((product, np.empty((ny, nx), dtype = dtype)) for product in products)
+    rows_per_chunk = max(1, maximum_chunk_bytes // (dtype.itemsize * (nx + 2) * (12 + len(products))))
+    
+    def hillshade(slope, aspect, azimuth):
+        azRad = (360 - azimuth + 90)*np.pi/180
+        return 255.0 * ((np.cos(elevRad) * np.cos(slope)) + (np.sin(elevRad)* np.sin(slope) * np.cos(azRad - aspect)))
+    
+    for start in range(0, ny, rows_per_chunk):
+        end = min(start + rows_per_chunk, ny)
+        (top, bottom) = (max(start - 1, 0), min(end + 1, ny))
+        z = np.pad(np.asarray(grid[top:bottom], dtype = dtype), ((1 - (start - top), 1 - (bottom - end)), (1, 1)), mode = 'edge')
+        h = dx[start:end] if dx.ndim == 2 else dx
+        center = z[1:-1, 1:-1]
+        d = dict()
+        if needs_first:
+            d['fx'] = (z[1:-1, 2:] - z[1:-1, :-2])/(2*h)
+            d['fy'] = (z[2:, 1:-1] - z[:-2, 1:-1])/(2*h)
+        if needs_second:
+            d['fxx'] = (z[1:-1, 2:] - 2*center + z[1:-1, :-2])/h**2
+            d['fyy'] = (z[2:, 1:-1] - 2*center + z[:-2, 1:-1])/h**2
+            d['fxy'] = (z[2:, 2:] - z[2:, :-2] - z[:-2, 2:] + z[:-2, :-2])/(4*h**2)
+        
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            if needs_first:
+                p = d['fx']**2 + d['fy']**2
+            if any(product in products for product in ('slope', 'aspect', 'hillshade', 'multidirectional_hillshade')):
+                d['slope'] = np.sqrt(p)
+                d['aspect'] = np.arctan2(d['fy'], d['fx'])
+            if 'hillshade' in products or 'multidirectional_hillshade' in products:
+                slope_angle = np.arctan(d['slope'])
+                if 'hillshade' in products:
+                    d['hillshade'] = hillshade(slope_angle, d['aspect'], azimuths[0])
+                if 'multidirectional_hillshade' in products:
+                    d['multidirectional_hillshade'] = sum(hillshade(slope_angle, d['aspect'], azimuth) for azimuth in multidirectional_azimuths) / len(multidirectional_azimuths)
+            if 'laplacian' in products:
+                d['laplacian'] = d['fxx'] + d['fyy']
+            if any(product in products for product in ('profile_curvature', 'plan_curvature', 'contour_curvature')):
+                (fx, fy, fxx, fyy, fxy) = (d['fx'], d['fy'], d['fxx'], d['fyy'], d['fxy'])
+                if 'profile_curvature' in products:
+                    d['profile_curvature'] = (fxx*fx**2 + 2*fxy*fx*fy + fyy*fy**2)/(p*np.power(p + 1, 1.5))
+                across = fxx*fy**2 - 2*fxy*fx*fy + fyy*fx**2
+                if 'plan_curvature' in products:
+                    d['plan_curvature'] = across/np.power(p, 1.5)
+                if 'contour_curvature' in products:
+                    d['contour_curvature'] = across/(p*np.sqrt(p + 1))
+            if 'k1' in products or 'k2' in products:
+                (fx, fy, fxx, fyy, fxy) = (d['fx'], d['fy'], d['fxx'], d['fyy'], d['fxy'])
+                H = -((fx**2 + 1)*fyy - 2*fx*fy*fxy + (fy**2 + 1)*fxx)/(2*np.power(p + 1, 1.5))
+                K = (fxx*fyy - fxy**2)/(p + 1)**2
+                root = np.sqrt(H**2 - K)
+                (d['k1'], d['k2']) = (H + root, H - root)
+        
+        for product in products:
+            outputs[product][start:end] = d[product]
+    
+    return outputs
 
 class CalculationMixin(object):
     
@@ -415,35 +569,15 @@ class CalculationMixin(object):
         #calculates finite differnces in X and Y direction using the centered difference method.
         #Applies a boundary condition such that the size and location of the grids in is the same as that out.
     
-        #Assign boundary conditions
-        Zbc = self.assignBCs(grid,grid.shape[1],grid.shape[0])
-    
-        #Compute finite differences
-        Cx = (Zbc[1:-1, 2:] - 2*Zbc[1:-1, 1:-1] + Zbc[1:-1, :-2])/dx**2
-        Cy = (Zbc[2:, 1:-1] - 2*Zbc[1:-1, 1:-1] + Zbc[:-2, 1:-1])/dx**2
-    
-        return Cx+Cy
+        return _terrain_derivatives(grid, dx, ('laplacian',), dtype = self._product_dtype())['laplacian']
     
     def calcContourCurvature(self, grid,dx):
         # kt = (fxx*fy^2 - 2*fxyfxfy + fyy*fx^2)/((fx^2 + fy^2)*sqrt((fx^2 + fy^2)+1)
+        # The outermost rows and columns are left as NaN.
     
-        #Preallocate
-        Kt = np.zeros_like(grid)*np.nan
-    
-        #First derivatives, 2nd order centered difference
-        fx = (grid[1:-1,2:] - grid[1:-1,:-2])/(dx*2)
-        fy = (grid[2:,1:-1] - grid[:-2,1:-1])/(dx*2)
-    
-        #Second derivatives, 2nd order centered differece
-        fxx = (grid[1:-1,2:] - 2*grid[1:-1,1:-1] + grid[1:-1,:-2])/(dx**2)
-        fyy = (grid[2:,1:-1] - 2*grid[1:-1,1:-1] + grid[:-2,1:-1])/(dx**2);
-    
-        #Partial derivative
-        fxy = (grid[2:,2:] - grid[2:,1:-1] - grid[1:-1,2:] + 2*grid[1:-1,1:-1] - grid[:-2,1:-1] - grid[1:-1,:-2] + grid[:-2,:-2])
-        fxy = fxy/(4*dx**2)
-    
-        #Contour curvature
-        Kt[1:-1, 1:-1] = (fxx*fy**2 - 2*fxy*fx*fy + fyy*fx**2)/((fx**2 + fy**2)*np.sqrt((fx**2 + fy**2)+1))
+        Kt = _terrain_derivatives(grid, dx, ('contour_curvature',), dtype = self._product_dtype())['contour_curvature']
+        Kt[[0, -1], :] = np.nan
+        Kt[:, [0, -1]] = np.nan
     
         return Kt
 
@@ -506,6 +640,88 @@ class BaseSpatialShape(object):
         return BaseSpatialGrid(nx = geoRefInfo.nx, ny = geoRefInfo.ny, projection = projection, geo_transform = geoRefInfo.geoTransform, grid= grid)
 
     
+class _OverviewPyramid(object):
+    
+    # Lazily built overviews of a 2-D (or RGBA) array: level k has cells 2**k times larger than the array.  'mean' 
+    # averages 2 x 2 blocks of the level below, leaving out NaN; 'decimate' takes every 2**k-th cell (for codes, angles 
+    # and colors, which should not be averaged).
+    
+    def __init__(self, data, method = 'mean'):
+        self.levels = [data]
+        self.method = method if np.issubdtype(np.asarray(data).dtype, np.floating) else 'decimate'
+    
+    def level(self, k):
+        if self.method == 'decimate':
+            return self.levels[0][::2**k, ::2**k]
+        while len(self.levels) <= k:
+            below = np.asarray(self.levels[-1], dtype = float64)
+            if below.shape[0] == 1 and below.shape[1] == 1:
+                return below
+            padding = ((0, below.shape[0] % 2), (0, below.shape[1] % 2)) + ((0, 0),) * (below.ndim - 2)
+            below = np.pad(below, padding, mode = 'constant', constant_values = np.nan)
+            blocks = below.reshape((below.shape[0] // 2, 2, below.shape[1] // 2, 2) + below.shape[2:])
+            valid = ~np.isnan(blocks)
+            count = valid.sum(axis = (1, 3))
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                self.levels.append(np.where(valid, blocks, 0.0).sum(axis = (1, 3)) / count)
+        return self.levels[k]
+
+class _OverviewImage(object):
+    
+    # Draws an array with imshow from an _OverviewPyramid, at the coarsest level whose cells are no larger than the 
+    # screen pixels over the current view, cropped to the view.  The image is redrawn when the axes are zoomed or 
+    # panned, so detail is refined on zoom.  extent is [left, right, bottom, top] of the whole array, as for imshow.
+    
+    def __init__(self, pyramid, extent, ax = None, **kwargs):
+        self.pyramid = pyramid
+        self.extent = [float(value) for value in extent]
+        self.ax = ax if ax is not None else plt.gca()
+        (self.ny, self.nx) = pyramid.levels[0].shape[:2]
+        (data, view_extent) = self.__view(self.extent[:2], self.extent[2:])
+        self.image = self.ax.imshow(data, extent = view_extent, **kwargs)
+        self.image._overview_image = self  # The axes only hold weak references to callbacks
+        self.ax.set_xlim(self.extent[0], self.extent[1])
+        self.ax.set_ylim(self.extent[2], self.extent[3])
+        self.ax.set_autoscale_on(False)
+        self.__updating = False
+        self.ax.callbacks.connect('xlim_changed', self.__refresh)
+        self.ax.callbacks.connect('ylim_changed', self.__refresh)
+    
+    def __view(self, xlim, ylim):
+        (left, right, bottom, top) = self.extent
+        (width, height) = ((right - left) / self.nx, (top - bottom) / self.ny)
+        # Full resolution columns and rows in view, with one cell of margin:
+        cols = sorted((int(np.floor((x - left) / width)) for x in xlim))
+        rows = sorted((int(np.floor((top - y) / height)) for y in ylim))
+        (c0, c1) = (max(cols[0] - 1, 0), min(cols[1] + 2, self.nx))
+        (r0, r1) = (max(rows[0] - 1, 0), min(rows[1] + 2, self.ny))
+        (c1, r1) = (max(c1, c0 + 1), max(r1, r0 + 1))
+        try:
+            pixels = max(self.ax.get_window_extent().width, self.ax.get_window_extent().height)
+        except Exception:
+            pixels = 1000.0
+        k = 0
+        while max(c1 - c0, r1 - r0) / 2**k > max(pixels, 1.0) and 2**(k + 1) <= max(self.nx, self.ny):
+            k += 1
+        f = 2**k
+        (lc0, lc1, lr0, lr1) = (c0 // f, -(-c1 // f), r0 // f, -(-r1 // f))
+        data = self.pyramid.level(k)[lr0:lr1, lc0:lc1]
+        view_extent = [left + lc0 * f * width, left + min(lc1 * f, self.nx) * width, 
+                       top - min(lr1 * f, self.ny) * height, top - lr0 * f * height]
+        return data, view_extent
+    
+    def __refresh(self, ax):
+        if self.__updating:
+            return
+        self.__updating = True
+        try:
+            (data, view_extent) = self.__view(ax.get_xlim(), ax.get_ylim())
+            self.image.set_data(data)
+            self.image.set_extent(view_extent)
+            ax.figure.canvas.draw_idle()
+        finally:
+            self.__updating = False
+
 class BaseSpatialGrid(GDALMixin):
         
     required_inputs_and_actions = ((('nx', 'ny', 'projection', 'geo_transform',),'_create'),
@@ -513,6 +729,7 @@ class BaseSpatialGrid(GDALMixin):
                                    (('gdal_filename',), '_read_gdal'), 
                                    (('nx', 'ny', 'dx'), '_create_random_grid'),)
     dtype = float64
+    precision = None
     
     def __deepcopy__(self, memo):
         import copy
@@ -520,6 +737,8 @@ class BaseSpatialGrid(GDALMixin):
         result = cls.__new__(cls)
         memo[id(self)] = result
         for k, v in self.__dict__.items():
+            if k == '_derived_cache':
+                continue
             setattr(result, k, copy.deepcopy(v, memo))
         return result
         
@@ -529,6 +748,11 @@ class BaseSpatialGrid(GDALMixin):
         self._georef_info = Georef_info()
         self._sorted = False
         
+        # precision (a floating point type) overrides the class's precision for this grid only; see _product_dtype.
+        if kwargs.get('precision') is not None:
+            self.precision = kwargs['precision']
+        kwargs.pop('precision', None)
+        
         if len(kwargs.keys()) == 0:
             return
         
@@ -544,6 +768,7 @@ class BaseSpatialGrid(GDALMixin):
         if i < 0 or j < 0 or i > self._georef_info.ny or j > self._georef_info.nx:
             return
         self._griddata[i, j] = value
+        self._invalidate_derived_arrays()
     
     def __getitem__(self, key):
         i, j = key
@@ -558,6 +783,26 @@ class BaseSpatialGrid(GDALMixin):
                 print('error: '+ str(i) + str(j))
         
         return None
+    
+    def _halo_griddata(self):
+        # Returns a read-only copy of _griddata surrounded by a one cell ring of nodata (NaN for float grids, 0 otherwise),
+        # so that the 8 neighbors of any cell can be read with plain indexing and no bounds checks: cell (i, j) is at 
+        # (i+1, j+1) in the result.  It is cached with the other value-derived arrays (see _derived_array).
+        
+        def calculate_halo():
+            griddata = self._griddata
+            nodata = np.nan if np.issubdtype(griddata.dtype, np.floating) else 0
+            halo = np.empty((griddata.shape[0] + 2, griddata.shape[1] + 2), dtype = griddata.dtype)
+            halo[[0, -1], :] = nodata
+            halo[:, [0, -1]] = nodata
+            halo[1:-1, 1:-1] = griddata
+            return halo
+        
+        return self._derived_array('halo', calculate_halo, depends_on_values = True)
+    
+    def _get_unchecked(self, i, j):
+        # Fast accessor for internal algorithms: valid for -1 <= i <= ny and -1 <= j <= nx, returns nodata outside of the grid.
+        return self._halo_griddata()[i+1, j+1]
         
     def __get_evaluative_action(self, *args, **kwargs):
                 
@@ -598,6 +843,7 @@ class BaseSpatialGrid(GDALMixin):
         if kwargs.get('mask') is not None:
             i = np.where(kwargs.get('mask')._griddata == 1)
             self._griddata[i] = np.random.rand(len(i[0]))
+            self._invalidate_derived_arrays()
         else:
             self._griddata = np.random.rand(self._georef_info.ny, self._georef_info.nx)
             
@@ -639,70 +885,313 @@ class BaseSpatialGrid(GDALMixin):
         inBounds = (outRows >= 0)*(outRows < self._georef_info.ny)*(outCols >= 0)*(outCols < self._georef_info.nx)
         return (outRows[inBounds], outCols[inBounds], dxMults[inBounds])
     
+    def __nearest_rowscols(self, xs, ys):
+        xs = np.asarray(xs, dtype = float64)
+        ys = np.asarray(ys, dtype = float64)
+        cols = np.round((xs - self._georef_info.xllcenter) / self._georef_info.dx)
+        rows = (self._georef_info.ny - 1) - np.round((ys - self._georef_info.yllcenter) / self._georef_info.dx)
+        return rows, cols
+    
+    def _xy_to_rowscols_array(self, xs, ys):
+        # Array version of _xy_to_rowscols.  Returns integer arrays of rows and columns, with -1 in both for points
+        # that fall outside of the grid.
+        
+        rows, cols = self.__nearest_rowscols(xs, ys)
+        in_bounds = (cols >= 0) & (cols < self._georef_info.nx) & (rows >= 0) & (rows < self._georef_info.ny)
+        rows = np.where(in_bounds, rows, -1).astype(np.intp)
+        cols = np.where(in_bounds, cols, -1).astype(np.intp)
+        return rows, cols
+    
+    def _rowscols_to_xy_array(self, rows, cols):
+        # Array version of _rowscols_to_xy.  Returns float arrays of x and y, with NaN in both for indexes that fall outside
+        # of the grid (including the -1 used by _xy_to_rowscols_array).
+        
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        xs = cols.astype(float64)*self._georef_info.dx + self._georef_info.xllcenter
+        ys = (float64(self._georef_info.ny - 1.0) - rows.astype(float64))*self._georef_info.dx + self._georef_info.yllcenter
+        
+        in_bounds = (cols >= 0) & (cols < self._georef_info.nx) & (rows >= 0) & (rows < self._georef_info.ny)
+        xs[~in_bounds] = np.nan
+        ys[~in_bounds] = np.nan
+        return xs, ys
+    
     def _xy_to_rowscols(self, v):
-        l = list()
-        for (x,y) in v:
-
-            col = int(round((x-self._georef_info.xllcenter)/self._georef_info.dx))
-            row = int((self._georef_info.ny - 1) - round((y-self._georef_info.yllcenter)/self._georef_info.dx))
-
-            if col > self._georef_info.nx or row > self._georef_info.ny or col < 0 or row < 0:
-                l.append((None, None))
-            else:
-                l.append((row,col))
-        return tuple(l)
+        v = np.array(list(v), dtype = float64).reshape((-1, 2))
+        rows, cols = self.__nearest_rowscols(v[:,0], v[:,1])
+        rows = rows.astype(int).tolist()
+        cols = cols.astype(int).tolist()
+        nx, ny = self._georef_info.nx, self._georef_info.ny
+        return tuple((None, None) if (col > nx or row > ny or col < 0 or row < 0) else (row, col) for (row, col) in zip(rows, cols))
     
     def _rowscols_to_xy(self, l):
-        v = list()
-        for(row,col) in l:
-            x = float64(col)*self._georef_info.dx + self._georef_info.xllcenter
-            y = (float64(self._georef_info.ny - 1.0) - float64(row))*self._georef_info.dx + self._georef_info.yllcenter
-            v.append((x,y))
-        return tuple(v)
+        l = np.array(list(l), dtype = float64).reshape((-1, 2))
+        x = l[:,1]*self._georef_info.dx + self._georef_info.xllcenter
+        y = (float64(self._georef_info.ny - 1.0) - l[:,0])*self._georef_info.dx + self._georef_info.yllcenter
+        return tuple(zip(x.tolist(), y.tolist()))
+    
+    def sample(self, xs, ys, grids = None, method = 'nearest'):
+        # Extracts the values of one or more grids (aligned with this one) at the locations xs, ys in a single pass.
+        # method is 'nearest' or 'bilinear'.  Returns an array of shape (number of grids, number of points), with NaN 
+        # for points that fall outside of the grid.
+        
+        if grids is None:
+            grids = [self]
+        
+        xs = np.atleast_1d(np.asarray(xs, dtype = float64))
+        ys = np.atleast_1d(np.asarray(ys, dtype = float64))
+        values = np.empty((len(grids), len(xs)), dtype = float64)
+        values[:] = np.nan
+        
+        if method == 'nearest':
+            rows, cols = self._xy_to_rowscols_array(xs, ys)
+            valid = rows >= 0
+            (rows, cols) = (rows[valid], cols[valid])
+            for (n, grid) in enumerate(grids):
+                values[n, valid] = grid._griddata[rows, cols]
+        elif method == 'bilinear':
+            (nx, ny) = (self._georef_info.nx, self._georef_info.ny)
+            colf = (xs - self._georef_info.xllcenter) / self._georef_info.dx
+            rowf = (ny - 1) - (ys - self._georef_info.yllcenter) / self._georef_info.dx
+            valid = (colf >= 0) & (colf <= nx - 1) & (rowf >= 0) & (rowf <= ny - 1)
+            (colf, rowf) = (colf[valid], rowf[valid])
+            col0 = np.minimum(np.floor(colf).astype(np.intp), max(nx - 2, 0))
+            row0 = np.minimum(np.floor(rowf).astype(np.intp), max(ny - 2, 0))
+            col1 = np.minimum(col0 + 1, nx - 1)
+            row1 = np.minimum(row0 + 1, ny - 1)
+            (wc, wr) = (colf - col0, rowf - row0)
+            for (n, grid) in enumerate(grids):
+                g = grid._griddata
+                values[n, valid] = (g[row0, col0] * (1.0 - wr) * (1.0 - wc) + g[row0, col1] * (1.0 - wr) * wc + 
+                                    g[row1, col0] * wr * (1.0 - wc) + g[row1, col1] * wr * wc)
+        else:
+            raise Error.InputError('method', 'must be \'nearest\' or \'bilinear\'')
+        
+        return values
+    
+    def __georef_key(self):
+        geoTransform = self._georef_info.geoTransform
+        if isinstance(geoTransform, (list, tuple)):
+            geoTransform = tuple(geoTransform)
+        return (geoTransform, self._georef_info.dx, self._georef_info.nx, self._georef_info.ny, self._georef_info.xllcenter, self._georef_info.yllcenter)
+    
+    def __values_signature(self):
+        # A count of the in-place writes to _griddata (bumped by _invalidate_derived_arrays) and a hash of a strided
+        # sample of about 32 x 32 of its values.
+        griddata = self._griddata
+        sample = griddata[tuple(slice(None, None, max(1, n // 32)) for n in griddata.shape)]
+        return (self.__dict__.get('_griddata_writes', 0), hash(np.ascontiguousarray(sample).tobytes()))
+    
+    def _derived_array(self, name, factory, depends_on_values = False):
+        # Memoizes arrays that are derived from the georeferencing of this grid (and optionally from the values in _griddata).
+        # Entries are invalidated when the georeferencing changes or when _griddata is replaced.  Entries that depend on
+        # the values are also checked against __values_signature on every use: methods that modify _griddata in place
+        # call _invalidate_derived_arrays when they are done (as __setitem__ and set_value_at_indexes do), which bumps
+        # the write count, and the sample catches most writes made without it (e.g. grid._griddata[i] = value from
+        # outside of this module).  A write that touches none of the sampled cells still needs _invalidate_derived_arrays.
+        # Cached arrays are read-only.
+        
+        cache = self.__dict__.setdefault('_derived_cache', dict())
+        key = self.__georef_key()
+        griddata = self.__dict__.get('_griddata') if depends_on_values else None
+        signature = self.__values_signature() if depends_on_values else None
+        entry = cache.get(name)
+        if entry is not None and entry[0] == key and entry[1] is griddata and entry[2] == signature:
+            return entry[3]
+        value = factory()
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        cache[name] = (key, griddata, signature, value)
+        return value
+    
+    def _invalidate_derived_arrays(self, values_only = True, keep = ()):
+        # Call after modifying _griddata in place.  Entries that only depend on georeferencing are kept unless values_only is False.
+        # Entries named in keep are kept too, and marked as up to date with the new values (for callers that bring them
+        # up to date themselves, see _patch_derived_array).
+        self._griddata_writes = self.__dict__.get('_griddata_writes', 0) + 1
+        cache = self.__dict__.get('_derived_cache')
+        if cache is None:
+            return
+        if not values_only:
+            cache.clear()
+            return
+        for name in [name for (name, entry) in cache.items() if entry[1] is not None]:
+            if name in keep:
+                (key, griddata, signature, value) = cache[name]
+                cache[name] = (key, griddata, self.__values_signature(), value)
+            else:
+                cache.pop(name)
+    
+    def _patch_derived_array(self, name, patch):
+        # Calls patch(array) to update a cached array in place, for callers that know how a local change to _griddata 
+        # changes it (and have kept it through _invalidate_derived_arrays).  Returns False (and does nothing) if the 
+        # array is not cached.
+        entry = self.__dict__.get('_derived_cache', dict()).get(name)
+        if entry is None or entry[1] is not self.__dict__.get('_griddata') or entry[2] != self.__values_signature():
+            return False
+        array = entry[3]
+        array.flags.writeable = True
+        try:
+            patch(array)
+        finally:
+            array.flags.writeable = False
+        return True
+    
+    def _product_dtype(self):
+        # Floating point type for elevation-derived values made by this grid: the class's precision if it sets one,
+        # otherwise default_precision (see set_precision).
+        return np.dtype(self.precision if self.precision is not None else default_precision)
+    
+    @classmethod
+    def precision_error(cls, dtype = np.float32, *args, **kwargs):
+        # Accuracy check for a reduced precision: builds cls(*args, **kwargs) at float64 and at dtype (passed to each
+        # grid as its precision, so the class and module settings are not touched), and returns the largest absolute
+        # and relative differences between their _griddata, and whether their NaNs agree.
+        
+        (reference, reduced) = [np.asarray(cls(*args, precision = this_dtype, **kwargs)._griddata, dtype = float64) for this_dtype in (float64, dtype)]
+        return _precision_error(reference, reduced)
+    
+    def _area_per_pixel_compact(self, *args, **kwargs):
+        # Constant spacing grids have a single pixel area; returned as a 0-d array that broadcasts against the grid.
+        return self._derived_array('area_per_pixel_compact', lambda: np.array(self._georef_info.dx**2, dtype = float64))
+    
+    def _mean_pixel_dimension_compact(self, *args, **kwargs):
+        return self._derived_array('mean_pixel_dimension_compact', lambda: np.array(self._georef_info.dx, dtype = float64))
     
     def _area_per_pixel(self, *args, **kwargs):
-        return self._georef_info.dx**2 * np.ones((self._georef_info.ny, self._georef_info.nx))
+        # Read-only, full-size view of the compact representation (no allocation).  Copy before modifying.
+        return np.broadcast_to(self._area_per_pixel_compact(), (self._georef_info.ny, self._georef_info.nx))
 
     def _mean_pixel_dimension(self, *args, **kwargs):
-        return self._georef_info.dx * np.ones_like(self._griddata, dtype = float64)
+        return np.broadcast_to(self._mean_pixel_dimension_compact(), (self._georef_info.ny, self._georef_info.nx))
 
     def get_XY_matricies(self):
-        xllc, yllc, nx, ny, dx = (self._georef_info.xllcenter, self._georef_info.yllcenter, self._georef_info.nx, self._georef_info.ny, self._georef_info.dx)
-        x = np.arange(xllc, xllc+(nx-1)*dx, dx)
-        y = np.arange(yllc, yllc+(ny-1)*dx, dx)
-        return np.meshgrid(x,y)
+        
+        def calculate_xy_vectors():
+            xllc, yllc, nx, ny, dx = (self._georef_info.xllcenter, self._georef_info.yllcenter, self._georef_info.nx, self._georef_info.ny, self._georef_info.dx)
+            x = np.arange(xllc, xllc+(nx-1)*dx, dx)
+            y = np.arange(yllc, yllc+(ny-1)*dx, dx)
+            x.flags.writeable = False
+            y.flags.writeable = False
+            return x, y
+        
+        (x, y) = self._derived_array('xy_vectors', calculate_xy_vectors)
+        return np.meshgrid(x, y, copy = False)
 
-    def resample(self, de):
-        return_grid = self.__class__()
-        return_grid._copy_info_from_grid(self, set_zeros=True)
+    resampling_methods = ('nearest', 'bilinear', 'cubic', 'mean', 'min', 'max', 'mode')
+    
+    def resample(self, de, method = None, maximum_chunk_bytes = 2**26):
+        # Resamples to a grid spacing of de over the same extent (the upper left corner is kept).  nearest, bilinear and 
+        # cubic interpolate at the new cell centers (for upsampling); mean, min, max and mode aggregate the cells whose
+        # centers fall in each new cell, leaving out NaN (for downsampling).  method defaults to cubic when de is
+        # smaller than dx and to mean otherwise.  Rows of the new grid are computed in chunks.
+        
         import copy
-        geoTransform = (self._georef_info.geoTransform[0], 
-                        np.sign(self._georef_info.geoTransform[1])*de, 
-                        self._georef_info.geoTransform[2], 
-                        self._georef_info.geoTransform[3], 
-                        self._georef_info.geoTransform[4], 
-                        np.sign(self._georef_info.geoTransform[5])*de)
         
+        if method is None:
+            method = 'cubic' if de < self._georef_info.dx else 'mean'
+        if method not in self.resampling_methods:
+            raise Error.InputError('Method', 'must be one of ' + ', '.join(self.resampling_methods))
+        
+        dx = self._georef_info.dx
         georef = copy.deepcopy(self._georef_info)
-        georef.geoTransform = geoTransform
+        georef.geoTransform = (self._georef_info.geoTransform[0], 
+                               np.sign(self._georef_info.geoTransform[1])*de, 
+                               self._georef_info.geoTransform[2], 
+                               self._georef_info.geoTransform[3], 
+                               self._georef_info.geoTransform[4], 
+                               np.sign(self._georef_info.geoTransform[5])*de)
         georef.dx = de
-        georef.nx = int(np.round(self._georef_info.nx * self._georef_info.dx / de))
-        georef.ny = int(np.round(self._georef_info.ny * self._georef_info.dx / de))
+        georef.nx = int(np.round(self._georef_info.nx * dx / de))
+        georef.ny = int(np.round(self._georef_info.ny * dx / de))
+        georef.xllcenter = self._georef_info.xllcenter - 0.5*dx + 0.5*de
+        georef.yllcenter = self._georef_info.yllcenter + (self._georef_info.ny - 0.5)*dx - (georef.ny - 0.5)*de
+        
+        return_grid = self.__class__()
         return_grid._georef_info = georef
-        xo = np.linspace(self._georef_info.xllcenter,(self._georef_info.nx-1)*(self._georef_info.dx), num = self._georef_info.nx)
-        yo = np.linspace(self._georef_info.yllcenter,(self._georef_info.ny-1)*(self._georef_info.dx), num = self._georef_info.ny)
-        xf = np.linspace(georef.xllcenter,(georef.nx-1)*georef.dx, num = georef.nx)
-        yf = np.linspace(georef.yllcenter,(georef.ny-1)*georef.dx, num = georef.ny)
-        from scipy.interpolate import interp2d
-        interp_grid = copy.deepcopy(self._griddata)
-        if geoTransform[1] > 0:
-            interp_grid = np.fliplr(interp_grid)
-        if geoTransform[5] < 0:
-            interp_grid = np.flipud(interp_grid)
-        f = interp2d(xo, yo, interp_grid, kind='quintic')
-        return_grid._griddata = f(xf, yf)
+        
+        grid = np.asarray(self._griddata, dtype = float64)
+        griddata = np.empty((georef.ny, georef.nx), dtype = float64)
+        rows_per_chunk = max(1, int(maximum_chunk_bytes // (8 * 8 * max(georef.nx, 1) * max(1.0, de / dx))))
+        
+        if method in ('nearest', 'bilinear', 'cubic'):
+            from scipy.ndimage import map_coordinates, spline_filter
+            order = {'nearest': 0, 'bilinear': 1, 'cubic': 3}[method]
+            valid = ~np.isnan(grid)
+            fill_nodata = order > 0 and not np.all(valid) and np.any(valid)
+            if fill_nodata:
+                # NaN cells are filled from the nearest valid cell so that they do not spread through the spline 
+                # prefilter; new cells that interpolate from any nodata cell (where the bilinearly interpolated valid
+                # mask is below 1) are set back to NaN.
+                from scipy.ndimage import distance_transform_edt
+                nearest_valid = distance_transform_edt(~valid, return_distances = False, return_indices = True)
+                grid = grid[tuple(nearest_valid)]
+                valid = valid.astype(float64)
+            if order > 1:
+                grid = spline_filter(grid, order = order, mode = 'nearest')
+            # Positions of the new cell centers in row and column index space of this grid:
+            cols = (np.arange(georef.nx) + 0.5) * de / dx - 0.5
+            for start in range(0, georef.ny, rows_per_chunk):
+                end = min(start + rows_per_chunk, georef.ny)
+                rows = (np.arange(start, end) + 0.5) * de / dx - 0.5
+                (R, C) = np.meshgrid(rows, cols, indexing = 'ij')
+                if order == 0:
+                    (R, C) = (np.clip(np.floor(R + 0.5), 0, grid.shape[0] - 1), np.clip(np.floor(C + 0.5), 0, grid.shape[1] - 1))
+                griddata[start:end] = map_coordinates(grid, (R, C), order = order, mode = 'nearest', prefilter = False)
+                if fill_nodata:
+                    griddata[start:end][map_coordinates(valid, (R, C), order = 1, mode = 'nearest', prefilter = False) < 1.0 - 1E-9] = np.nan
+        else:
+            # Each cell goes to the new cell that contains its center:
+            cols = np.floor((np.arange(grid.shape[1]) + 0.5) * dx / de).astype(np.intp)
+            rows = np.floor((np.arange(grid.shape[0]) + 0.5) * dx / de).astype(np.intp)
+            for start in range(0, georef.ny, rows_per_chunk):
+                end = min(start + rows_per_chunk, georef.ny)
+                in_chunk = np.flatnonzero((rows >= start) & (rows < end))
+                in_grid = cols < georef.nx
+                labels = ((rows[in_chunk, np.newaxis] - start) * georef.nx + cols[np.newaxis, in_grid]).ravel()
+                values = grid[in_chunk][:, in_grid].ravel()
+                griddata[start:end] = self.__aggregate(labels, values, (end - start) * georef.nx, method).reshape((end - start, georef.nx))
+        
+        if method in ('nearest', 'min', 'max', 'mode') and np.issubdtype(self._griddata.dtype, np.integer):
+            griddata = np.where(np.isnan(griddata), 0, griddata).astype(self._griddata.dtype)
+        return_grid._griddata = griddata
         return return_grid
     
+    def __aggregate(self, labels, values, size, method):
+        
+        # Reduces values that share a label (0 <= label < size) with method, leaving out NaN; labels with no values are NaN.
+        
+        valid = ~np.isnan(values)
+        (labels, values) = (labels[valid], values[valid])
+        out = np.full(size, np.nan)
+        if len(values) == 0:
+            return out
+        
+        if method == 'mean':
+            count = np.bincount(labels, minlength = size)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                out = np.bincount(labels, weights = values, minlength = size) / count
+            out[count == 0] = np.nan
+            return out
+        
+        # Sort by label (and by value, for mode), then reduce over runs of equal labels:
+        order = np.lexsort((values, labels)) if method == 'mode' else np.argsort(labels, kind = 'stable')
+        (labels, values) = (labels[order], values[order])
+        starts = np.flatnonzero(np.concatenate(((True,), labels[1:] != labels[:-1])))
+        if method == 'min':
+            out[labels[starts]] = np.minimum.reduceat(values, starts)
+        elif method == 'max':
+            out[labels[starts]] = np.maximum.reduceat(values, starts)
+        else:
+            # Runs of equal (label, value); the longest run in each label wins, the smallest value on ties:
+            run_starts = np.flatnonzero(np.concatenate(((True,), (labels[1:] != labels[:-1]) | (values[1:] != values[:-1]))))
+            run_lengths = np.diff(np.concatenate((run_starts, (len(values),))))
+            run_labels = labels[run_starts]
+            best = np.lexsort((-run_lengths, run_labels))
+            first = np.concatenate(((True,), run_labels[best][1:] != run_labels[best][:-1]))
+            out[run_labels[best][first]] = values[run_starts[best][first]]
+        return out
+
     def location_in_grid(self, xo):
         index = self._xy_to_rowscols((xo,))[0]
         return index[0] is not None and index[1] is not None and self[index[0], index[1]] is not None and self[index[0], index[1]] != 0 and not np.isnan(self[index[0], index[1]])
@@ -800,29 +1289,59 @@ class BaseSpatialGrid(GDALMixin):
             return self._sort_indexes
     
     def apply_moving_window(self, moving_window):
-        out_grid = None
-        out_grid._georef_info = self._georef_info
+        out_grid = BaseSpatialGrid()
+        out_grid._copy_info_from_grid(self, True)
+        out_grid.dtype = self.dtype
         out_grid._griddata = moving_window.apply_moving_window(self._griddata, self._georef_info.dx, self.dtype)
         return out_grid
     
-    def average_over_distance(self, distance, grid = None):
-        (nx, ny) = (self._georef_info.nx, self._georef_info.ny)
-        (dx, dy) = (self._georef_info.dx, self._georef_info.dx)
-        (xmin, xmax) = (self._georef_info.xllcenter, nx*dx+self._georef_info.xllcenter)
-        (ymin, ymax) = (self._georef_info.yllcenter, ny*dy+self._georef_info.yllcenter)
-        (xcenter, ycenter) = ((xmin+xmax) / 2.0, (ymin+ymax) / 2.0)
-        [x,y] = np.meshgrid(np.arange(xmin, xmax, dx),np.arange(ymin, ymax, dy))
-        D = np.sqrt(np.power((x - xcenter),2) + np.power((y - ycenter), 2))
-        template = (D <= distance).astype(float)
-        template /= np.sum(template[:])
+    def average_over_distance(self, distance, grid = None, shape = 'disk'):
         if grid is None:
             grid = self._griddata
+        return self.average_grids_over_distance(distance, (grid, ), shape = shape)[0]
+    
+    def average_grids_over_distance(self, distance, grids, shape = 'disk'):
+        # Averages each grid over the cells within distance of each cell (a disk), or within a square of half-width
+        # distance (shape = 'box').  NaN cells and cells beyond the edge of the grid are left out by dividing by the
+        # number of valid cells under the window, and cells with no valid cells in reach are NaN.  Disks are convolved
+        # with a kernel-sized overlap-add FFT; boxes use a summed-area table.
         
-        from numpy.fft import fft2 as fft2
-        from numpy.fft import ifft2 as ifft2
-        from numpy.fft import ifftshift
+        from scipy.signal import oaconvolve
         
-        return np.real(ifftshift(ifft2(fft2(grid)*fft2(template))))
+        dx = self._georef_info.dx
+        radius = int(np.floor(distance / dx))
+        if shape == 'disk':
+            offsets = np.arange(-radius, radius+1)
+            kernel = (np.hypot(offsets[:,np.newaxis], offsets[np.newaxis,:]) * dx <= distance).astype(float64)
+            window_sum = lambda values: oaconvolve(values, kernel, mode = 'same')
+        elif shape == 'box':
+            window_sum = lambda values: self.__box_sum(values, radius)
+        else:
+            raise Error.InputError('shape', "must be 'disk' or 'box'")
+        
+        averages = []
+        for grid in grids:
+            grid = np.asarray(grid, dtype = float64)
+            valid = ~np.isnan(grid)
+            if np.all(valid) and grid.shape == self._griddata.shape:
+                counts = self._derived_array('window_counts_' + shape + '_' + repr(float(distance)), lambda: np.rint(window_sum(np.ones(grid.shape))))
+            else:
+                counts = np.rint(window_sum(valid.astype(float64)))
+            # Sums are taken about the mean to limit round-off:
+            offset = np.mean(grid[valid]) if np.any(valid) else 0.0
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                average = window_sum(np.where(valid, grid - offset, 0.0)) / counts + offset
+            average[counts == 0] = np.nan
+            averages.append(average)
+        
+        return averages
+    
+    def __box_sum(self, values, radius):
+        # Sum of values over the (2*radius+1) square centered on each cell, from a summed-area table.
+        
+        size = 2*radius + 1
+        table = np.pad(values, ((radius+1, radius), (radius+1, radius)), mode = 'constant').cumsum(axis = 0).cumsum(axis = 1)
+        return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
         
     def clip_to_bounds(self, bounds):
         extent = (bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1])
@@ -889,71 +1408,103 @@ class BaseSpatialGrid(GDALMixin):
         # of the grids in is the same as that out. However, the larger N is, the more NoData
         #Will be around the edges .
     
-        #Compute finite differences
-        elevGrid = self._griddata
-        dx = self._georef_info.dx
-        N = np.ceil(length_scale / dx)
-        
-        Sx = (elevGrid[N:-N, (2*N):] - elevGrid[N:-N, :-(2*N)])/(((2*N)+1)*dx)
-        Sy = (elevGrid[(2*N):,N:-N] - elevGrid[:-(2*N), N:-N])/(((2*N)+1)*dx)
-    
-        #Create two new arrays of the original DEMs size
-        SxPadded = np.empty(elevGrid.shape)
-        SxPadded[:] = np.NAN
-        SyPadded = np.empty(elevGrid.shape)
-        SyPadded[:] = np.NAN
-    
-        SyPadded[N:-N, N:-N] = Sy
-        SxPadded[N:-N, N:-N] = Sx
-    
-        return SxPadded, SyPadded
+        (SxPadded, SyPadded) = self.calculate_gradients_over_length_scales((length_scale, ))
+        return SxPadded[0], SyPadded[0]
     
     def calculate_laplacian_over_length_scale(self, length_scale):
         #C = calcFiniteCurv(elevGrid, dx)
         #calculates finite differnces in X and Y direction using the centered difference method.
         #Applies a boundary condition such that the size and location of the grids in is the same as that out.
     
-        dx = self._georef_info.dx
-        grid = self._griddata
-        winRad = np.ceil(length_scale / dx)
-        #Assign boundary conditions
-        Curv = np.zeros_like(grid)*np.nan
+        return self.calculate_laplacians_over_length_scales((length_scale, ))[0]
     
-        #Compute finite differences
-        Cx = (grid[winRad:-winRad, (2*winRad):] - 2*grid[winRad:-winRad, winRad:-winRad] + grid[winRad:-winRad, :-(2*winRad)])/(2*dx*winRad)**2
-        Cy = (grid[(2*winRad):, winRad:-winRad] - 2*grid[winRad:-winRad, winRad:-winRad] + grid[:-(2*winRad), winRad:-winRad])/(2*dx*winRad)**2
+    def calculate_gradients_over_length_scales(self, length_scales, **kwargs):
+        # Stacked version of calculate_gradient_over_length_scale: returns Sx and Sy as arrays of shape 
+        # (len(length_scales), ny, nx).  smoothing optionally gives the standard deviation of a Gaussian (in the units of 
+        # dx, one value or one per length scale) that the elevation is smoothed with before differencing.
+        
+        return self.__differences_over_length_scales(length_scales, 'gradient', **kwargs)
     
-        Curv[winRad:-winRad,winRad:-winRad] = Cx+Cy
-        return Curv
-
-    def principal_curvatures(self):
-        Zy, Zx  = np.gradient(self._griddata, self._georef_info.dx)
-        Zxy, Zxx = np.gradient(Zx, self._georef_info.dx)
-        Zyy, _ = np.gradient(Zy, self._georef_info.dx)
+    def calculate_laplacians_over_length_scales(self, length_scales, **kwargs):
+        # Stacked version of calculate_laplacian_over_length_scale, with the same keyword arguments as
+        # calculate_gradients_over_length_scales.
+        
+        return self.__differences_over_length_scales(length_scales, 'laplacian', **kwargs)[0]
+    
+    def __differences_over_length_scales(self, length_scales, kind, smoothing = None, maximum_chunk_bytes = 2**26):
         
-        H = (Zx**2 + 1)*Zyy - 2*Zx*Zy*Zxy + (Zy**2 + 1)*Zxx
-        H = -H/(2*(Zx**2 + Zy**2 + 1)**(1.5))
+        # For each length scale, cells within N = ceil(length_scale / dx) of the edges are NaN.  The (smoothed) 
+        # elevation is shared by all scales with the same smoothing, and differences are taken in blocks of rows.
         
-        K = (Zxx * Zyy - (Zxy ** 2)) /  (1 + (Zx ** 2) + (Zy **2)) ** 2
+        from scipy.ndimage import gaussian_filter1d
         
-        k1 = H + np.sqrt(np.power(H,2) - K)
-        k2 = H - np.sqrt(np.power(H,2) - K)
+        dx = self._georef_info.dx
+        (ny, nx) = self._griddata.shape
+        half_widths = [int(np.ceil(length_scale / dx)) for length_scale in length_scales]
+        sigmas = list(smoothing) if np.ndim(smoothing) > 0 else [smoothing] * len(half_widths)
+        if len(sigmas) != len(half_widths):
+            raise Error.InputError('Smoothing', 'must be a single value or one value per length scale')
+        
+        smoothed = dict()
+        def elevation_for(sigma):
+            if sigma is None or sigma == 0:
+                return np.asarray(self._griddata, dtype = float64)
+            if sigma not in smoothed:
+                grid = gaussian_filter1d(np.asarray(self._griddata, dtype = float64), sigma / dx, axis = 0, mode = 'nearest')
+                smoothed[sigma] = gaussian_filter1d(grid, sigma / dx, axis = 1, mode = 'nearest')
+            return smoothed[sigma]
+        
+        outputs = [np.full((len(half_widths), ny, nx), np.nan) for _ in range(2 if kind == 'gradient' else 1)]
+        rows_per_chunk = max(1, maximum_chunk_bytes // (8 * 4 * nx))
+        
+        for (layer, (N, sigma)) in enumerate(zip(half_widths, sigmas)):
+            if N < 1 or 2*N >= ny or 2*N >= nx:
+                continue
+            grid = elevation_for(sigma)
+            for start in range(N, ny - N, rows_per_chunk):
+                end = min(start + rows_per_chunk, ny - N)
+                center = grid[start:end, N:-N]
+                (east, west) = (grid[start:end, (2*N):], grid[start:end, :-(2*N)])
+                (south, north) = (grid[start+N:end+N, N:-N], grid[start-N:end-N, N:-N])
+                if kind == 'gradient':
+                    outputs[0][layer, start:end, N:-N] = (east - west)/(((2*N)+1)*dx)
+                    outputs[1][layer, start:end, N:-N] = (south - north)/(((2*N)+1)*dx)
+                else:
+                    outputs[0][layer, start:end, N:-N] = ((east - 2*center + west) + (south - 2*center + north))/(2*dx*N)**2
+        
+        return outputs
+
+    def principal_curvatures(self):
         
-        k1re = BaseSpatialGrid()
-        k1re._copy_info_from_grid(self, True)
-        k2re = BaseSpatialGrid()
-        k2re._copy_info_from_grid(self, True)
-        k1re._griddata = k1
-        k2re._griddata = k2
+        grids = self.terrain_derivatives(('k1', 'k2'), dx = self._georef_info.dx)
+        return (grids['k1'], grids['k2'])
+    
+    def terrain_derivatives(self, products, **kwargs):
+        # Any of terrain_products, from a single pass over this grid (see _terrain_derivatives for the keyword 
+        # arguments).  Returns a dict of product name to BaseSpatialGrid.
         
-        return (k1re, k2re)
+        dx = kwargs.pop('dx', None)
+        kwargs.setdefault('dtype', self._product_dtype())
+        values = _terrain_derivatives(self._griddata, self._mean_pixel_dimension_compact() if dx is None else dx, products, **kwargs)
+        grids = dict()
+        for (product, value) in values.items():
+            grids[product] = BaseSpatialGrid()
+            grids[product]._copy_info_from_grid(self, True)
+            grids[product]._griddata = value
+        return grids
         
     def plot(self, **kwargs):
+        # Large grids are drawn from overviews matched to the size of the axes (overviews = False draws every cell).  The
+        # overviews are built for each call, so they always show the current values.
 
         interactive = kwargs.pop('interactive', True)
         colorbar = kwargs.pop('colorbar', True)
+        overviews = kwargs.pop('overviews', True)
         extent = [self._georef_info.xllcenter, self._georef_info.xllcenter+(self._georef_info.nx-0.5)*self._georef_info.dx, self._georef_info.yllcenter, self._georef_info.yllcenter+(self._georef_info.ny-0.5)*self._georef_info.dx]
-        plt.imshow(self._griddata, extent = extent, **kwargs)
+        if overviews:
+            plt.sci(_OverviewImage(_OverviewPyramid(self._griddata), extent, **kwargs).image)
+        else:
+            plt.imshow(self._griddata, extent = extent, **kwargs)
         if interactive:
             plt.ion()
             plt.show(block=False)
@@ -1041,10 +1592,15 @@ class BaseSpatialGrid(GDALMixin):
     def set_value_at_rowscols(self, value, rowscols):
         rowscols_array = (np.array(list(zip(*rowscols))).T[:,0],np.array(list(zip(*rowscols))).T[:,1])
         self._griddata[rowscols_array] = value
+        self._invalidate_derived_arrays()
         
-    def save(self, filename):
+    def save(self, filename, overviews = None):
+        # overviews optionally lists reduction factors (e.g. (2, 4, 8, 16)) for averaged GeoTIFF overviews.
         
-        self._create_gdal_representation_from_array(self._georef_info, 'GTiff', self._griddata, self.dtype, filename, ['COMPRESS=LZW'])
+        gdal_dataset = self._create_gdal_representation_from_array(self._georef_info, 'GTiff', self._griddata, self.dtype, filename, ['COMPRESS=LZW'])
+        if overviews:
+            gdal_dataset.BuildOverviews('AVERAGE' if np.issubdtype(np.dtype(self.dtype), np.floating) else 'NEAREST', list(overviews))
+        gdal_dataset = None
     
     def write_to_ai(self, filename):
         self._writeArcAsciiRaster(self._georef_info, filename, self._griddata, np.NAN, '%10.2f')
@@ -1144,11 +1700,22 @@ class ValueGrid(BaseSpatialGrid):
     def set_value_at_indexes(self, indexes, value):
         ij = zip(*indexes)
         self._griddata[ij] = value
+        self._invalidate_derived_arrays()
         
     
 class FlowDirection(BaseSpatialGrid):
     pass
 
+def _d8_lookup_tables(flow_offsets):
+    di = np.zeros(256, dtype = np.intp)
+    dj = np.zeros(256, dtype = np.intp)
+    length = np.zeros(256, dtype = float64)
+    for (code, (this_di, this_dj)) in flow_offsets.items():
+        di[code] = this_di
+        dj[code] = this_dj
+        length[code] = np.sqrt(this_di**2 + this_dj**2)
+    return di, dj, length
+
 class FlowDirectionD8(FlowDirection):
     
     required_inputs_and_actions = ((('nx', 'ny', 'projection', 'geo_transform',),'_create'),
@@ -1158,6 +1725,14 @@ class FlowDirectionD8(FlowDirection):
     
     from numpy import uint8
     dtype = uint8
+    
+    # (di, dj, code): offset of each neighbor of a cell, and the flow code that neighbor has when it drains into the cell
+    _upstream_neighbors = ((0, 1, 16), (1, 1, 32), (1, 0, 64), (1, -1, 128), (0, -1, 1), (-1, -1, 2), (-1, 0, 4), (-1, 1, 8))
+    
+    # Lookup tables indexed by flow code: offset to the receiving cell, and the unit length of that step (0 for codes
+    # that do not drain anywhere).
+    _flow_offsets = {1: (0, 1), 2: (1, 1), 4: (1, 0), 8: (1, -1), 16: (0, -1), 32: (-1, -1), 64: (-1, 0), 128: (-1, 1)}
+    _flow_di, _flow_dj, _flow_length = _d8_lookup_tables(_flow_offsets)
 
     def _create_from_flooded_dem(self, *args, **kwargs):
         flooded_dem = kwargs['flooded_dem']
@@ -1246,126 +1821,269 @@ class FlowDirectionD8(FlowDirection):
     
     def get_flow_to_cell(self,i,j):
         #Function to get the indices of the cell that is drained to based on the flow direction specified in fd
-            
-        iOut = None
-        jOut = None
-        isGood = False
-
-        if self._griddata[i,j] == 1 and j+1 < self._georef_info.nx:
-            iOut = i
-            jOut = j+1
-        elif self._griddata[i,j] == 2 and i+1 < self._georef_info.ny and j+1 < self._georef_info.nx:
-            iOut = i+1
-            jOut = j+1
-        elif self._griddata[i,j] == 4 and i+1 < self._georef_info.ny:
-            iOut = i+1
-            jOut = j
-        elif self._griddata[i,j] == 8 and i+1 < self._georef_info.ny and j-1 >= 0:
-            iOut = i+1
-            jOut = j-1
-        elif self._griddata[i,j] == 16 and j-1 >= 0:
-            iOut = i
-            jOut = j-1
-        elif self._griddata[i,j] == 32 and i-1 >= 0 and j-1 >= 0:
-            iOut = i-1
-            jOut = j-1
-        elif self._griddata[i,j] == 64 and i-1 >= 0:
-            iOut = i-1
-            jOut = j
-        elif self._griddata[i,j] == 128 and i-1 >= 0 and j+1 < self._georef_info.nx:
-            iOut = i-1
-            jOut = j+1
-    
-        if not(iOut is None):
-            isGood = True
-    
-        return iOut, jOut, isGood
+        
+        offset = self._flow_offsets.get(self._griddata[i,j])
+        if offset is None:
+            return None, None, False
+        
+        (iOut, jOut) = (i + offset[0], j + offset[1])
+        if iOut < 0 or jOut < 0 or iOut >= self._georef_info.ny or jOut >= self._georef_info.nx:
+            return None, None, False
+    
+        return iOut, jOut, True
+    
+    def flow_to(self, indexes):
+        # Vectorized get_flow_to_cell.  indexes are either raveled indexes into the grid or a tuple of (rows, columns).
+        # Returns arrays of the receiving rows and columns and a boolean array that is True where the receiver is valid
+        # (receivers of invalid cells are returned as -1).
+        
+        if isinstance(indexes, tuple):
+            (rows, cols) = (np.asarray(indexes[0], dtype = np.intp), np.asarray(indexes[1], dtype = np.intp))
+        else:
+            (rows, cols) = np.unravel_index(np.asarray(indexes, dtype = np.intp), self._griddata.shape)
+        
+        codes = np.asarray(self._griddata[rows, cols], dtype = np.uint8)
+        rows_next = rows + self._flow_di[codes]
+        cols_next = cols + self._flow_dj[codes]
+        is_good = (self._flow_length[codes] > 0) & (rows_next >= 0) & (cols_next >= 0) & (rows_next < self._georef_info.ny) & (cols_next < self._georef_info.nx)
+        rows_next[~is_good] = -1
+        cols_next[~is_good] = -1
+        return rows_next, cols_next, is_good
+    
+    def flow_length_to(self, indexes):
+        # Unit length (1 or sqrt(2)) of the step from each cell to its receiver, 0 for cells that do not drain.
+        
+        if not isinstance(indexes, tuple):
+            indexes = np.unravel_index(np.asarray(indexes, dtype = np.intp), self._griddata.shape)
+        return self._flow_length[np.asarray(self._griddata[indexes[0], indexes[1]], dtype = np.uint8)]
+
+    def receiver_indexes(self):
+        # Flat index of the cell that each cell drains to, or -1 for cells that do not drain or drain off the grid.
+        
+        def calculate_receiver_indexes():
+            (rows_next, cols_next, is_good) = self.flow_to(np.arange(self._griddata.size))
+            return np.where(is_good, rows_next * self._griddata.shape[1] + cols_next, -1)
+        
+        return self._derived_array('receiver_indexes', calculate_receiver_indexes, depends_on_values = True)
+    
+    def donor_counts(self):
+        # Number of cells that drain into each cell (flat indexes, as receiver_indexes).
+        
+        def calculate_donor_counts():
+            receivers = self.receiver_indexes()
+            return np.bincount(receivers[receivers >= 0], minlength = receivers.size)
+        
+        return self._derived_array('donor_counts', calculate_donor_counts, depends_on_values = True)
+    
+    def topological_order(self):
+        # Flat indexes of the cells ordered so that every cell comes before the cell it drains to, and the offsets
+        # into that order of each level (cells in a level only receive flow from cells in earlier levels).  Built
+        # level by level from the cells with no donors.  Cells on flow loops, and cells downstream of them, are left out.
+        
+        def calculate_topological_order():
+            receivers = self.receiver_indexes()
+            donors = self.donor_counts().copy()
+            frontier = np.flatnonzero(donors == 0)
+            levels = []
+            while len(frontier) > 0:
+                levels.append(frontier)
+                next_cells = receivers[frontier]
+                (next_cells, counts) = np.unique(next_cells[next_cells >= 0], return_counts = True)
+                donors[next_cells] -= counts
+                frontier = next_cells[donors[next_cells] == 0]
+            order = np.concatenate(levels) if len(levels) > 0 else np.zeros(0, dtype = np.intp)
+            level_offsets = np.concatenate(((0,), np.cumsum([len(level) for level in levels], dtype = np.intp)))
+            order.flags.writeable = False
+            level_offsets.flags.writeable = False
+            return order, level_offsets
+        
+        return self._derived_array('topological_order', calculate_topological_order, depends_on_values = True)
+    
+    def basin_labels(self, outlets):
+        # Labels every cell with the number (1..N, in the order given) of the outlet it drains to, or 0 for cells that
+        # do not drain to any of the outlets.  Labels are pushed upstream in one pass over the topological order, so
+        # a cell takes the label of the first outlet downstream of it: nested outlets win over the outlets that
+        # contain them.  Where several outlets fall in the same cell, the first one wins.
+        
+        outlets = np.asarray(outlets, dtype = np.float64).reshape((-1, 2))
+        (rows, cols) = self._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
+        numbers = np.arange(1, len(rows)+1, dtype = np.int32)
+        inside = rows >= 0
+        
+        labels = np.zeros(self._griddata.size, dtype = np.int32)
+        labels[(rows * self._griddata.shape[1] + cols)[inside][::-1]] = numbers[inside][::-1]
+        
+        receivers = self.receiver_indexes()
+        (order, level_offsets) = self.topological_order()
+        for level in range(len(level_offsets)-2, -1, -1):
+            cells = order[level_offsets[level]:level_offsets[level+1]]
+            cells = cells[(labels[cells] == 0) & (receivers[cells] >= 0)]
+            labels[cells] = labels[receivers[cells]]
+        
+        return labels.reshape(self._griddata.shape)
+    
+    def _donors_of(self, cells):
+        # (donors, receivers): the flat indexes of every cell that drains into one of cells, and the cell it drains to.
+        
+        receivers = self.receiver_indexes()
+        (ny, nx) = self._griddata.shape
+        (rows, cols) = np.divmod(cells, nx)
+        (donors, targets) = ([], [])
+        for (di, dj, code) in self._upstream_neighbors:
+            inside = (rows + di >= 0) & (rows + di < ny) & (cols + dj >= 0) & (cols + dj < nx)
+            neighbors = (rows + di) * nx + cols + dj
+            drains = inside & (receivers[np.where(inside, neighbors, 0)] == cells)
+            donors.append(neighbors[drains])
+            targets.append(cells[drains])
+        return np.concatenate(donors), np.concatenate(targets)
+    
+    def _downstream_of(self, cells, receivers_of = None):
+        # Sorted flat indexes of the cells downstream of cells (not including them, unless they are downstream of one
+        # another), following receivers_of (a function of flat indexes; receiver_indexes by default).
+        
+        receivers_of = receivers_of if receivers_of is not None else (lambda indexes: self.receiver_indexes()[indexes])
+        seen = set()
+        frontier = np.asarray(cells, dtype = np.intp)
+        while len(frontier) > 0:
+            frontier = receivers_of(frontier)
+            frontier = np.array([cell for cell in set(frontier[frontier >= 0].tolist()) if cell not in seen], dtype = np.intp)
+            seen.update(frontier.tolist())
+        return np.array(sorted(seen), dtype = np.intp)
+    
+    def _upstream_of(self, cells):
+        # Sorted flat indexes of cells and of every cell that drains into them.
+        
+        seen = set(np.asarray(cells, dtype = np.intp).tolist())
+        frontier = np.array(sorted(seen), dtype = np.intp)
+        while len(frontier) > 0:
+            (donors, _) = self._donors_of(frontier)
+            frontier = np.array([cell for cell in donors.tolist() if cell not in seen], dtype = np.intp)
+            seen.update(frontier.tolist())
+        return np.array(sorted(seen), dtype = np.intp)
+    
+    def _accumulate_at(self, cells, values, own, step = None, maximum = False):
+        # Recomputes values (a grid, modified in place) at cells (sorted flat indexes), from upstream to downstream, as
+        # own plus the sum (or, with maximum = True, the largest) of values + step over the cells that drain into each
+        # one.  own and step are functions of flat indexes.  Values upstream of cells are taken as they are, so cells
+        # must include every cell whose upstream values change.  Cells on flow loops are left as they are.  Returns
+        # (donors, receivers, contributions) for the cells that drain into cells.
+        
+        if len(cells) == 0:
+            return np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.intp), np.zeros(0, dtype = float64)
+        (donors, targets) = self._donors_of(cells)
+        contribution_of = (lambda indexes: values.flat[indexes] + step(indexes)) if step is not None else (lambda indexes: values.flat[indexes])
+        combine = np.maximum.at if maximum else np.add.at
+        
+        target_positions = np.searchsorted(cells, targets)
+        donor_positions = np.minimum(np.searchsorted(cells, donors), len(cells) - 1)
+        within = cells[donor_positions] == donors
+        result = np.asarray(own(cells), dtype = float64).copy()
+        combine(result, target_positions[~within], contribution_of(donors[~within]))
+        
+        receiver_position = np.full(len(cells), -1, dtype = np.intp)
+        receiver_position[donor_positions[within]] = target_positions[within]
+        pending = np.bincount(target_positions[within], minlength = len(cells))
+        frontier = np.flatnonzero(pending == 0)
+        while len(frontier) > 0:
+            values.flat[cells[frontier]] = result[frontier]
+            frontier = frontier[receiver_position[frontier] >= 0]
+            combine(result, receiver_position[frontier], contribution_of(cells[frontier]))
+            (next_positions, counts) = np.unique(receiver_position[frontier], return_counts = True)
+            pending[next_positions] -= counts
+            frontier = next_positions[pending[next_positions] == 0]
+        
+        return donors, targets, contribution_of(donors)
+    
+    def update_flow_codes(self, indexes, codes, area = None, flow_length = None, chi = None, **kwargs):
+        # Sets the flow codes at indexes (raveled, or a tuple of rows and columns) and updates area, flow_length and 
+        # chi (grids made from this flow direction) for the change, without recalculating them everywhere: area and
+        # flow length are recalculated along the old and new paths downstream of the changed cells, and chi over the
+        # cells upstream of those paths.  chi requires area, theta, Ao and outlets (see Chi.update_for_flow_codes).  
+        # The cached receiver indexes and donor counts are patched rather than rebuilt.  Returns the sorted flat indexes
+        # of the cells whose upstream area changed.
+        
+        if not isinstance(indexes, tuple):
+            indexes = np.unravel_index(np.asarray(indexes, dtype = np.intp).ravel(), self._griddata.shape)
+        (rows, cols) = (np.asarray(indexes[0], dtype = np.intp).ravel(), np.asarray(indexes[1], dtype = np.intp).ravel())
+        codes = np.broadcast_to(np.asarray(codes, dtype = self._griddata.dtype), rows.shape)
+        changing = self._griddata[rows, cols] != codes
+        (rows, cols, codes) = (rows[changing], cols[changing], codes[changing])
+        cells = rows * self._griddata.shape[1] + cols
+        (cells, first) = np.unique(cells, return_index = True)
+        (rows, cols, codes) = (rows[first], cols[first], codes[first])
+        
+        receivers = self.receiver_indexes()
+        self.donor_counts()
+        old_receivers = receivers[cells].copy()
+        self._griddata[rows, cols] = codes
+        (rows_next, cols_next, is_good) = self.flow_to((rows, cols))
+        new_receivers = np.where(is_good, rows_next * self._griddata.shape[1] + cols_next, -1)
+        self._invalidate_derived_arrays(keep = ('receiver_indexes', 'donor_counts'))
+        
+        def patch_receivers(array):
+            array[cells] = new_receivers
+        
+        def patch_donor_counts(array):
+            np.subtract.at(array, old_receivers[old_receivers >= 0], 1)
+            np.add.at(array, new_receivers[new_receivers >= 0], 1)
+        
+        self._patch_derived_array('receiver_indexes', patch_receivers)
+        self._patch_derived_array('donor_counts', patch_donor_counts)
+        
+        def old_receivers_of(indexes):
+            position = np.minimum(np.searchsorted(cells, indexes), max(len(cells) - 1, 0))
+            return np.where(cells[position] == indexes, old_receivers[position], receivers[indexes]) if len(cells) > 0 else receivers[indexes]
+        
+        downstream = np.union1d(self._downstream_of(cells, old_receivers_of), self._downstream_of(cells))
+        if area is not None:
+            area.update_for_flow_codes(self, downstream)
+        if flow_length is not None:
+            flow_length.update_for_flow_codes(self, downstream)
+        if chi is not None:
+            if area is None:
+                raise Error.InputError('Area', 'is required to update chi')
+            chi.update_for_flow_codes(self, np.union1d(cells, downstream), area, kwargs['theta'], kwargs['Ao'], kwargs['outlets'])
+        return downstream
 
     def get_upstream_cell_indexes(self, i, j):
         
+        halo = self._halo_griddata()
         options = list()
         
-        if self[i, j+1] == 16:
-            options += [(i, j+1)]
-        
-        if self[i+1, j+1] == 32:
-            options += [(i+1, j+1)]
-            
-        if self[i+1, j] == 64:
-            options += [(i+1, j)]
-                    
-        if self[i+1, j-1] == 128:
-            options += [(i+1, j-1)]
-                
-        if self[i, j-1] == 1:
-            options += [(i, j-1)]
-         
-        if self[i-1, j-1] == 2:
-            options += [(i-1, j-1)]
-            
-        if self[i-1, j] == 4:
-            options += [(i-1, j)]
-            
-        if self[i-1, j+1] == 8:
-            options += [(i-1, j+1)]
+        for (di, dj, code) in self._upstream_neighbors:
+            if halo[i+di+1, j+dj+1] == code:
+                options += [(i+di, j+dj)]
 
         return options
     
     def __get_flow_from_cell(self, i, j, max_recursion_depth=None, depth=0):
         
-        i_source = [i]
-        j_source = [j]
-
-        if max_recursion_depth is not None and depth > max_recursion_depth:
-            return i_source, j_source
-
-        recursion_depth = depth + 1
-
-
-        if self[i, j+1] == 16:
-            [i_append, j_append] = self.__get_flow_from_cell(i,j+1,max_recursion_depth=max_recursion_depth,depth=recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
+        # Depth first, pre-order traversal of the cells upstream of (i, j), using an explicit stack.
         
-        if self[i+1, j+1] == 32:
-            [i_append, j_append] = self.__get_flow_from_cell(i+1,j+1,max_recursion_depth=max_recursion_depth,depth=recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
-            
-        if self[i+1, j] == 64:
-            [i_append, j_append] = self.__get_flow_from_cell(i+1,j,max_recursion_depth=max_recursion_depth,depth=recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
-        
-        if self[i+1, j-1] == 128:
-            [i_append, j_append] = self.__get_flow_from_cell(i+1,j-1,max_recursion_depth=max_recursion_depth,depth=recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
-                
-        if self[i, j-1] == 1:
-            [i_append, j_append] = self.__get_flow_from_cell(i,j-1,max_recursion_depth=max_recursion_depth,depth=recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
-         
-        if self[i-1, j-1] == 2:
-            [i_append, j_append] = self.__get_flow_from_cell(i-1,j-1,max_recursion_depth=max_recursion_depth,depth=recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
+        halo = self._halo_griddata()
+        i_source = []
+        j_source = []
+        stack = [(i, j, depth)]
+        
+        while len(stack) > 0:
+            (i, j, depth) = stack.pop()
+            i_source.append(i)
+            j_source.append(j)
             
-        if self[i-1, j] == 4:
-            [i_append, j_append] = self.__get_flow_from_cell(i-1,j,max_recursion_depth = max_recursion_depth,depth = recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
+            if max_recursion_depth is not None and depth > max_recursion_depth:
+                continue
             
-        if self[i-1, j+1] == 8:
-            [i_append, j_append] = self.__get_flow_from_cell(i-1,j+1,max_recursion_depth = max_recursion_depth,depth = recursion_depth)
-            i_source = i_source + i_append
-            j_source = j_source + j_append
+            children = [(i+di, j+dj, depth+1) for (di, dj, code) in self._upstream_neighbors if halo[i+di+1, j+dj+1] == code]
+            stack.extend(children[::-1])
                
         return i_source, j_source
 
     def __map_flow_from_cell(self, index, **kwargs):
         
+        return self.__map_flow_from_cell_with_halo(index, self._halo_griddata(), **kwargs)
+    
+    def __map_flow_from_cell_with_halo(self, index, halo, **kwargs):
+        
         (i, j) = index
 
         return_dict = dict()
@@ -1377,45 +2095,11 @@ class FlowDirectionD8(FlowDirection):
         return_dict['next'] = []
         return_dict['distance_scale'] = 1.0
         
-        if self[i, j+1] == 16:
-            return_dict['distance_scale'] = 1.0
-            child_dict = self.__map_flow_from_cell((i,j+1), **kwargs)
-            return_dict['next'].append(child_dict)
-        
-        if self[i+1, j+1] == 32:
-            return_dict['distance_scale'] = 1.4142135623730951
-            child_dict = self.__map_flow_from_cell((i+1,j+1), **kwargs)
-            return_dict['next'].append(child_dict)
-
-        if self[i+1, j] == 64:
-            return_dict['distance_scale'] = 1.0
-            child_dict = self.__map_flow_from_cell((i+1,j), **kwargs)
-            return_dict['next'].append(child_dict)
-        
-        if self[i+1, j-1] == 128:
-            return_dict['distance_scale'] = 1.4142135623730951
-            child_dict = self.__map_flow_from_cell((i+1,j-1), **kwargs)
-            return_dict['next'].append(child_dict)
-                
-        if self[i, j-1] == 1:
-            return_dict['distance_scale'] = 1.0
-            child_dict = self.__map_flow_from_cell((i,j-1), **kwargs)
-            return_dict['next'].append(child_dict)
-
-        if self[i-1, j-1] == 2:
-            return_dict['distance_scale'] = 1.4142135623730951
-            child_dict = self.__map_flow_from_cell((i-1,j-1), **kwargs)
-            return_dict['next'].append(child_dict)
-            
-        if self[i-1, j] == 4:
-            return_dict['distance_scale'] = 1.0
-            child_dict = self.__map_flow_from_cell((i-1,j), **kwargs)
-            return_dict['next'].append(child_dict)
-            
-        if self[i-1, j+1] == 8:
-            return_dict['distance_scale'] = 1.4142135623730951
-            child_dict = self.__map_flow_from_cell((i-1,j+1), **kwargs)
-            return_dict['next'].append(child_dict)
+        for (di, dj, code) in self._upstream_neighbors:
+            if halo[i+di+1, j+dj+1] == code:
+                return_dict['distance_scale'] = 1.4142135623730951 if (di != 0 and dj != 0) else 1.0
+                child_dict = self.__map_flow_from_cell_with_halo((i+di,j+dj), halo, **kwargs)
+                return_dict['next'].append(child_dict)
         
         if len(return_dict.get('next', 0)) == 0:
             return_dict.pop('next')
@@ -1427,10 +2111,12 @@ class FlowDirectionD8(FlowDirection):
         flooded_dem = args[0]
         mask = args[1]
         
+        # Grids made from this flow direction (area, flow_length, chi; see update_flow_codes) can be passed as keyword 
+        # arguments to be updated for the new codes.
+        
         indexes = np.where(mask._griddata == 1)
-        for (i,j) in zip(indexes[0],indexes[1]):
-            flow_code = self.__flow_code_for_position(flooded_dem, i, j)
-            self._griddata[i,j] = flow_code
+        codes = [self.__flow_code_for_position(flooded_dem, i, j) for (i,j) in zip(indexes[0],indexes[1])]
+        return self.update_flow_codes(indexes, np.array(codes, dtype = self._griddata.dtype), **kwargs)
     
     def divides_for_outlets(self, outlet1, outlet2):
         basin1 = BaseSpatialGrid()
@@ -1497,20 +2183,142 @@ class FlowDirectionD8(FlowDirection):
         ((i, j),) = self._xy_to_rowscols(v)
         return self.get_indexes_of_upstream_cells(i, j)
 
+    def search_down_flow_direction_batch(self, starts, search_length = np.inf, return_rowscols = False):
+        
+        # Traces the downstream path from every (x, y) start point together.  All active paths take one step per
+        # iteration through the D8 lookup tables.  The first path to reach a cell claims it in a grid-sized owner
+        # map, which doubles as the visited bitmap for loop detection.  A path that reaches a cell claimed by another
+        # path stops there and shares the stored remainder of that path.  As in search_down_flow_direction_with_length,
+        # paths stop before the grid edge, before revisiting a cell, once the length reaches search_length, and
+        # after a cell that does not drain.  Returns a list with one (xs, ys, lengths) tuple of arrays per start
+        # point, or (rows, cols, lengths) if return_rowscols is True.
+        
+        (ny, nx) = self._griddata.shape
+        dx = self._georef_info.dx
+        starts = np.asarray(starts, dtype = np.float64).reshape((-1, 2))
+        (rows, cols) = self._xy_to_rowscols_array(starts[:,0], starts[:,1])
+        n = len(rows)
+        
+        owner = np.full(ny*nx, -1, dtype = np.intp)
+        position = np.zeros(ny*nx, dtype = np.intp)
+        claimed_length = np.zeros(ny*nx, dtype = np.float64)
+        
+        cell = np.where(rows >= 0, rows * nx + cols, -1)
+        length = np.zeros(n, dtype = np.float64)
+        count = np.zeros(n, dtype = np.intp)
+        limit = np.full(n, float(search_length), dtype = np.float64)
+        stopped_by_length = np.zeros(n, dtype = bool)
+        join_path = np.full(n, -1, dtype = np.intp)
+        join_position = np.zeros(n, dtype = np.intp)
+        join_offset = np.zeros(n, dtype = np.float64)
+        
+        step_path, step_position, step_cell, step_length = [], [], [], []
+        
+        active = np.flatnonzero(cell >= 0)
+        while len(active) > 0:
+            c = cell[active]
+            L = length[active]
+            (r, q) = np.divmod(c, nx)
+            at_edge = (r == 0) | (r == ny-1) | (q == 0) | (q == nx-1)
+            over = ~at_edge & (L >= limit[active])
+            stopped_by_length[active[over]] = True
+            o = owner[c]
+            
+            # The first path to arrive at each unclaimed cell claims it; any others arriving together join it:
+            
+            free = np.flatnonzero(~at_edge & ~over & (o < 0))
+            (_, first) = np.unique(c[free], return_index = True)
+            claim = free[first]
+            owner[c[claim]] = active[claim]
+            position[c[claim]] = count[active[claim]]
+            claimed_length[c[claim]] = L[claim]
+            
+            step_path.append(active[claim])
+            step_position.append(count[active[claim]])
+            step_cell.append(c[claim])
+            step_length.append(L[claim])
+            count[active[claim]] += 1
+            
+            # A path reaching one of its own cells has closed a loop.  It is recorded as joining itself there, so
+            # that paths joining it inside the loop pick up the rest of the loop when they are assembled:
+            
+            joined = ~at_edge & ~over
+            joined[claim] = False
+            joined = np.flatnonzero(joined)
+            k = active[joined]
+            join_path[k] = owner[c[joined]]
+            join_position[k] = position[c[joined]]
+            join_offset[k] = L[joined] - claimed_length[c[joined]]
+            
+            # A joining path may need more of the shared path than search_length allowed its owner to trace.  Raise
+            # the limits down the chain of joins, resuming any path that stopped on its limit:
+            
+            resumed = []
+            if np.isfinite(search_length):
+                for path in k:
+                    need = limit[path] - join_offset[path]
+                    target = join_path[path]
+                    seen = set((path,))
+                    while target >= 0 and target not in seen and need > limit[target]:
+                        seen.add(target)
+                        limit[target] = need
+                        if stopped_by_length[target]:
+                            stopped_by_length[target] = False
+                            resumed.append(target)
+                            break
+                        need -= join_offset[target]
+                        target = join_path[target]
+            
+            (rows_next, cols_next, is_good) = self.flow_to((r[claim], q[claim]))
+            moving = active[claim]
+            cell[moving] = np.where(is_good, rows_next * nx + cols_next, -1)
+            length[moving] = L[claim] + dx * self._flow_length[np.asarray(self._griddata.flat[c[claim]], dtype = np.uint8)]
+            active = np.concatenate((moving[is_good], np.array(resumed, dtype = np.intp)))
+        
+        step_path = np.concatenate(step_path) if len(step_path) > 0 else np.zeros(0, dtype = np.intp)
+        step_position = np.concatenate(step_position) if len(step_position) > 0 else np.zeros(0, dtype = np.intp)
+        step_cell = np.concatenate(step_cell) if len(step_cell) > 0 else np.zeros(0, dtype = np.intp)
+        step_length = np.concatenate(step_length) if len(step_length) > 0 else np.zeros(0, dtype = np.float64)
+        order = np.lexsort((step_position, step_path))
+        step_cell = step_cell[order]
+        step_length = step_length[order]
+        first_step = np.concatenate(((0,), np.cumsum(count)))
+        
+        # Assemble each path from its own steps followed by the shared remainders of the paths it joined:
+        
+        paths = []
+        for path in range(n):
+            cells = []
+            lengths = []
+            seen = dict()
+            (target, start, offset) = (path, 0, 0.0)
+            while target >= 0:
+                end = count[target]
+                if target in seen:
+                    end = seen[target]
+                seen.setdefault(target, start)
+                segment_length = step_length[first_step[target]+start:first_step[target]+max(start, end)] + offset
+                cut = np.searchsorted(segment_length >= search_length, True)
+                cells.append(step_cell[first_step[target]+start:first_step[target]+start+cut])
+                lengths.append(segment_length[:cut])
+                if cut < len(segment_length) or end < count[target]:
+                    break
+                (target, start, offset) = (join_path[target], join_position[target], offset + join_offset[target])
+            cells = np.concatenate(cells)
+            lengths = np.concatenate(lengths)
+            (path_rows, path_cols) = np.divmod(cells, nx)
+            if return_rowscols:
+                paths.append((path_rows, path_cols, lengths))
+            else:
+                (xs, ys) = self._rowscols_to_xy_array(path_rows, path_cols)
+                paths.append((xs, ys, lengths))
+        
+        return paths
+
     def search_down_flow_direction_with_length(self, start, search_length = np.inf):
-        l = list()
-        length_list = list()
-        ((row,col),) = self._xy_to_rowscols((start,))
-        length = 0.0
-        while not (row == 0 or row == self._georef_info.ny-1 or col == 0 or col == self._georef_info.nx - 1 or \
-                   (row,col) in l) and (length < search_length):
-            l.append((row, col))
-            length_list.append(length)
-            row,col,inBounds = self.get_flow_to_cell(row, col)
-            length += self._georef_info.dx * (1.0 if (row == col) else 1.414)
-            if not inBounds:
-                break
-        return tuple(l), tuple(length_list)
+        
+        ((rows, cols, lengths),) = self.search_down_flow_direction_batch((start,), search_length = search_length, return_rowscols = True)
+        return tuple(zip(rows.tolist(), cols.tolist())), tuple(lengths.tolist())
 
     def search_down_flow_direction(self, start, search_length = np.inf):
         return self.search_down_flow_direction_with_length(start, search_length=search_length)[0]
@@ -1542,9 +2350,12 @@ class FlowDirectionD8(FlowDirection):
     
     def pixel_scale(self, dtype = np.float32):
         
-        dim = np.ones_like(self._griddata, dtype = dtype)
-        dim[np.where((self._griddata == 32) | (self._griddata == 128) | (self._griddata == 2) | (self._griddata == 8))] = 1.41421356
-        return dim
+        def calculate_pixel_scale():
+            lookup = np.ones(256, dtype = dtype)
+            lookup[[2, 8, 32, 128]] = 1.41421356
+            return lookup[np.asarray(self._griddata, dtype = np.uint8)]
+        
+        return self._derived_array('pixel_scale_' + np.dtype(dtype).name, calculate_pixel_scale, depends_on_values = True)
     
     def map_values_to_recursive_list(self, outlet, **kwargs):
         
@@ -1587,32 +2398,124 @@ class FlowDirectionD8(FlowDirection):
         divides._griddata[1:-2,1:-2] = ((ijm1 != 1) & (im1jm1 != 2) & (im1j != 4) & (im1jp1 != 8) & (ijp1 != 16) & (ip1jp1 != 32) & (ip1j != 64) & (ip1jm1 != 128))
         return divides
     
-    def paired_divides(self, mask = None):
+    def paired_divide_indexes(self, mask = None):
+        
+        # Returns arrays (rows, cols, paired_rows, paired_cols) of divide cells and the cell directly across the divide from
+        # each of them (opposite to the direction the divide cell drains).
         
         divides = self.divides()
         if mask is not None:
-            i = np.where((divides._griddata == 1) & (mask._griddata > 0))
+            (i, j) = np.where((divides._griddata == 1) & (mask._griddata > 0))
         else:
-            i = np.where(divides._griddata == 1)
-
-        rcs = zip(i[0].tolist(),i[1].tolist())
+            (i, j) = np.where(divides._griddata == 1)
         
-        pairs = list()
-        for (i,j) in rcs:
-            
-            (i_next, j_next, good) = self.get_flow_to_cell(i,j)
-            
-            if good and i_next is not None and j_next is not None:
-                i_next = 2*i - i_next
-                j_next = 2*j - j_next
-                
-                if i_next >= 0 and i_next < self._georef_info.ny and j_next >= 0 and j_next < self._georef_info.nx:
-                    (xy, ) = self._rowscols_to_xy(((i,j),))
-                    (xy_next, ) = self._rowscols_to_xy(((i_next, j_next),))
-                    pairs.append( (xy, xy_next))
+        (i_next, j_next, good) = self.flow_to((i, j))
+        i_pair = 2*i - i_next
+        j_pair = 2*j - j_next
+        
+        valid = good & (i_pair >= 0) & (i_pair < self._georef_info.ny) & (j_pair >= 0) & (j_pair < self._georef_info.nx)
+        return i[valid], j[valid], i_pair[valid], j_pair[valid]
+    
+    def paired_divides(self, mask = None):
+        
+        (i, j, i_pair, j_pair) = self.paired_divide_indexes(mask = mask)
+        (x, y) = self._rowscols_to_xy_array(i, j)
+        (x_pair, y_pair) = self._rowscols_to_xy_array(i_pair, j_pair)
                 
-        return tuple(pairs)
+        return tuple(zip(zip(x.tolist(), y.tolist()), zip(x_pair.tolist(), y_pair.tolist())))
                 
+class _SteepestDescentWalker(object):
+    
+    # Walks from a cell to its lowest neighbor that the walk has not visited yet, until it reaches a cell next to nodata
+    # or the edge of the grid, or a cell whose neighbors have all been visited.  The neighbors of every cell are sorted
+    # by elevation once up front, and visited cells are marked with the walk number in a stamp array that is reused
+    # from one walk to the next.
+    
+    adjust = ((-1, -1), (0, -1), (1,-1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+    
+    def __init__(self, elevation, neighbor_order, stops, area_per_pixel = None, maximum_pit_depth = None):
+        nx = elevation.shape[1]
+        self._elevation = np.ravel(elevation)
+        self._offsets = [di * nx + dj for (di, dj) in self.adjust]
+        # Plain Python sequences index much faster than numpy arrays one element at a time:
+        self._neighbor_order = neighbor_order.tobytes()
+        self._stops = stops.tobytes()
+        self._area_per_pixel = np.ravel(area_per_pixel) if area_per_pixel is not None else None
+        self._maximum_pit_depth = maximum_pit_depth
+        self._stamps = None
+        self._walk_number = 0
+    
+    def walk(self, start):
+        # Returns the flat indexes of the cells visited, starting with start.
+        
+        if self._stamps is None or self._walk_number == np.iinfo(np.int32).max:
+            import array
+            self._stamps = array.array('i', bytes(4 * self._elevation.size))
+            self._walk_number = 0
+        self._walk_number += 1
+        
+        (stamps, number) = (self._stamps, self._walk_number)
+        (elevation, offsets, neighbor_order, stops) = (self._elevation, self._offsets, self._neighbor_order, self._stops)
+        maximum_pit_depth = self._maximum_pit_depth
+        
+        cell = int(start)
+        stamps[cell] = number
+        path = [cell]
+        while not stops[cell]:
+            moved = False
+            for k in neighbor_order[8*cell:8*cell+8]:
+                next_cell = cell + offsets[k]
+                if maximum_pit_depth is not None and not (elevation[next_cell] - elevation[cell] <= maximum_pit_depth):
+                    break
+                if stamps[next_cell] != number:
+                    stamps[next_cell] = number
+                    cell = next_cell
+                    path.append(cell)
+                    moved = True
+                    break
+            if not moved:
+                break
+        
+        return path
+    
+    def accumulate(self, starts, terminations_only = False):
+        # Walks from each start, adding up the pixel area of every cell passed through (the last cell only counts if the
+        # walk stopped because it ran out of unvisited neighbors).  Returns the cells and values that writing the
+        # cumulative areas of each walk into a grid, one walk after another, would leave behind.
+        
+        cells = []
+        values = []
+        for start in starts:
+            path = self.walk(start)
+            if self._stops[path[-1]]:
+                contributing = path[:-1]
+            else:
+                contributing = path
+            areas = np.cumsum(self._area_per_pixel[contributing])
+            if terminations_only:
+                cells.append([path[-1]])
+                values.append([areas[-1] if len(areas) > 0 else 0.0])
+            else:
+                cells.append(contributing)
+                values.append(areas)
+        
+        if len(cells) == 0:
+            return np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.float64)
+        cells = np.concatenate(cells).astype(np.intp)[::-1]
+        values = np.concatenate(values).astype(np.float64)[::-1]
+        (cells, last) = np.unique(cells, return_index = True)
+        return cells, values[last]
+
+_walker = None
+
+def _init_walker_worker(walker):
+    global _walker
+    _walker = walker
+
+def _accumulate_walks(task):
+    (starts, terminations_only) = task
+    return _walker.accumulate(starts, terminations_only)
+
 class Elevation(CalculationMixin, BaseSpatialGrid):
 
     def findDEMedge(self):
@@ -1646,44 +2549,44 @@ class Elevation(CalculationMixin, BaseSpatialGrid):
         mask3._griddata = morph.binary_erosion(mask3._griddata, iterations = 3).astype(uint8)
         mask3._griddata = (mask3._griddata.astype(float) + mask2._griddata.astype(float)).astype(uint8)
         i = np.where(mask3._griddata == 1)
-        rc = zip(i[0].tolist(),i[1].tolist())
-        return self._rowscols_to_xy(rc)
+        xs, ys = self._rowscols_to_xy_array(i[0], i[1])
+        return tuple(zip(xs.tolist(), ys.tolist()))
+    
+    def _descent_neighbor_order(self):
+        # For each cell, the indexes into _SteepestDescentWalker.adjust of its neighbors sorted by elevation (stable, so
+        # ties keep the adjust order), and whether the cell has a nodata neighbor or lies on the edge of the grid.
+        
+        def calculate_descent_neighbor_order():
+            halo = self._halo_griddata().astype(np.float64)
+            (ny, nx) = self._griddata.shape
+            neighbor_order = np.zeros((ny*nx, 8), dtype = np.uint8)
+            stops = np.zeros(ny*nx, dtype = bool)
+            rows_per_chunk = max(1, 2**20 // nx)
+            for start in range(0, ny, rows_per_chunk):
+                end = min(start + rows_per_chunk, ny)
+                neighbors = np.stack([halo[start+1+di:end+1+di, 1+dj:nx+1+dj] for (di, dj) in _SteepestDescentWalker.adjust], axis = -1).reshape((-1, 8))
+                neighbor_order[start*nx:end*nx] = np.argsort(neighbors, axis = 1, kind = 'stable')
+                stops[start*nx:end*nx] = np.any(np.isnan(neighbors), axis = 1)
+            neighbor_order.flags.writeable = False
+            stops.flags.writeable = False
+            return neighbor_order, stops
+        
+        return self._derived_array('descent_neighbor_order', calculate_descent_neighbor_order, depends_on_values = True)
+    
+    def _steepest_descent_walker(self, area_per_pixel = None, maximum_pit_depth = None):
+        (neighbor_order, stops) = self._descent_neighbor_order()
+        return _SteepestDescentWalker(self._griddata, neighbor_order, stops, area_per_pixel = area_per_pixel, maximum_pit_depth = maximum_pit_depth)
     
     def track_flow_downhill(self, starting_point, maximum_pit_depth = 20):
         
-        adjust = [(-1, -1), (0, -1), (1,-1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
-        
-        (ij, ) = self._xy_to_rowscols((starting_point,))
-        visited = (ij, )
-        ij_a = [(ij[0] + x[0], ij[1] + x[1]) for x in adjust]
-        e_a = np.array([self[i[0], i[1]] for i in ij_a])
-        new = True
-        while None not in e_a and np.sum(np.isnan(e_a)) == 0 and new:
-            sls = np.argsort(e_a)
-            new = False
-            for sl in sls:
-                this_ij = (ij[0] + adjust[sl][0], ij[1] + adjust[sl][1])
-                if (this_ij not in visited) and ( (e_a[sl] - self[ij[0], ij[1]]) <= maximum_pit_depth):
-                    visited += (this_ij, )
-                    ij = this_ij
-                    new = True
-                    break
-            if new:
-                ij_a = [(ij[0] + x[0], ij[1] + x[1]) for x in adjust]
-                e_a = np.array([self[i[0], i[1]] for i in ij_a]) 
-        xy = self._rowscols_to_xy(visited)
-        this_xy = xy[0]
-        l = tuple()
-        e = tuple()
-        last_l = 0
-        for txy in xy:
-            (ij, ) = self._xy_to_rowscols((txy,))
-            e += (self[ij[0], ij[1]], )
-            this_dl = np.sqrt(np.power(txy[0] - this_xy[0], 2) + np.power(txy[1] - this_xy[1], 2))
-            last_l = last_l + this_dl
-            l += (last_l, )
-            this_xy = txy
-        return xy, l, e
+        ((i, j), ) = self._xy_to_rowscols((starting_point,))
+        walker = self._steepest_descent_walker(maximum_pit_depth = maximum_pit_depth)
+        (rows, cols) = np.divmod(np.array(walker.walk(i * self._georef_info.nx + j)), self._georef_info.nx)
+        (xs, ys) = self._rowscols_to_xy_array(rows, cols)
+        xy = tuple(zip(xs.tolist(), ys.tolist()))
+        l = np.concatenate(([0.0], np.cumsum(np.sqrt(np.power(np.diff(xs), 2) + np.power(np.diff(ys), 2)))))
+        e = self._griddata[rows, cols]
+        return xy, tuple(l.tolist()), tuple(e.tolist())
 
 class Gradient(BaseSpatialGrid):
     
@@ -1695,14 +2598,13 @@ class Gradient(BaseSpatialGrid):
     def _create_from_elevation(self, *args, **kwargs):
         elevation = kwargs['elevation']
         self._copy_info_from_grid(elevation,True)
-        dx = elevation._georef_info.dx
-        [self._gy, self._gx] = np.gradient(elevation._griddata,dx)
+        derivatives = _terrain_derivatives(elevation._griddata, elevation._georef_info.dx, ('fx', 'fy'), dtype = self._product_dtype())
+        (self._gy, self._gx) = (derivatives['fy'], derivatives['fx'])
     
     def average_gradient(self, distance):
         outgrid = Gradient()
         outgrid._copy_info_from_grid(self, True)
-        outgrid._gy = self.average_over_distance(distance, grid = self._gy)
-        outgrid._gx = self.average_over_distance(distance, grid = self._gx)
+        (outgrid._gy, outgrid._gx) = self.average_grids_over_distance(distance, (self._gy, self._gx))
         return outgrid
     
     def save(self, filename):    
@@ -1755,9 +2657,9 @@ class Gradient(BaseSpatialGrid):
             direction = (direction > 90)*(direction - 180) + (direction < -90)*(direction + 180) + ((direction <= 90) & (direction >= -90))*direction
             kwargs.pop('reflect')
         plt.figure()
-        plt.imshow(mag, extent = extent, **kwargs)
+        _OverviewImage(_OverviewPyramid(mag), extent, **kwargs)
         plt.figure()
-        plt.imshow(direction, extent = extent, **kwargs)
+        _OverviewImage(_OverviewPyramid(direction, method = 'decimate'), extent, **kwargs)
         if interactive:
             plt.ion()
             plt.show(block=False)
@@ -1855,9 +2757,9 @@ class ScarpWavelet(BaseSpatialGrid):
         vmax = kwargs.pop('vmax', 90)
         title = kwargs.pop('title', '')
 
+        from matplotlib import cm
         if hillshade is not None:
-            from matplotlib import cm
-            plt.imshow(hillshade._griddata, extent = extent, cmap = cm.gray, **kwargs)
+            _OverviewImage(_OverviewPyramid(hillshade._griddata), extent, cmap = cm.gray, **kwargs)
         self._adjusted_orientations = adjusted_orientations._griddata
         
         from matplotlib import colors
@@ -1866,7 +2768,7 @@ class ScarpWavelet(BaseSpatialGrid):
         adjusted_orientations_rgba = cm.ScalarMappable(cmap = cmap, norm = norm).to_rgba(adjusted_orientations._griddata)
         norm = colors.LogNorm()
         adjusted_orientations_rgba[:,:,3] = (~normalized_data.mask).astype(float)*norm(self._SNR)
-        plt.imshow(adjusted_orientations_rgba, extent = extent, **kwargs)
+        _OverviewImage(_OverviewPyramid(adjusted_orientations_rgba, method = 'decimate'), extent, **kwargs)
         plt.title(title)
         if interactive:
             plt.ion()
@@ -1880,21 +2782,43 @@ class ScarpWavelet(BaseSpatialGrid):
                                      window_size,
                                      age,
                                      num=46, 
-                                     discard_max_min=True):
+                                     discard_max_min=True,
+                                     threads=1):
+        # Orientations are run one at a time unless threads > 1 is passed, in which case they are run in a thread pool.
+        # Each count grid is folded into the running max and min as soon as it is done.  The transform of the valid mask
+        # is computed once per call; each template transform is made and dropped by the orientation that uses it, so at
+        # most threads of them exist at a time.
         data = self.valid_data()
         max = -np.inf * np.ones_like(data)
         min = np.inf * np.ones_like(data)
+        mask_transform = self._mask_transform(data)
 
-        orientations = np.linspace(-np.pi / 2, np.pi / 2, num=num)
-        for orientation in orientations:
+        def take_orientation(this, orientation):
             # XXX: This uses orientation to conform to N-E coordinates
             # i.e. N = 0, E = -90, W = +90
-            this = self._convolve_mask(data, window_size, age, orientation)
-            mask = (this != this.max()) * (max < orientation)
+            partial = this != this.max()
+            mask = partial * (max < orientation)
             max[mask] = orientation
-            mask = (this != this.max()) * (min > orientation)
+            mask = partial * (min > orientation)
             min[mask] = orientation
 
+        orientations = np.linspace(-np.pi / 2, np.pi / 2, num=num)
+        if threads is not None and threads > 1 and len(orientations) > 1:
+            from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+            pending = dict()
+            with ThreadPoolExecutor(max_workers = threads) as executor:
+                for orientation in orientations:
+                    if len(pending) >= threads:
+                        (done, _) = wait(pending, return_when = FIRST_COMPLETED)
+                        for future in done:
+                            take_orientation(future.result(), pending.pop(future))
+                    pending[executor.submit(self._convolve_mask, data, window_size, age, orientation, mask_transform)] = orientation
+                for future in wait(pending).done:
+                    take_orientation(future.result(), pending[future])
+        else:
+            for orientation in orientations:
+                take_orientation(self._convolve_mask(data, window_size, age, orientation, mask_transform), orientation)
+
         max[np.isinf(max)] = np.nan
         min[np.isinf(min)] = np.nan
         max[np.isnan(data)] = np.nan
@@ -1915,19 +2839,27 @@ class ScarpWavelet(BaseSpatialGrid):
 
         return max, min
 
-    def _convolve_mask(self, data, window_size, age, orientation):
+    def _convolve_mask(self, data, window_size, age, orientation, mask_transform=None):
         """
         Returns the number of valid pixels in specified window at each pixel
         """
-        from numpy.fft import fft2, ifft2, fftshift
-        mask = ~np.isnan(data)
-        window = self.template_window(window_size,
-                                      age,
-                                      orientation,
-                                      use_pixels=True)
-        count = np.round(np.real(fftshift(ifft2(fft2(window) * fft2(mask)))))
+        from scipy.fft import irfft2
+        from numpy.fft import fftshift
+        if mask_transform is None:
+            mask_transform = self._mask_transform(data)
+        window_transform = self._template_transform(window_size, age, orientation)
+        count = np.round(fftshift(irfft2(window_transform * mask_transform, s = data.shape)))
         return count
 
+    def _mask_transform(self, data):
+        from scipy.fft import rfft2
+        return rfft2((~np.isnan(data)).astype(float64))
+
+    def _template_transform(self, window_size, age, orientation):
+        # Real FFT of the pixel template window.  These are grid-sized, so they are not kept on the grid.
+        from scipy.fft import rfft2
+        return rfft2(np.asarray(self.template_window(window_size, age, orientation, use_pixels=True), dtype = float64))
+
     def template_window(self, window_size, age, orientation, use_pixels=False):
         nx = self._georef_info.nx
         ny = self._georef_info.ny
@@ -1955,21 +2887,91 @@ class LocalRelief(BaseSpatialGrid):
     required_inputs_and_actions = ((('nx', 'ny', 'projection', 'geo_transform',),'_create'),
                            (('ai_ascii_filename','EPSGprojectionCode'),'_read_ai'),
                            (('gdal_filename',), '_read_gdal'), 
-                           (('elevation','pixel_radius'), '_create_from_elevation_and_radius'))
+                           (('elevation','pixel_radius'), '_create_from_elevation_and_radius'),
+                           (('elevation','pixel_radii'), '_create_from_elevation_and_radii'))
     
     def _create_from_elevation_and_radius(self, *args, **kwargs):
+        kwargs['pixel_radii'] = (kwargs.pop('pixel_radius'), )
+        self._create_from_elevation_and_radii(*args, **kwargs)
+    
+    def _create_from_elevation_and_radii(self, *args, **kwargs):
+        # The relief for each radius is kept as a layer of _relief, in the order the radii are given; _griddata holds
+        # the relief for the last radius.
         elevation = kwargs['elevation']
-        pixel_radius = kwargs['pixel_radius']
         self._copy_info_from_grid(elevation,True)
-        
-        import scipy.ndimage.filters as filters
-        y,x = np.ogrid[-pixel_radius:pixel_radius, -pixel_radius:pixel_radius]
-        footprint = x*x + y*y <= pixel_radius*pixel_radius
-        maximum = np.zeros_like(elevation._griddata)
-        minimum = np.zeros_like(elevation._griddata)
-        filters.maximum_filter(elevation._griddata, footprint = footprint, output = maximum)
-        filters.minimum_filter(elevation._griddata, footprint = footprint, output = minimum)
-        self._griddata = maximum - minimum
+        self._pixel_radii = tuple(int(pixel_radius) for pixel_radius in kwargs['pixel_radii'])
+        if len(self._pixel_radii) == 0 or min(self._pixel_radii) < 1:
+            raise Error.InputError('pixel_radius', 'Pixel radii must be at least 1')
+        self._relief = self.__relief_for_radii(elevation._griddata, self._pixel_radii, kwargs.get('maximum_chunk_bytes', 2**28), self._product_dtype())
+        self._griddata = self._relief[-1]
+    
+    def relief_for_radius(self, pixel_radius):
+        relief = LocalRelief()
+        relief._copy_info_from_grid(self, True)
+        relief._pixel_radii = (pixel_radius, )
+        relief._relief = self._relief[self._pixel_radii.index(pixel_radius)][np.newaxis].copy()
+        relief._griddata = relief._relief[0]
+        return relief
+    
+    def __relief_for_radii(self, grid, pixel_radii, maximum_chunk_bytes, dtype = float64):
+        
+        # The footprint for radius r covers row and column offsets from -r to r-1 with dy*dy + dx*dx <= r*r (the
+        # original ogrid footprint).  Each of its rows is a run of columns, so the maximum and minimum over the disk are
+        # taken over 1-D running maxima and minima of the rows, which cost the same for any run length.  Runs shared by
+        # several radii are filtered once per chunk of rows.  The grid is padded by reflection, as the 2-D filters did.
+        # NaNs are left out of the maximum and minimum (as -inf and +inf), and the relief is NaN wherever the footprint
+        # covers a NaN, found by running the same row runs over a grid that marks the NaNs.
+        
+        import math
+        from scipy.ndimage import maximum_filter1d, minimum_filter1d
+        
+        largest_radius = max(pixel_radii)
+        (ny, nx) = grid.shape
+        padded = np.pad(np.asarray(grid, dtype = dtype), largest_radius, mode = 'symmetric')
+        padded_nan = np.isnan(padded)
+        has_nan = bool(padded_nan.any())
+        if has_nan:
+            padded_nan = padded_nan.view(np.uint8)
+            padded_for_maximum = np.where(padded_nan, -np.inf, padded)
+            padded_for_minimum = np.where(padded_nan, np.inf, padded)
+        else:
+            padded_for_maximum = padded_for_minimum = padded
+        
+        runs = dict()
+        for (layer, radius) in enumerate(pixel_radii):
+            for dy in range(-radius, radius):
+                half_width = math.isqrt(radius*radius - dy*dy)
+                runs.setdefault((-half_width, min(radius-1, half_width)), []).append((layer, dy))
+        
+        relief = np.empty((len(pixel_radii), ny, nx), dtype = dtype)
+        row_bytes = np.dtype(dtype).itemsize * (2 * len(pixel_radii) * nx + 2 * (nx + 2*largest_radius)) + has_nan * (len(pixel_radii) * nx + nx + 2*largest_radius)
+        rows_per_chunk = max(1, maximum_chunk_bytes // row_bytes - 2*largest_radius)
+        
+        for start in range(0, ny, rows_per_chunk):
+            end = min(start + rows_per_chunk, ny)
+            rows = slice(start, end+2*largest_radius)
+            maximum = np.full((len(pixel_radii), end-start, nx), -np.inf)
+            minimum = np.full((len(pixel_radii), end-start, nx), np.inf)
+            if has_nan:
+                covers_nan = np.zeros((len(pixel_radii), end-start, nx), dtype = np.uint8)
+            for ((first, last), uses) in runs.items():
+                length = last - first + 1
+                column = largest_radius + first + length // 2
+                run_maximum = maximum_filter1d(padded_for_maximum[rows], length, axis = 1)[:, column:column+nx]
+                run_minimum = minimum_filter1d(padded_for_minimum[rows], length, axis = 1)[:, column:column+nx]
+                if has_nan:
+                    run_nan = maximum_filter1d(padded_nan[rows], length, axis = 1)[:, column:column+nx]
+                for (layer, dy) in uses:
+                    row = largest_radius + dy
+                    np.maximum(maximum[layer], run_maximum[row:row+end-start], out = maximum[layer])
+                    np.minimum(minimum[layer], run_minimum[row:row+end-start], out = minimum[layer])
+                    if has_nan:
+                        np.maximum(covers_nan[layer], run_nan[row:row+end-start], out = covers_nan[layer])
+            relief[:, start:end] = maximum - minimum
+            if has_nan:
+                relief[:, start:end][covers_nan != 0] = np.nan
+        
+        return relief
         
 class Mask(BaseSpatialGrid):
     
@@ -1984,10 +2986,7 @@ class Mask(BaseSpatialGrid):
         flow_direction = kwargs['flow_direction']
         outlets = kwargs['outlets']
         self._copy_info_from_grid(flow_direction, True)
-        for (outlet_x, outlet_y) in outlets:
-            indexes = flow_direction.get_indexes_of_upstream_cells_for_location(outlet_x, outlet_y)
-            for index in indexes:
-                self[index[0],index[1]] = 1
+        self._griddata = (flow_direction.basin_labels(outlets) > 0).astype(self.dtype)
 
     def perform_opening(self, structure = None, iterations = 1):
         from scipy.ndimage.morphology import binary_opening
@@ -2035,13 +3034,12 @@ class Hillshade(CalculationMixin, BaseSpatialGrid):
     
         # Convert angular measurements to radians
                 
-        azRad, elevRad = (360 - az + 90)*np.pi/180, (90-elev)*np.pi/180
-        Sx, Sy = self._calcFiniteSlopes(self._griddata, self._mean_pixel_dimension(), self._georef_info.nx, self._georef_info.ny)  # Calculate slope in X and Y directions
-    
-        AspectRad = np.arctan2(Sy, Sx) # Angle of aspect
-        SmagRad = np.arctan(np.sqrt(Sx**2 + Sy**2))  # magnitude of slope in radians
-    
-        self._griddata = 255.0 * ((np.cos(elevRad) * np.cos(SmagRad)) + (np.sin(elevRad)* np.sin(SmagRad) * np.cos(azRad - AspectRad)))
+        # az may also be a sequence of azimuths, for a multidirectional hillshade (the mean of their hillshades).
+        
+        if np.ndim(az) == 0:
+            self._griddata = _terrain_derivatives(self._griddata, self._mean_pixel_dimension_compact(), ('hillshade',), azimuth = az, inclination = elev, dtype = self._product_dtype())['hillshade']
+        else:
+            self._griddata = _terrain_derivatives(self._griddata, self._mean_pixel_dimension_compact(), ('multidirectional_hillshade',), azimuths = az, inclination = elev, dtype = self._product_dtype())['multidirectional_hillshade']
 
 class GeographicHillshade(GeographicGridMixin, Hillshade):
     pass
@@ -2064,8 +3062,7 @@ class MaxSlope(CalculationMixin, BaseSpatialGrid):
     
     def calcSlope(self):
  
-        Sx, Sy = self._calcFiniteSlopes(self._griddata, self._mean_pixel_dimension(), self._georef_info.nx, self._georef_info.ny)  # Calculate slope in X and Y directions    
-        self._griddata = np.sqrt(Sx**2 + Sy**2)
+        self._griddata = _terrain_derivatives(self._griddata, self._mean_pixel_dimension_compact(), ('slope',), dtype = self._product_dtype())['slope']
         
 class GeographicMaxSlope(GeographicGridMixin, MaxSlope):
     
@@ -2082,11 +3079,10 @@ class Laplacian(CalculationMixin, BaseSpatialGrid):
     
     def _create_from_elevation(self, *args, **kwargs):
 
-        from scipy.ndimage import laplace
         elevation = kwargs['elevation']
         
         self._copy_info_from_grid(elevation)
-        self._griddata = laplace(elevation._griddata) / np.power(elevation._georef_info.dx,2)
+        self._griddata = _terrain_derivatives(elevation._griddata, elevation._georef_info.dx, ('laplacian',), dtype = self._product_dtype())['laplacian']
     
 
 class GeographicLaplacian(GeographicGridMixin, Laplacian):
@@ -2131,7 +3127,7 @@ class PriorityQueueMixIn(object):
         mask = args[0]
         outlets = args[1]
         
-        self.__flood(mask = mask, outlets = outlets, randomize = True)
+        self._flood(mask = mask, outlets = outlets, randomize = True)
         
     def _flood(self, *args, **kwargs):
         # dem is a numpy array of elevations to be flooded, aggInc is the minimum amount to increment elevations by moving upstream
@@ -2149,10 +3145,11 @@ class PriorityQueueMixIn(object):
         if kwargs.get('mask') is not None:
             closed = (kwargs.get('mask')._griddata != 1).astype(int)
         if kwargs.get('outlets') is not None:
-            v = self._xy_to_rowscols(kwargs.get('outlets'))
+            outlets = np.array(list(kwargs.get('outlets')), dtype = float64).reshape((-1, 2))
+            edgeRows, edgeCols = self._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
             #using_mask = True
-            edgeRows = [a[0] for a in v]
-            edgeCols = [a[1] for a in v]
+            edgeRows = edgeRows[edgeRows >= 0]
+            edgeCols = edgeCols[edgeCols >= 0]
         if kwargs.get('randomize') is True:
             self._randomize_grid_values(mask = kwargs['mask'])
         if kwargs.get('outlets') is None:
@@ -2220,6 +3217,7 @@ class PriorityQueueMixIn(object):
             self._griddata = visited
         if kwargs.get('clip_to_fill') is True:
             self._griddata[visited == 0] = np.NAN
+        self._invalidate_derived_arrays()
             
         
             
@@ -2239,9 +3237,9 @@ class PriorityFillGrid(PriorityQueueMixIn, BaseSpatialGrid):
         kwargs['randomize'] = False
         kwargs['binary_result'] = True
         self._copy_info_from_grid(mask,True)
-        rcs = self._xy_to_rowscols(outlets)
-        for rc in rcs:
-            self._griddata[rc[0],rc[1]] = 100
+        outlets = np.array(list(outlets), dtype = float64).reshape((-1, 2))
+        rows, cols = self._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
+        self._griddata[rows[rows >= 0], cols[cols >= 0]] = 100
         i = np.where(np.isnan(mask._griddata))
         self._griddata[i] = 0
         i = np.where(mask._griddata != 1)
@@ -2292,7 +3290,7 @@ class Area(BaseSpatialGrid):
         else:
             idcs = flow_dir.sort()
             
-        area = self._area_per_pixel(*args, **kwargs)  # area of a pixel
+        area = self._area_per_pixel(*args, **kwargs).copy()  # area of a pixel, accumulated in place
         
         [ind_i, ind_j] = np.unravel_index(idcs, flow_dir._griddata.shape)
         
@@ -2314,10 +3312,18 @@ class Area(BaseSpatialGrid):
     
         self._griddata = area # Return non bc version of area
     
+    def update_for_flow_codes(self, flow_direction, cells):
+        # Recalculates the area at cells (flat indexes of every cell whose upstream area changed, as found by 
+        # FlowDirectionD8.update_flow_codes) after flow codes change.  Masks and evaluate_at are not supported.
+        
+        area_per_pixel = self._area_per_pixel()
+        flow_direction._accumulate_at(cells, self._griddata, lambda indexes: area_per_pixel[np.unravel_index(indexes, area_per_pixel.shape)])
+        self._invalidate_derived_arrays()
+    
     def areas_greater_than(self, min_area):
         ij_cols = np.where(self._griddata >= min_area)
-        ij = zip(ij_cols[0].tolist(), ij_cols[1].tolist())
-        return self._rowscols_to_xy(ij)
+        xs, ys = self._rowscols_to_xy_array(ij_cols[0], ij_cols[1])
+        return tuple(zip(xs.tolist(), ys.tolist()))
     
     def areas_between(self, fd, min_area, max_area):
         ij_out = []
@@ -2399,7 +3405,7 @@ class MainstemValleyArea(Area):
         else:
             idcs = flow_dir.sort()
             
-        dA = self._area_per_pixel(*args, **kwargs)
+        dA = self._area_per_pixel(*args, **kwargs).copy()
         dx = self._mean_pixel_dimension(*args, **kwargs) * flow_dir.pixel_scale()
         
         length = np.zeros_like(dA)
@@ -2527,7 +3533,7 @@ class KsFromChiWithSmoothing(BaseSpatialGrid, AlongFlowSmoothing):
         de = area._mean_pixel_dimension()
         
         self._copy_info_from_grid(elevation)
-        self._griddata = np.zeros_like(elevation._griddata)
+        self._griddata = np.zeros_like(elevation._griddata, dtype = self._product_dtype())
         self._n = np.zeros_like(self._griddata).astype(int)
         self._n_regression = np.zeros_like(self._griddata).astype(int)
         self._mse = np.zeros_like(self._griddata)
@@ -2646,7 +3652,7 @@ class ThetaFromChiWithSmoothing(BaseSpatialGrid, AlongFlowSmoothing):
         de = area._mean_pixel_dimension()
 
         self._copy_info_from_grid(elevation)
-        self._griddata = np.zeros_like(elevation._griddata)
+        self._griddata = np.zeros_like(elevation._griddata, dtype = self._product_dtype())
         self._n = np.zeros_like(self._griddata).astype(int)
         self._n_regression = np.zeros_like(self._griddata).astype(int)
         self._mse = np.zeros_like(self._griddata)
@@ -2920,103 +3926,164 @@ class MultiscaleCurvatureValleyWidth(BaseSpatialGrid):
             return inv(G)
 
         @classmethod
-        def _convolve(cls, X, Y, Z, K, fix_center=False):
+        def _transform(cls, Z, workers=None):
+            # Real FFT of the elevation grid, shared by the kernels of every scale.
 
-            from numpy.fft import fft2 as fft2
-            from numpy.fft import ifft2 as ifft2
-            from numpy import flipud as flipud
-            from numpy import fliplr as fliplr
-            from numpy.fft import ifftshift
+            from scipy.fft import rfft2
+            return rfft2(Z._griddata, workers = workers)
 
-            Xt = X
-            Yt = Y
-
-            FZ = fft2(fliplr(fliplr(Z._griddata)))
-            FX1 = fft2(np.power(Xt, 2))
-            FX2 = fft2(np.power(Yt, 2))
-            FX3 = fft2(Xt * Yt)
-            FX4 = fft2(Xt)
-            FX5 = fft2(Yt)
-            FX6 = fft2(K)
-
-            g = np.real(ifftshift(ifft2(FZ * FX1))) - np.sum(np.power(Xt, 2)) * Z._griddata
-            h = np.real(ifftshift(ifft2(FZ * FX2))) - np.sum(np.power(Yt, 2)) * Z._griddata
-            i = np.real(ifftshift(ifft2(FZ * FX3))) - np.sum(Xt * Yt) * Z._griddata
-            j = np.real(ifftshift(ifft2(FZ * FX4))) - np.sum(Xt) * Z._griddata
-            k = np.real(ifftshift(ifft2(FZ * FX5))) - np.sum(Yt) * Z._griddata
-            if not fix_center:
-                l = np.real(ifftshift(ifft2(FZ * FX6))) - np.sum(K) * Z._griddata
-            else:
-                l = None
+        @classmethod
+        def _kernel_factors(cls, Z, de):
+            # The kernels X**2, Y**2, XY, X, Y and K (in that order) are each the product of a function of y (rows) and a
+            # function of x (columns) over the square window, so they are returned as those pairs of 1-D factors, after
+            # the x and y coordinates inside the window.
 
-            return g, h, i, j, k, l
+            center = (Z._georef_info.xllcenter + (Z._georef_info.dx / 2) * (Z._georef_info.nx - 1),
+                      Z._georef_info.yllcenter + (Z._georef_info.dx / 2) * (Z._georef_info.ny - 1))
+            x = np.arange(Z._georef_info.nx) * Z._georef_info.dx + Z._georef_info.xllcenter - center[0]
+            y = np.arange(Z._georef_info.ny) * Z._georef_info.dx + Z._georef_info.yllcenter - center[1]
+            kx = (np.abs(x) <= de).astype(float)
+            ky = (np.abs(y) <= de).astype(float)
+
+            return x[kx > 0], y[ky > 0], ((ky, np.power(x, 2) * kx), (np.power(y, 2) * ky, kx), (y * ky, x * kx), (ky, x * kx), (y * ky, kx), (ky, kx))
 
         @classmethod
-        def _Cmin(cls, H, g, h, i, j, k, l, fix_center=False):
+        def _coefficients_from_transform(cls, Z, FZ, de, coefficients, fix_center=False, workers=None):
+            # Coefficients of the quadratic fit over the window of half-width de at every cell, for the rows of inv(G)
+            # listed in coefficients (0 = a, 1 = b, ... 5 = f).  Each coefficient is a linear combination of the
+            # correlations of (Z - Z[center]) with the six kernels of _kernel_factors, so the combination is made in the
+            # frequency domain and only one inverse transform is needed per coefficient.  The kernel transforms are outer
+            # products of the 1-D transforms of their factors.
+
+            from scipy.fft import fft, rfft, irfft2
+            from numpy.fft import ifftshift
 
+            (x, y, factors) = cls._kernel_factors(Z, de)
             if fix_center:
-                a = H[0, 0] * g + H[0, 1] * h + H[0, 2] * i + H[0, 3] * j + H[0, 4] * k
-                b = H[1, 0] * g + H[1, 1] * h + H[1, 2] * i + H[1, 3] * j + H[1, 4] * k
-                c = H[2, 0] * g + H[2, 1] * h + H[2, 2] * i + H[2, 3] * j + H[2, 4] * k
-            else:
-                a = H[0, 0] * g + H[0, 1] * h + H[0, 2] * i + H[0, 3] * j + H[0, 4] * k + H[0, 5] * l
-                b = H[1, 0] * g + H[1, 1] * h + H[1, 2] * i + H[1, 3] * j + H[1, 4] * k + H[1, 5] * l
-                c = H[2, 0] * g + H[2, 1] * h + H[2, 2] * i + H[2, 3] * j + H[2, 4] * k + H[2, 5] * l
+                factors = factors[:5]
+            (X, Y) = np.meshgrid(x, y)
+            H = cls._calc_inv_G_for_kernel(X, Y, X.size, fix_center)
 
-            return -a - b - np.sqrt(np.power((a - b), 2) + np.power(c, 2))
+            FY = np.stack([fft(fy) for (fy, _) in factors], axis = 1)
+            FX = np.stack([rfft(fx) for (_, fx) in factors], axis = 0)
+            sums = np.array([np.sum(fy) * np.sum(fx) for (fy, fx) in factors])
+            s = Z._griddata.shape
 
-        @classmethod
-        def _calc_coefficients(cls, H, g, h, i, j, k, l, fix_center=False):
-            if fix_center:
-                a = H[0, 0] * g + H[0, 1] * h + H[0, 2] * i + H[0, 3] * j + H[0, 4] * k
-                b = H[1, 0] * g + H[1, 1] * h + H[1, 2] * i + H[1, 3] * j + H[1, 4] * k
-                c = H[2, 0] * g + H[2, 1] * h + H[2, 2] * i + H[2, 3] * j + H[2, 4] * k
-                d = H[3, 0] * g + H[3, 1] * h + H[3, 2] * i + H[3, 3] * j + H[3, 4] * k
-                e = H[4, 0] * g + H[4, 1] * h + H[4, 2] * i + H[4, 3] * j + H[4, 4] * k
-                f = 0
-            else:
-                a = H[0, 0] * g + H[0, 1] * h + H[0, 2] * i + H[0, 3] * j + H[0, 4] * k + H[0, 5] * l
-                b = H[1, 0] * g + H[1, 1] * h + H[1, 2] * i + H[1, 3] * j + H[1, 4] * k + H[1, 5] * l
-                c = H[2, 0] * g + H[2, 1] * h + H[2, 2] * i + H[2, 3] * j + H[2, 4] * k + H[2, 5] * l
-                d = H[3, 0] * g + H[3, 1] * h + H[3, 2] * i + H[3, 3] * j + H[3, 4] * k + H[3, 5] * l
-                e = H[4, 0] * g + H[4, 1] * h + H[4, 2] * i + H[4, 3] * j + H[4, 4] * k + H[4, 5] * l
-                f = H[5, 0] * g + H[5, 1] * h + H[5, 2] * i + H[5, 3] * j + H[5, 4] * k + H[5, 5] * l
-            return a, b, c, d, e, f
+            values = []
+            for row in coefficients:
+                weights = H[row, :len(factors)]
+                value = ifftshift(irfft2(FZ * np.dot(FY * weights, FX), s = s, workers = workers))
+                value -= np.dot(weights, sums) * Z._griddata
+                values.append(value)
 
-        @classmethod
-        def _calc_coefficients_for_scale(cls, Z, de, fix_center=False):
-            X, Y, N, K = cls._create_kernel(Z, de)
-            H = cls._calc_inv_G_for_kernel(X, Y, N, fix_center)
-            g, h, i, j, k, l = cls._convolve(X, Y, Z, K, fix_center)
-            return cls._calc_coefficients(H, g, h, i, j, k, l, fix_center)
+            return values
 
         @classmethod
-        def _create_kernel(cls, Z, de):
+        def _weight_kernels(cls, Z, de, coefficients, fix_center=False):
+            # Weights of the quadratic fit over the window of half-width de, so that each coefficient in coefficients
+            # (rows of inv(G): 0 = a, 1 = b, ... 5 = f) at cell p is sum(W[d] * (Z[p - d] - Z[p])) over offsets d in
+            # the window, as in _coefficients_from_transform.  Returns the weights as an array (coefficient, row offset, column offset) with
+            # offsets -r..r, and r.
+
+            (x, y, _) = cls._kernel_factors(Z, de)
+            dx = Z._georef_info.dx
+            (cols, rows) = (np.rint(x / dx).astype(int), np.rint(y / dx).astype(int))
+            r = int(max(np.max(np.abs(cols)), np.max(np.abs(rows))))
+            (X, Y) = np.meshgrid(x, y)
+            H = cls._calc_inv_G_for_kernel(X, Y, X.size, fix_center)
+            terms = (X * X, Y * Y, X * Y, X, Y) + ((np.ones_like(X),) if not fix_center else ())
+
+            W = np.zeros((len(coefficients), 2 * r + 1, 2 * r + 1))
+            for (n, row) in enumerate(coefficients):
+                W[n][np.ix_(rows + r, cols + r)] = sum(H[row, m] * term for (m, term) in enumerate(terms))
+            return W, r
 
-            center = (Z._georef_info.xllcenter + (Z._georef_info.dx / 2) * (Z._georef_info.nx - 1),
-                      Z._georef_info.yllcenter + (Z._georef_info.dx / 2) * (Z._georef_info.ny - 1))
-            x = np.arange(Z._georef_info.nx) * Z._georef_info.dx + Z._georef_info.xllcenter - center[0]
-            y = np.arange(Z._georef_info.ny) * Z._georef_info.dx + Z._georef_info.yllcenter - center[1]
-
-            X, Y = np.meshgrid(x, y)
-            K = ((np.abs(X) <= (de)) & (np.abs(Y) <= (de))).astype(float)
+        @classmethod
+        def _Cmin_for_scale_at_cells(cls, Z, de, rows, cols, fix_center=False, maximum_chunk_bytes=2**26):
+            # Cmin for the window of half-width de at the cells (rows, cols) only, from direct windowed dot products with
+            # the weight kernels of a, b and c.  The grid wraps around at its edges, matching the FFT path.
+
+            from numpy.lib.stride_tricks import sliding_window_view
+
+            (W, r) = cls._weight_kernels(Z, de, range(3), fix_center)
+            W = W[:, ::-1, ::-1]
+            sums = np.sum(W, axis = (1, 2))
+            windows = sliding_window_view(np.pad(Z._griddata, r, mode = 'wrap'), W.shape[1:])
+
+            Cmin = np.empty(len(rows))
+            chunk = max(1, maximum_chunk_bytes // (8 * W[0].size))
+            for start in range(0, len(rows), chunk):
+                (i, j) = (rows[start:start + chunk], cols[start:start + chunk])
+                (a, b, c) = np.einsum('nij,kij->kn', windows[i, j], W) - sums[:, np.newaxis] * Z._griddata[i, j]
+                Cmin[start:start + chunk] = -a - b - np.sqrt(np.power((a - b), 2) + np.power(c, 2))
+            sys.stdout.write('scale ' + str(de) + '\n')
+            sys.stdout.flush()
+            return Cmin, de
 
-            N = np.sum(K[:])
-            return X * K, Y * K, N, K
+        @classmethod
+        def _calc_coefficients_for_scale(cls, Z, de, fix_center=False, FZ=None, workers=None):
+            if FZ is None:
+                FZ = cls._transform(Z, workers)
+            if fix_center:
+                return tuple(cls._coefficients_from_transform(Z, FZ, de, range(5), fix_center, workers)) + (0,)
+            return tuple(cls._coefficients_from_transform(Z, FZ, de, range(6), fix_center, workers))
 
         @classmethod
-        def _Cmin_for_scale(cls, Z, de, fix_center=False):
+        def _Cmin_for_scale(cls, Z, de, fix_center=False, FZ=None, workers=None):
 
-            X, Y, N, K = cls._create_kernel(Z, de)
-            H = cls._calc_inv_G_for_kernel(X, Y, N, fix_center)
-            g, h, i, j, k, l = cls._convolve(X, Y, Z, K, fix_center)
-            Cmin = cls._Cmin(H, g, h, i, j, k, l, fix_center)
+            if FZ is None:
+                FZ = cls._transform(Z, workers)
+            (a, b, c) = cls._coefficients_from_transform(Z, FZ, de, range(3), fix_center, workers)
+            Cmin = -a - b - np.sqrt(np.power((a - b), 2) + np.power(c, 2))
             sys.stdout.write('scale ' + str(de) + '\n')
             sys.stdout.flush()
             return Cmin, de
 
     @classmethod
-    def _elevation_fit_for_location(cls, x, y, elevation, de, fix_center = False):
+    def _local_elevation_fit_for_location(cls, x, y, elevation, de, fix_center = False):
+        # Least-squares quadratic fit to the cells within de of (x, y) along each axis (clipped at the edges of the grid,
+        # NaN cells left out), with X and Y measured east and north of the center cell.  Returns the fitted surface over
+        # that window only.
+
+        ((i, j),) = elevation._xy_to_rowscols(((x, y),))
+        r = int(np.floor(de / elevation._georef_info.dx + 1e-9))
+        (top, bottom) = (max(i - r, 0), min(i + r + 1, elevation._georef_info.ny))
+        (left, right) = (max(j - r, 0), min(j + r + 1, elevation._georef_info.nx))
+        (rows, cols) = np.mgrid[top:bottom, left:right]
+        (xs, ys) = elevation._rowscols_to_xy_array(rows, cols)
+        ((xa, ya),) = elevation._rowscols_to_xy(((i, j),))
+        (X, Y) = (xs - xa, ys - ya)
+        window = np.asarray(elevation._griddata[top:bottom, left:right], dtype = float64)
+        elevation_center = elevation._griddata[i, j]
+
+        terms = [X * X, Y * Y, X * Y, X, Y]
+        valid = ~np.isnan(window)
+        if fix_center:
+            (coefficients, _, _, _) = np.linalg.lstsq(np.column_stack([t[valid] for t in terms]), window[valid] - elevation_center, rcond = None)
+            (a, b, c, d, e), f = coefficients, elevation_center
+        else:
+            terms.append(np.ones_like(X))
+            (coefficients, _, _, _) = np.linalg.lstsq(np.column_stack([t[valid] for t in terms]), window[valid], rcond = None)
+            (a, b, c, d, e, f) = coefficients
+        print('Window size = ' + str(de) + '\n' + 'a = ' + str(a) + ', b = ' + str(b) + ', c = ' + str(c)  + ', d = ' + str(d) + ', e = ' + str(e) + ', f = ' + str(f))
+
+        Z = Elevation()
+        Z._copy_info_from_grid(elevation, set_zeros = True)
+        Z._griddata = a*np.power(X,2) + b*np.power(Y,2) + c*X*Y + d*X + e*Y + f
+        Z._georef_info.nx = right - left
+        Z._georef_info.ny = bottom - top
+        Z._georef_info.xllcenter = xs[-1, 0]
+        Z._georef_info.yllcenter = ys[-1, 0]
+        Z._georef_info.geoTransform = (Z._georef_info.xllcenter - 0.5*Z._georef_info.dx, Z._georef_info.dx, 0, Z._georef_info.yllcenter + (float(Z._georef_info.ny-0.5))*Z._georef_info.dx, 0, -Z._georef_info.dx)
+
+        return Z
+
+    @classmethod
+    def _elevation_fit_for_location(cls, x, y, elevation, de, fix_center = False, local = False):
+        # local = True fits only the window around (x, y), see _local_elevation_fit_for_location.
+
+        if local:
+            return cls._local_elevation_fit_for_location(x, y, elevation, de, fix_center)
 
         Z = Elevation()
         Z._copy_info_from_grid(elevation, set_zeros=False)
@@ -3073,6 +4140,9 @@ class MultiscaleCurvatureValleyWidth(BaseSpatialGrid):
         # Condition inputs to ensure that grids produce square convolution matrices:
         
         (area_cutoff, max_width, min_width, normalize, fix_center, use_dask) = (kwargs['area_cutoff'], kwargs['max_width'], kwargs['min_width'], kwargs.get('normalize', False), kwargs.get('fix_center', False), kwargs.get('use_dask', False))
+        sparse = kwargs.get('sparse', False)
+        workers = kwargs.get('workers')
+        threads = kwargs.get('threads', 1)  # Scales are run in a thread pool only when threads > 1 is passed
         
         if use_dask:
             from dask import compute, delayed
@@ -3108,30 +4178,51 @@ class MultiscaleCurvatureValleyWidth(BaseSpatialGrid):
         scales = np.arange(min_width, max_width, de)
         g_minC = np.zeros_like(Z._griddata)
         g_w = np.zeros_like(Z._griddata)
-        ind = 1
         
-        if use_dask:
+        # The transform of the elevation is shared by every scale:
+        
+        FZ = self.Utilities._transform(Z, workers) if not sparse else None
+        
+        def take_minimum(minC, scale, g_minC = g_minC, g_w = g_w):
+            # Ties go to the smallest scale, so the result does not depend on the order in which scales finish.
+            if normalize:
+                minC *= scale
+            i = (minC < g_minC) | ((minC == g_minC) & (scale < g_w))
+            g_w[i] = scale
+            g_minC[i] = minC[i]
+        
+        if sparse:
+            # Only cells above the area cutoff are evaluated, from windowed dot products rather than full-grid transforms:
+            (rows, cols) = np.where(A._griddata >= area_cutoff)
+            (c_minC, c_w) = (np.zeros(len(rows)), np.zeros(len(rows)))
+            for scale in scales:
+                take_minimum(*self.Utilities._Cmin_for_scale_at_cells(Z, scale, rows, cols, fix_center), g_minC = c_minC, g_w = c_w)
+            g_minC[rows, cols] = c_minC
+            g_w[rows, cols] = c_w
+        elif use_dask:
             from functools import partial
-            wrapper = partial(self.Utilities._Cmin_for_scale, Z, fix_center = fix_center)
+            wrapper = partial(self.Utilities._Cmin_for_scale, Z, fix_center = fix_center, FZ = FZ, workers = workers)
             tasks = [delayed(wrapper)(s) for s in scales]
             results = compute(*tasks)
             for result in results:
-                minC, scale = result
-                if normalize:
-                    minC *= scale
-                i = np.where(minC < g_minC)
-                g_w[i] = np.ones(i[0].shape)*scale
-                g_minC[i] = minC[i]
-                ind += 1
+                take_minimum(*result)
+        elif threads is not None and threads > 1 and len(scales) > 1:
+            # The transforms release the GIL, so scales are run in a thread pool that shares FZ.  At most one scale per
+            # thread is in flight, and each is reduced into g_minC and g_w as soon as it finishes:
+            from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+            pending = set()
+            with ThreadPoolExecutor(max_workers = threads) as executor:
+                for scale in scales:
+                    if len(pending) >= threads:
+                        (done, pending) = wait(pending, return_when = FIRST_COMPLETED)
+                        for future in done:
+                            take_minimum(*future.result())
+                    pending.add(executor.submit(self.Utilities._Cmin_for_scale, Z, scale, fix_center, FZ, workers))
+                for future in wait(pending).done:
+                    take_minimum(*future.result())
         else:
             for scale in scales:   
-                minC, _ = self.Utilities._Cmin_for_scale(Z, scale, fix_center)
-                if normalize:
-                    minC *= scale
-                i = np.where(minC < g_minC)
-                g_w[i] = np.ones(i[0].shape)*scale
-                g_minC[i] = minC[i]
-                ind += 1
+                take_minimum(*self.Utilities._Cmin_for_scale(Z, scale, fix_center, FZ, workers))
                 
         i = np.where(A._griddata < area_cutoff)
         g_minC[i] = np.nan
@@ -3249,52 +4340,42 @@ class DiscreteFlowAccumulation(BaseSpatialGrid):
             elevation._griddata[i] = np.NaN
         kwargs['elevation'] = elevation
         i = np.where(~np.isnan(elevation._griddata))
-        rcs = zip(i[0].tolist(),i[1].tolist())
-        kwargs['outlets'] = elevation._rowscols_to_xy(rcs)
+        xs, ys = elevation._rowscols_to_xy_array(i[0], i[1])
+        kwargs['outlets'] = tuple(zip(xs.tolist(), ys.tolist()))
         self._create_from_elevation_outlets(*args, **kwargs)
         
     def _create_from_elevation_outlets(self, *args, **kwargs):
         
         elevation = kwargs['elevation']
         self._copy_info_from_grid(elevation, True)
-        adjust = [(-1, -1), (0, -1), (1,-1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
-        
-        counter = 1
-        
-        for outlet in kwargs['outlets']:
-            if kwargs.get('display_output') is True:
-                print('Evaluating outlet ' + str(counter) + ' / ' + str(len(kwargs['outlets'])))
-            counter += 1
-            (ij, ) = elevation._xy_to_rowscols((outlet,))
-            visited = (ij, )
-            ij_a = [(ij[0] + x[0], ij[1] + x[1]) for x in adjust]
-            e_a = np.array([elevation[i[0], i[1]] if elevation[i[0], i[1]] is not None else np.NaN for i in ij_a])
-            new = True
-            area = 0
-            while None not in e_a and np.sum(np.isnan(e_a)) == 0 and new:
-                area += self._area_per_pixel()[ij[0], ij[1]]
-                if kwargs.get('terminations_only') is not True:
-                    self._griddata[ij[0], ij[1]] = area
-                sls = np.argsort(e_a)
-                new = False
-                for sl in sls:
-                    this_ij = (ij[0] + adjust[sl][0], ij[1] + adjust[sl][1])
-                    if this_ij not in visited:
-                        visited += (this_ij, )
-                        ij = this_ij
-                        new = True
-                        break
-                if new:
-                    ij_a = [(ij[0] + x[0], ij[1] + x[1]) for x in adjust]
-                    e_a = np.array([elevation[i[0], i[1]] if elevation[i[0], i[1]] is not None else np.NaN for i in ij_a]) 
-            if kwargs.get('terminations_only') is True:
-                self._griddata[ij[0], ij[1]] = area  
-
-    def _area_per_pixel(self, *args, **kwargs):
-        return self._georef_info.dx**2 * np.ones((self._georef_info.ny, self._georef_info.nx))
-
-    def _mean_pixel_dimension(self, *args, **kwargs):
-        return self._georef_info.dx * np.ones_like(kwargs['elevation']._griddata, self.dtype)
+        terminations_only = kwargs.get('terminations_only') is True
+        
+        outlets = np.asarray(kwargs['outlets'], dtype = np.float64).reshape((-1, 2))
+        (rows, cols) = elevation._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
+        starts = (rows * self._georef_info.nx + cols)[rows >= 0]
+        
+        # Walks are run in batches; each batch returns the values its walks leave in the grid, and batches are written
+        # in order so that later walks still overwrite earlier ones.  Batches are only spread over a pool of worker
+        # processes when processes > 1 is passed and there is more than one batch to run.
+        
+        walker = elevation._steepest_descent_walker(area_per_pixel = self._area_per_pixel())
+        batch_size = kwargs.get('batch_size', 10000)
+        tasks = [(starts[k:k+batch_size], terminations_only) for k in range(0, len(starts), batch_size)]
+        processes = kwargs.get('processes', 1)
+        
+        def write_batches(results):
+            for (batch, (cells, values)) in enumerate(results):
+                if kwargs.get('display_output') is True:
+                    print('Evaluated outlets ' + str(min((batch+1)*batch_size, len(starts))) + ' / ' + str(len(starts)))
+                self._griddata.flat[cells] = values
+        
+        if processes is None or processes <= 1 or len(tasks) <= 1:
+            write_batches(walker.accumulate(*task) for task in tasks)
+        else:
+            import multiprocessing
+            context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+            with context.Pool(processes, initializer = _init_walker_worker, initargs = (walker,)) as pool:
+                write_batches(pool.imap(_accumulate_walks, tasks))
 
 class GeographicDiscreteFlowAccumulation(GeographicGridMixin, DiscreteFlowAccumulation):    
     pass
@@ -3364,6 +4445,29 @@ class FlowLength(BaseSpatialGrid):
         
         return None
     
+    def update_for_flow_codes(self, flow_direction, cells):
+        # Recalculates the flow length (and the direction to the longest upstream path) at cells (flat indexes of every
+        # cell whose upstream area changed, as found by FlowDirectionD8.update_flow_codes) after flow codes change.
+        
+        pixel_dimension = self._mean_pixel_dimension()
+        
+        def step(indexes):
+            return pixel_dimension[np.unravel_index(indexes, pixel_dimension.shape)] * flow_direction.flow_length_to(indexes).astype(np.float32)
+        
+        (donors, targets, lengths) = flow_direction._accumulate_at(cells, self._griddata, lambda indexes: np.zeros(len(indexes)), step = step, maximum = True)
+        
+        directions = self.__dict__.get('_FlowLength__flow_directions')
+        if directions is not None:
+            directions.flat[cells] = 0
+            longest = np.lexsort((lengths, targets))
+            last = np.r_[targets[longest][1:] != targets[longest][:-1], True]
+            (donors, targets) = (donors[longest][last], targets[longest][last])
+            table = np.array([[self.__flow_direction_for_length((0, 0), (di, dj)) or 0 for dj in (-1, 0, 1)] for di in (-1, 0, 1)], dtype = np.uint8)
+            (donor_rows, donor_cols) = np.unravel_index(donors, directions.shape)
+            (target_rows, target_cols) = np.unravel_index(targets, directions.shape)
+            directions[target_rows, target_cols] = table[target_rows - donor_rows + 1, target_cols - donor_cols + 1]
+        self._invalidate_derived_arrays()
+    
     def points_with_length(self, length, fd):
         
         tolerance = np.nanmin(self._mean_pixel_dimension())
@@ -3561,8 +4665,9 @@ class Relief(BaseSpatialGrid, MaxFlowLengthTrackingMixin):
     
     def _create_from_flow_direction_sorted_indexes_and_elevation(self, *args, **kwargs):
         self._copy_info_from_grid(kwargs['elevation'])
+        self._griddata = self._griddata.astype(self._product_dtype())
         self._calculate_by_tracking_down_max_flow_length(*args, **kwargs)
-        self._griddata = self._griddata - kwargs['elevation']._griddata
+        self._griddata = (self._griddata - kwargs['elevation']._griddata).astype(self._product_dtype())
     
     def _calculate_grid_value(self, pos, next_pos, *args, **kwargs):
         (i,j) = pos
@@ -3602,9 +4707,11 @@ class Ksi(BaseSpatialGrid, MaxFlowLengthTrackingMixin):
         self._copy_info_from_grid(kwargs['flow_direction'], True)
         area_grid = kwargs['area']._griddata - kwargs['Ao']
         area_grid[area_grid <= 0] = np.nan
-        self._griddata = np.zeros_like(area_grid)
+        self._griddata = np.zeros_like(area_grid, dtype = self._product_dtype())
         i = np.where(area_grid > 0)
-        self._griddata[i] = ( (kwargs['Ao'] / area_grid[i]) ** kwargs['theta']) * self._mean_pixel_dimension(*args, **kwargs)[i] * kwargs['flow_direction'].pixel_scale()[i]
+        de = self._mean_pixel_dimension(*args, **kwargs)
+        pixel_scale = kwargs['flow_direction'].pixel_scale()
+        self._griddata[i] = ( (kwargs['Ao'] / area_grid[i]) ** kwargs['theta']) * de[i] * pixel_scale[i]
         self._calculate_by_tracking_down_max_flow_length(*args, **kwargs)
         
     def _calculate_grid_value(self, pos, next_pos, *args, **kwargs):
@@ -3633,7 +4740,6 @@ class RestoredElevation(BaseSpatialGrid):
         iterations = kwargs['iterations']
         ks = kwargs['ks']
         theta = kwargs['theta']
-        v = self._xy_to_rowscols(outlets)
         pixel_dimension = self._mean_pixel_dimension(*args, **kwargs)
         
         
@@ -3647,255 +4753,81 @@ class RestoredElevation(BaseSpatialGrid):
             external_divides._griddata = np.zeros_like(external_divides._griddata, int)
         if randomize:
             filled = FilledElevation(elevation = self, mask = mask, randomize = randomize, outlets = outlets)
-            flow_direction.update_flow_codes_in_mask(filled, mask)
+            flow_direction.update_flow_codes_in_mask(filled, mask, area = area)
             i = np.where(mask._griddata == 1)
             self._griddata[i] = filled._griddata[i]
-            area = self.__recalculate_area(area, flow_direction, pixel_dimension, outlets)
+            self._invalidate_derived_arrays()
         for i in range(iterations):
             last_grid = self._griddata.copy()
             print('Iteration {0}'.format(i))
             print('Filling outlets.')
-            divides = self.__fill_outlets(area, flow_direction, pixel_dimension, v, ks, theta)
+            divides = self.__fill_outlets(area, flow_direction, pixel_dimension, outlets, ks, theta)
             print('Migrating divides')
-            flow_direction = self.__migrate_divides(flow_direction, divides, external_divides)
-            area = self.__recalculate_area(area, flow_direction, pixel_dimension, outlets)
+            flow_direction = self.__migrate_divides(flow_direction, divides, external_divides, area)
             change_in_elevation = np.mean((self._griddata - last_grid)**2)
             print('Change: {0}'.format(change_in_elevation))
     
-    def __is_unit_area(self, idx, flow_direction):
-        
-        (i,j) = idx
-        
-        if flow_direction[i,j+1] == 16 or flow_direction[i+1, j+1] == 32 or \
-                flow_direction[i+1, j] == 64 or flow_direction[i+1, j-1] == 128 or \
-                flow_direction[i, j-1] == 1 or flow_direction[i-1, j-1] == 2 or \
-                flow_direction[i-1, j] == 4 or flow_direction[i-1, j+1] == 8:
-            return False
-        else:
-            return True
-        
     def __migrate_divides(self, *args, **kwargs):
+        # Every neighbor that is higher than a divide (and not on an external divide) is turned to drain into it.  A
+        # cell next to several divides drains to the one it falls most steeply to.  area is updated for the new codes
+        # along the flow paths they change.
         
         flow_direction = args[0]
-        divides = args[1]
+        (rows, cols) = args[1]
         external_divides = args[2]
-        migrated = 0
-
-        for (i, j) in divides:
-            if external_divides[i,j] != 1:
-                try:
-                    if self[i,j+1] > self[i,j] and external_divides[i,j+1] != 1:
-                        flow_direction[i,j+1] = 16
-                        migrated += 1
-                except:
-                    pass
-                
-                try:
-                    if self[i+1, j+1] > self[i,j] and external_divides[i+1,j+1] != 1:
-                        flow_direction[i+1, j+1] = 32
-                        migrated += 1
-                except:
-                    pass
-                
-                try:
-                    if self[i+1, j] > self[i,j] and external_divides[i+1,j] != 1:
-                        flow_direction[i+1, j] = 64
-                        migrated += 1
-                except:
-                    pass
-                
-                try:
-                    if self[i+1, j-1] > self[i,j] and external_divides[i+1,j-1] != 1:
-                        flow_direction[i+1, j-1] = 128
-                        migrated += 1
-                except:
-                    pass
-                
-                try:
-                    if self[i, j-1] > self[i,j] and external_divides[i,j-1] != 1:
-                        flow_direction[i, j-1] = 1
-                        migrated += 1
-                except:
-                    pass
-                
-                try:        
-                    if self[i-1,j-1] > self[i,j] and external_divides[i-1,j-1] != 1:
-                        flow_direction[i-1, j-1] = 2
-                        migrated += 1
-                except:
-                    pass
-                
-                try:
-                    if self[i-1, j] > self[i,j] and external_divides[i-1,j] != 1:
-                        flow_direction[i-1, j] = 4
-                        migrated += 1
-                except:
-                    pass
-                
-                try:
-                    if self[i-1, j+1] > self[i,j] and external_divides[i-1,j+1] != 1:
-                        flow_direction[i-1, j+1] = 8
-                        migrated += 1
-                except:
-                    pass
-                
-        print("Migrated " + str(migrated) + " divides.")
+        area = args[3]
+        
+        elevation = self._halo_griddata()
+        flow_codes = flow_direction._halo_griddata()
+        external = external_divides._halo_griddata()
+        
+        keep = external[rows+1, cols+1] != 1
+        (rows, cols) = (rows[keep] + 1, cols[keep] + 1)
+        candidates = []
+        for (di, dj, code) in flow_direction._upstream_neighbors:
+            (neighbor_rows, neighbor_cols) = (rows + di, cols + dj)
+            with np.errstate(invalid = 'ignore'):
+                drop = (elevation[neighbor_rows, neighbor_cols] - elevation[rows, cols]) / (1.4142135623730951 if (di != 0 and dj != 0) else 1.0)
+                migrate = (drop > 0) & (external[neighbor_rows, neighbor_cols] != 1)
+            candidates.append((neighbor_rows[migrate] * flow_codes.shape[1] + neighbor_cols[migrate], drop[migrate], np.full(np.count_nonzero(migrate), code, dtype = flow_codes.dtype)))
+        (neighbors, drop, codes) = [np.concatenate(values) for values in zip(*candidates)]
+        
+        steepest_first = np.argsort(-drop, kind = 'stable')
+        (neighbors, first) = np.unique(neighbors[steepest_first], return_index = True)
+        (neighbor_rows, neighbor_cols) = np.divmod(neighbors, flow_codes.shape[1])
+        flow_direction.update_flow_codes((neighbor_rows - 1, neighbor_cols - 1), codes[steepest_first][first], area = area)
+        
+        print("Migrated " + str(len(neighbors)) + " divides.")
         return flow_direction
     
-    def __fill_outlets(self, area, flow_direction, pixel_dimension, outlet_indexes, ks, theta):
-        
-        divides = list()
-        for ind in outlet_indexes:
-            divides += self.__fill_upstream_points(ind, ks, theta, area, flow_direction, pixel_dimension)
-        return divides
-        
-    def __fill_upstream_points(self, ind, ks, theta, area, flow_direction, pixel_dimension):
-        
-        (i, j) = ind
-        elevation_for_cell = self[i,j]
-        is_divide = True
-        divides = list()
-        
-        try:
-            if flow_direction[i, j+1] == 16:
-                self._griddata[i,j+1] = elevation_for_cell + pixel_dimension[i,j]*1.00*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i,j+1), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try:
-            if flow_direction[i+1, j+1] == 32:
-                self._griddata[i+1,j+1] = elevation_for_cell + pixel_dimension[i,j]*1.414*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i+1,j+1), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try:                
-            if flow_direction[i+1, j] == 64:
-                self._griddata[i+1,j] = elevation_for_cell + pixel_dimension[i,j]*1.00*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i+1,j), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try:
-            if flow_direction[i+1, j-1] == 128:
-                self._griddata[i+1,j-1] = elevation_for_cell + pixel_dimension[i,j]*1.414*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i+1,j-1), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try:        
-            if flow_direction[i, j-1] == 1:
-                self._griddata[i,j-1] = elevation_for_cell + pixel_dimension[i,j]*1.00*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i,j-1), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try: 
-            if flow_direction[i-1, j-1] == 2:
-                self._griddata[i-1,j-1] = elevation_for_cell + pixel_dimension[i,j]*1.414*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i-1,j-1), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try:    
-            if flow_direction[i-1, j] == 4:
-                self._griddata[i-1,j] = elevation_for_cell + pixel_dimension[i,j]*1.00*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i-1,j), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        try:    
-            if flow_direction[i-1, j+1] == 8:
-                self._griddata[i-1,j+1] = elevation_for_cell + pixel_dimension[i,j]*1.414*ks*area[i,j]**(-theta)
-                divides += self.__fill_upstream_points((i-1,j+1), ks, theta, area, flow_direction, pixel_dimension)
-                is_divide = False
-        except:
-            pass
-        
-        if is_divide:
-            return [(i,j)]
-        else:
-            return divides
+    def __fill_outlets(self, area, flow_direction, pixel_dimension, outlets, ks, theta):
+        # Integrates ks * A^-theta upstream from the outlets: each cell upstream of an outlet is set to the elevation of
+        # its receiver plus ks * A^-theta times the step, with A and the pixel dimension taken at the receiver.  Cells
+        # are filled one level of the flow direction's topological order at a time, downstream levels first.  Returns
+        # the (rows, columns) of the divides, the filled cells that no cell drains into.
+        
+        shape = self._griddata.shape
+        labels = flow_direction.basin_labels(outlets).ravel()
+        receivers = flow_direction.receiver_indexes()
+        (order, level_offsets) = flow_direction.topological_order()
+        
+        filled = (receivers >= 0) & (labels[np.maximum(receivers, 0)] > 0)
+        step = np.where(flow_direction.flow_length_to(np.arange(receivers.size)) > 1.0, 1.414, 1.0)
+        increment = np.zeros(receivers.size, dtype = float64)
+        to = receivers[filled]
+        with np.errstate(divide = 'ignore'):
+            increment[filled] = np.asarray(pixel_dimension).ravel()[to] * step[filled] * ks * np.asarray(area._griddata, dtype = float64).ravel()[to]**(-theta)
+        
+        elevation = self._griddata.ravel()
+        for level in range(len(level_offsets)-2, -1, -1):
+            cells = order[level_offsets[level]:level_offsets[level+1]]
+            cells = cells[filled[cells]]
+            elevation[cells] = elevation[receivers[cells]] + increment[cells]
+        self._griddata[:] = elevation.reshape(shape)
+        self._invalidate_derived_arrays()
+        
+        return np.unravel_index(np.flatnonzero((labels > 0) & (flow_direction.donor_counts() == 0)), shape)
     
-    def __recalculate_area(self, area, flow_direction, pixel_dimension, outlets):
-        outlet_indexes = self._xy_to_rowscols(outlets)
-        for outlet in outlet_indexes:
-            self.__recurse_area(outlet, area, flow_direction, pixel_dimension)
-        return area
-        
-    def __recurse_area(self, ind, area, flow_direction, pixel_dimension):
-        
-        (i, j) = ind
-        
-        this_area = pixel_dimension[i,j]**2
-        
-        try:
-            if flow_direction[i, j+1] == 16:
-                ind = (i, j+1)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try:
-            if flow_direction[i+1, j+1] == 32:
-                ind = (i+1,j+1)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try:                
-            if flow_direction[i+1, j] == 64:
-                ind = (i+1,j)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try:
-            if flow_direction[i+1, j-1] == 128:
-                ind = (i+1, j-1)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try:        
-            if flow_direction[i, j-1] == 1:
-                ind = (i,j-1)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try: 
-            if flow_direction[i-1, j-1] == 2:
-                ind = (i-1, j-1)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try:    
-            if flow_direction[i-1, j] == 4:
-                ind = (i-1, j)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass
-        
-        try:    
-            if flow_direction[i-1, j+1] == 8:
-                ind = (i-1, j+1)
-                this_area += self.__recurse_area(ind, area, flow_direction, pixel_dimension)
-        except:
-            pass    
-
-        area[i,j] = this_area
-        return this_area
-   
 class GeographicRestoredElevation(GeographicGridMixin, RestoredElevation):
     pass
 
@@ -3908,18 +4840,19 @@ class ChiScaledRelief(BaseSpatialGrid):
     
     def _create_from_inputs(self, *args, **kwargs):
         self._copy_info_from_grid(kwargs['elevation'], True)
-        outlet_indexes = self._xy_to_rowscols(kwargs['outlets'])
         elevation = kwargs['elevation']
         scale = np.power(kwargs['Ao'],kwargs['theta'])
-        outlet_number = 1
-        for outlet_index in outlet_indexes:
-            indexes = kwargs['flow_direction'].get_indexes_of_upstream_cells(outlet_index[0], outlet_index[1])
-            elevation_of_outlet = kwargs['elevation'][outlet_index[0],outlet_index[1]]
-            for index in indexes:
-                self[index[0],index[1]] = (elevation[index[0], index[1]] - elevation_of_outlet) * scale
-            if kwargs.get('output_flag', False):
-                print('Outlet ' + str(outlet_number) + '/' + str(len(outlet_indexes)) + ' completed.')
-            outlet_number = outlet_number + 1
+        
+        # Each cell is scaled relative to the nearest outlet downstream of it:
+        
+        outlets = np.asarray(kwargs['outlets'], dtype = np.float64).reshape((-1, 2))
+        labels = kwargs['flow_direction'].basin_labels(outlets)
+        (rows, cols) = self._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
+        elevation_of_outlets = np.where(rows >= 0, elevation._griddata[rows, cols], np.nan)
+        i = np.where(labels > 0)
+        self._griddata[i] = (elevation._griddata[i] - elevation_of_outlets[labels[i]-1]) * scale
+        if kwargs.get('output_flag', False):
+            print(str(len(outlets)) + ' outlets completed.')
             
     def _create_from_basin_length(self, *args, **kwargs):
         kwargs['outlets'] = kwargs['flow_length'].points_with_length(kwargs['basin_length'],kwargs['flow_direction'])
@@ -3937,6 +4870,7 @@ class Chi(BaseSpatialGrid):
     
     def _create_from_inputs(self, *args, **kwargs):
         self._copy_info_from_grid(kwargs['flow_direction'], True)
+        self._griddata = self._griddata.astype(self._product_dtype())
         self.__calculate_chi(*args, **kwargs)
     
     def _create_from_basin_length(self, *args, **kwargs):
@@ -3944,6 +4878,40 @@ class Chi(BaseSpatialGrid):
         kwargs['output_flag'] = True
         return self._create_from_inputs(*args, **kwargs)
             
+    def update_for_flow_codes(self, flow_direction, cells, area, theta, Ao, outlets):
+        # Recalculates chi upstream of cells (flat indexes of the cells whose receiver or upstream area changed, as found by
+        # FlowDirectionD8.update_flow_codes) after flow codes change, one level of donors at a time from the most 
+        # downstream cells.  The mask and maximum_length options of the full calculation are not supported.
+        
+        pixel_dimension = self._mean_pixel_dimension()
+        receivers = flow_direction.receiver_indexes()
+        outlets = np.asarray(outlets, dtype = np.float64).reshape((-1, 2))
+        (rows, cols) = self._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
+        outlet_cells = (rows * self._griddata.shape[1] + cols)[rows >= 0]
+        
+        upstream = flow_direction._upstream_of(cells)
+        
+        # As in the full calculation, which fills from the outlets in order, an outlet starts chi again unless an outlet
+        # earlier in the list is downstream of it:
+        outlet_cells = np.array([cell for (number, cell) in enumerate(outlet_cells.tolist()) if np.isin(cell, upstream) and 
+                                 not np.any(np.isin(flow_direction._downstream_of([cell]), outlet_cells[:number]))], dtype = np.intp)
+        
+        receiver_positions = np.minimum(np.searchsorted(upstream, receivers[upstream]), len(upstream) - 1)
+        frontier = upstream[(upstream[receiver_positions] != receivers[upstream]) | np.isin(upstream, outlet_cells)]
+        self._griddata.flat[upstream] = 0.0  # Cells that are not reached drain into a flow loop, not to an outlet.
+        while len(frontier) > 0:
+            indexes = np.unravel_index(frontier, self._griddata.shape)
+            is_outlet = np.isin(frontier, outlet_cells)
+            scale = np.where(is_outlet | (flow_direction.flow_length_to(frontier) <= 1.0), 1.0, 1.414)
+            with np.errstate(divide = 'ignore'):
+                chi = (Ao / area._griddata[indexes])**theta * pixel_dimension[indexes] * scale
+            receiver = receivers[frontier]
+            receiver_chi = self._griddata.flat[np.maximum(receiver, 0)]
+            self._griddata[indexes] = np.where(is_outlet, chi, np.where((receiver >= 0) & (receiver_chi > 0), receiver_chi + chi, 0.0))
+            (frontier, _) = flow_direction._donors_of(frontier)
+            frontier = frontier[~np.isin(frontier, outlet_cells)]
+        self._invalidate_derived_arrays()
+    
     def __calculate_chi(self, *args, **kwargs):
         pixel_dimension = self._mean_pixel_dimension(*args, **kwargs)
         area = kwargs['area']
@@ -4058,21 +5026,13 @@ class CrossDivideDChi(BaseSpatialGrid):
     
     def _create_from_inputs(self, *args, **kwargs):
         self._copy_info_from_grid(kwargs['flow_direction'], True)
-        paired_divides = kwargs['flow_direction'].paired_divides()
-        divide_columns = zip(*paired_divides)
-        from_point = divide_columns[0]
-        to_point = divide_columns[1]
-        
-        from_idx = self._xy_to_rowscols(from_point)
-        to_idx = self._xy_to_rowscols(to_point)
-        
-        from_idx_column = zip(*from_idx)
-        to_idx_column = zip(*to_idx)
+        (i, j, i_pair, j_pair) = kwargs['flow_direction'].paired_divide_indexes()
+        chi = kwargs['chi']._griddata
         
-        minchi = np.minimum(kwargs['chi']._griddata[to_idx_column[0],to_idx_column[1]], kwargs['chi']._griddata[from_idx_column[0],from_idx_column[1]])
-        maxchi = np.maximum(kwargs['chi']._griddata[to_idx_column[0],to_idx_column[1]], kwargs['chi']._griddata[from_idx_column[0],from_idx_column[1]])
+        minchi = np.minimum(chi[i_pair, j_pair], chi[i, j])
+        maxchi = np.maximum(chi[i_pair, j_pair], chi[i, j])
         
-        self._griddata[from_idx_column[0],from_idx_column[1]] = (maxchi - minchi) * (minchi != 0).astype(float)
+        self._griddata[i, j] = (maxchi - minchi) * (minchi != 0).astype(float)
                 
 class NormalizedCrossDivideDChi(BaseSpatialGrid):
     
@@ -4083,24 +5043,16 @@ class NormalizedCrossDivideDChi(BaseSpatialGrid):
     
     def _create_from_inputs(self, *args, **kwargs):
         self._copy_info_from_grid(kwargs['flow_direction'], True)
-        paired_divides = kwargs['flow_direction'].paired_divides(mask = kwargs['chi'])
-        divide_columns = zip(*paired_divides)
-        from_point = divide_columns[0]
-        to_point = divide_columns[1]
+        (i, j, i_pair, j_pair) = kwargs['flow_direction'].paired_divide_indexes(mask = kwargs['chi'])
+        chi = kwargs['chi']._griddata
         
-        from_idx = self._xy_to_rowscols(from_point)
-        to_idx = self._xy_to_rowscols(to_point)
-        
-        from_idx_column = zip(*from_idx)
-        to_idx_column = zip(*to_idx)
-        
-        minchi = np.minimum(kwargs['chi']._griddata[to_idx_column[0],to_idx_column[1]], kwargs['chi']._griddata[from_idx_column[0],from_idx_column[1]])
-        maxchi = np.maximum(kwargs['chi']._griddata[to_idx_column[0],to_idx_column[1]], kwargs['chi']._griddata[from_idx_column[0],from_idx_column[1]])
+        minchi = np.minimum(chi[i_pair, j_pair], chi[i, j])
+        maxchi = np.maximum(chi[i_pair, j_pair], chi[i, j])
         
         rangechi = (maxchi - minchi) * (minchi != 0).astype(float)
         meanchi = (maxchi + minchi) / 2
         
-        self._griddata[from_idx_column[0],from_idx_column[1]] = rangechi / meanchi
+        self._griddata[i, j] = rangechi / meanchi
 
          
 class Deflection(BaseSpatialGrid):
@@ -4162,14 +5114,11 @@ class ChannelSlope(BaseSpatialGrid):
 
         dx = self._georef_info.dx
         idcs = fd.sort() # Get the sorted indices of the array in reverse order (e.g. largest first)
-    
-        for idx in idcs:  # Loop through all the data in sorted order
-            [i, j] = np.unravel_index(idx, fd._griddata.shape)  # Get the row/column indices
-    
-            i_next, j_next, is_good = fd.get_flow_to_cell(i,j)
-            if is_good:
-                dist = np.sqrt((i-i_next)**2 + (j-j_next)**2)*dx
-                self._griddata[i,j] = (dem[i,j] - dem[i_next, j_next]) / dist
+        
+        (i, j) = np.unravel_index(idcs, fd._griddata.shape)
+        (i_next, j_next, is_good) = fd.flow_to((i, j))
+        (i, j, i_next, j_next) = (i[is_good], j[is_good], i_next[is_good], j_next[is_good])
+        self._griddata[i, j] = (dem._griddata[i, j] - dem._griddata[i_next, j_next]) / (fd.flow_length_to((i, j)) * dx)
 
     
 def mosaicFolder(folderPath, fileSuffix, outfile):
@@ -4186,7 +5135,219 @@ def mosaicFolder(folderPath, fileSuffix, outfile):
     # sys.argv = argv
     subprocess.call(argument)
 
+class JointHistogram(object):
+    
+    # Streaming 2-D histogram of two aligned grids, for plotting one against the other without holding the values of
+    # every cell.  Values are added in blocks (add, or from_grids, which streams over tiles of rows) and only the bins
+    # are kept.  Bins are rectangular, or hexagonal with hexagonal = True (x_bins hexagons across and y_bins down, as
+    # in matplotlib's hexbin), and can be spaced logarithmically along either axis (log_x, log_y; values <= 0 are left
+    # out).  Either give the number of bins and their range, or (rectangular bins only) the bin edges.  If a third
+    # grid is added, the mean and quantiles of its values in each bin are available; quantiles are interpolated from
+    # a histogram of z_bins bins over z_range.
+    
+    def __init__(self, x_bins = 100, y_bins = 100, x_range = None, y_range = None, log_x = False, log_y = False, hexagonal = False, z_bins = 256, z_range = None):
+        
+        (self.log_x, self.log_y, self.hexagonal) = (log_x, log_y, hexagonal)
+        (self.x_edges, self._tx_edges) = self.__edges(x_bins, x_range, log_x, 'X')
+        (self.y_edges, self._ty_edges) = self.__edges(y_bins, y_range, log_y, 'Y')
+        (self.nx, self.ny) = (len(self._tx_edges) - 1, len(self._ty_edges) - 1)
+        self.size = (self.nx + 1) * (self.ny + 1) + self.nx * self.ny if hexagonal else self.nx * self.ny
+        if hexagonal and (np.ndim(x_bins) > 0 or np.ndim(y_bins) > 0):
+            raise Error.InputError('Bins', 'hexagonal bins take the number of bins and their range, not edges')
+        
+        self.z_range = z_range
+        self.z_bins = z_bins
+        self.counts = np.zeros(self.size, dtype = np.int64)
+        self._z_count = np.zeros(self.size, dtype = np.int64)
+        self._z_sum = np.zeros(self.size, dtype = float64)
+        self._z_histogram = None
+    
+    def __edges(self, bins, value_range, log, name):
+        transform = np.log10 if log else (lambda values: values)
+        if np.ndim(bins) > 0:
+            edges = np.asarray(bins, dtype = float64)
+            return edges, transform(edges)
+        if value_range is None:
+            raise Error.InputError(name + ' range', 'is required when the number of bins is given')
+        transformed = np.linspace(transform(float(value_range[0])), transform(float(value_range[1])), int(bins) + 1)
+        return (np.power(10.0, transformed) if log else transformed), transformed
+    
+    def _bin_indexes(self, x, y):
+        # Bin of each (x, y), or -1 for points outside of the bins.
+        
+        tx = np.log10(np.where(x > 0, x, np.nan)) if self.log_x else x
+        ty = np.log10(np.where(y > 0, y, np.nan)) if self.log_y else y
+        
+        if not self.hexagonal:
+            # As np.histogram2d, the last bin includes its right edge:
+            ix = np.searchsorted(self._tx_edges, tx, side = 'right') - 1
+            iy = np.searchsorted(self._ty_edges, ty, side = 'right') - 1
+            ix[tx == self._tx_edges[-1]] = self.nx - 1
+            iy[ty == self._ty_edges[-1]] = self.ny - 1
+            inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+            return np.where(inside, ix * self.ny + iy, -1)
+        
+        # Hexagon centers lie on two interleaved rectangular lattices; each point goes to the nearer of the two centers,
+        # and is left out if that center is not on the grid (as matplotlib's hexbin):
+        (sx, sy) = self.__hexagon_spacing()
+        (ix, iy) = ((tx - self._tx_edges[0]) / sx, (ty - self._ty_edges[0]) / sy)
+        (ix, iy) = (np.where(np.isnan(ix), -1.0, ix), np.where(np.isnan(iy), -1.0, iy))
+        (ix1, iy1, ix2, iy2) = (np.round(ix), np.round(iy), np.floor(ix), np.floor(iy))
+        first = (ix - ix1)**2 + 3.0 * (iy - iy1)**2 < (ix - ix2 - 0.5)**2 + 3.0 * (iy - iy2 - 0.5)**2
+        inside = np.where(first, (ix1 >= 0) & (ix1 <= self.nx) & (iy1 >= 0) & (iy1 <= self.ny), 
+                          (ix2 >= 0) & (ix2 < self.nx) & (iy2 >= 0) & (iy2 < self.ny))
+        index = np.where(first, ix1 * (self.ny + 1) + iy1, (self.nx + 1) * (self.ny + 1) + ix2 * self.ny + iy2)
+        return np.where(inside, index, -1).astype(np.intp)
+    
+    def __hexagon_spacing(self):
+        return (self._tx_edges[-1] - self._tx_edges[0]) / self.nx, (self._ty_edges[-1] - self._ty_edges[0]) / self.ny
+    
+    def _bin_centers(self):
+        # (x, y) of the center of each bin, in the (log10 where log) coordinates the bins are spaced in.
+        
+        if not self.hexagonal:
+            (cx, cy) = ((self._tx_edges[:-1] + self._tx_edges[1:]) / 2.0, (self._ty_edges[:-1] + self._ty_edges[1:]) / 2.0)
+            (X, Y) = np.meshgrid(cx, cy, indexing = 'ij')
+            return X.ravel(), Y.ravel()
+        (sx, sy) = self.__hexagon_spacing()
+        (X1, Y1) = np.meshgrid(np.arange(self.nx + 1), np.arange(self.ny + 1), indexing = 'ij')
+        (X2, Y2) = np.meshgrid(np.arange(self.nx) + 0.5, np.arange(self.ny) + 0.5, indexing = 'ij')
+        return (self._tx_edges[0] + sx * np.concatenate((X1.ravel(), X2.ravel())), 
+                self._ty_edges[0] + sy * np.concatenate((Y1.ravel(), Y2.ravel())))
+    
+    def add(self, x, y, z = None, mask = None):
+        # Adds the values in x and y (arrays of any, matching, shape), and z for per-bin statistics.  Elements where
+        # either is NaN, or mask is False (or 0), are left out.
+        
+        (x, y) = (np.asarray(x, dtype = float64).ravel(), np.asarray(y, dtype = float64).ravel())
+        keep = ~np.isnan(x) & ~np.isnan(y)
+        if mask is not None:
+            keep &= np.asarray(mask).ravel().astype(bool)
+        index = self._bin_indexes(x, y)
+        keep &= index >= 0
+        index = index[keep]
+        self.counts += np.bincount(index, minlength = self.size)
+        
+        if z is not None:
+            z = np.asarray(z, dtype = float64).ravel()[keep]
+            has_z = ~np.isnan(z)
+            (index, z) = (index[has_z], z[has_z])
+            self._z_count += np.bincount(index, minlength = self.size)
+            self._z_sum += np.bincount(index, weights = z, minlength = self.size)
+            if self.z_range is not None:
+                if self._z_histogram is None:
+                    self._z_histogram = np.zeros(self.size * self.z_bins, dtype = np.int64)
+                (low, high) = self.z_range
+                iz = np.clip(((z - low) / (high - low) * self.z_bins).astype(np.intp), 0, self.z_bins - 1)
+                self._z_histogram += np.bincount(index * self.z_bins + iz, minlength = self.size * self.z_bins)
+        return self
+    
+    @classmethod
+    def from_grids(cls, x_grid, y_grid, z_grid = None, mask = None, maximum_tile_elements = 2**22, **kwargs):
+        # Streams over tiles of rows of x_grid and y_grid (grids or arrays; z_grid and mask optional).  When x_range,
+        # y_range (and z_range, for quantiles) are not given for numbers of bins, a first pass over the tiles finds them.
+        
+        arrays = [None if grid is None else (grid._griddata if hasattr(grid, '_griddata') else np.asarray(grid)) for grid in (x_grid, y_grid, z_grid, mask)]
+        rows = arrays[0].shape[0]
+        rows_per_tile = max(1, maximum_tile_elements // max(1, int(np.prod(arrays[0].shape[1:]))))
+        tiles = [slice(start, min(start + rows_per_tile, rows)) for start in range(0, rows, rows_per_tile)]
+        
+        def tile_values(tile):
+            (x, y, z, m) = [None if array is None else array[tile] for array in arrays]
+            keep = ~np.isnan(x) & ~np.isnan(y)
+            if m is not None:
+                keep &= m.astype(bool)
+            if kwargs.get('log_x'):
+                keep &= x > 0
+            if kwargs.get('log_y'):
+                keep &= y > 0
+            return x, y, z, m, keep
+        
+        needed = [(name, position) for (name, position, bins) in (('x_range', 0, kwargs.get('x_bins', 100)), ('y_range', 1, kwargs.get('y_bins', 100)), ('z_range', 2, None))
+                  if kwargs.get(name) is None and np.ndim(bins) == 0 and (position < 2 or arrays[2] is not None)]
+        if len(needed) > 0:
+            ranges = dict((name, [np.inf, -np.inf]) for (name, _) in needed)
+            for tile in tiles:
+                values = tile_values(tile)
+                for (name, position) in needed:
+                    v = values[position][values[4]]
+                    v = v[~np.isnan(v)]
+                    if len(v) > 0:
+                        ranges[name] = [min(ranges[name][0], np.min(v)), max(ranges[name][1], np.max(v))]
+            for (name, (low, high)) in ranges.items():
+                if np.isfinite(low):
+                    kwargs[name] = (low, high if high > low else low + 1.0)
+        
+        histogram = cls(**kwargs)
+        for tile in tiles:
+            (x, y, z, m, _) = tile_values(tile)
+            histogram.add(x, y, z, m)
+        return histogram
+    
+    def mean(self):
+        # Mean of z in each bin (NaN for empty bins), shaped like counts.
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self._reshape(np.where(self._z_count > 0, self._z_sum / self._z_count, np.nan))
+    
+    def quantile(self, q):
+        # q-th quantile (0 <= q <= 1) of z in each bin, interpolated within the bins of the z histogram.
+        
+        if self._z_histogram is None:
+            raise Error.InputError('Quantile', 'requires z values and a z_range')
+        histogram = self._z_histogram.reshape((self.size, self.z_bins))
+        cumulative = np.cumsum(histogram, axis = 1)
+        total = cumulative[:, -1]
+        target = q * total
+        k = np.minimum(np.sum(cumulative < target[:, np.newaxis], axis = 1), self.z_bins - 1)
+        below = np.where(k > 0, cumulative[np.arange(self.size), k - 1], 0)
+        in_bin = histogram[np.arange(self.size), k]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            fraction = np.where(in_bin > 0, (target - below) / in_bin, 0.5)
+        (low, high) = self.z_range
+        values = low + (k + fraction) * (high - low) / self.z_bins
+        return self._reshape(np.where(total > 0, values, np.nan))
+    
+    def _reshape(self, values):
+        return values.reshape((self.nx, self.ny)) if not self.hexagonal else values
+    
+    def histogram(self):
+        # Counts, and the x and y bin edges, as returned by np.histogram2d (rectangular bins only).
+        return self._reshape(self.counts), self.x_edges, self.y_edges
+    
+    def plot(self, statistic = 'count', q = 0.5, ax = None, log_counts = True, **kwargs):
+        # Draws the bins colored by count, mean or quantile (of z, at q).  Hexagonal bins on log axes are drawn in log10
+        # coordinates.
+        
+        from matplotlib import colors
+        ax = ax if ax is not None else plt.gca()
+        values = {'count': lambda: self.counts.astype(float64), 'mean': lambda: self.mean().ravel(), 'quantile': lambda: self.quantile(q).ravel()}[statistic]()
+        values = np.where(self.counts > 0, values, np.nan)
+        if statistic == 'count' and log_counts:
+            kwargs.setdefault('norm', colors.LogNorm())
+        
+        if not self.hexagonal:
+            artist = ax.pcolormesh(self.x_edges, self.y_edges, np.ma.masked_invalid(values.reshape((self.nx, self.ny)).T), **kwargs)
+            if self.log_x:
+                ax.set_xscale('log')
+            if self.log_y:
+                ax.set_yscale('log')
+        else:
+            from matplotlib.collections import PolyCollection
+            (sx, sy) = self.__hexagon_spacing()
+            hexagon = np.array([[.5, -.5], [.5, .5], [0., 1.], [-.5, .5], [-.5, -.5], [0., -1.]]) * [sx, sy / 3.0]
+            (cx, cy) = self._bin_centers()
+            filled = ~np.isnan(values)
+            artist = PolyCollection([hexagon + center for center in zip(cx[filled], cy[filled])], **kwargs)
+            artist.set_array(values[filled])
+            ax.add_collection(artist)
+            ax.set_xlim(self._tx_edges[0] - sx / 2.0, self._tx_edges[-1] + sx / 2.0)
+            ax.set_ylim(self._ty_edges[0] - sy / 1.5, self._ty_edges[-1] + sy / 1.5)
+        plt.sci(artist)
+        return artist
+
 def plot(*args, **kwargs):
+    # With bins (passed to JointHistogram.from_grids, e.g. bins = (100, 100)), the grids are plotted as a 2-D 
+    # histogram streamed over tiles instead of as points.
     
     grid1 = args[0]._griddata
     grid2 = args[1]._griddata
@@ -4201,6 +5362,21 @@ def plot(*args, **kwargs):
     if kwargs.get('symbol') is None:
         symbol = 'k.'
     
+    bins = kwargs.pop('bins', None)
+    if bins is not None and kwargs.get('indexes') is None:
+        (x_bins, y_bins) = bins if np.ndim(bins) == 1 and len(bins) == 2 else (bins, bins)
+        histogram = JointHistogram.from_grids(args[0], args[1], x_bins = x_bins, y_bins = y_bins, log_x = kwargs.pop('log_x', False), log_y = kwargs.pop('log_y', False), hexagonal = kwargs.pop('hexagonal', False))
+        histogram.plot()
+        plt.xlabel(kwargs.get('xlabel') if kwargs.get('xlabel') is not None else 'Grid 1')
+        plt.ylabel(kwargs.get('ylabel') if kwargs.get('ylabel') is not None else 'Grid 2')
+        if interactive:
+            plt.ion()
+            plt.show(block=False)
+        else:
+            plt.ioff()
+            plt.show(block=True)
+        return plt.gca()
+    
     if kwargs.get('indexes') is None:    
         valid_indexes = np.where( ~np.isnan(grid1+grid2) )
     else:
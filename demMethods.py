@@ -65,9 +65,20 @@ def processForTheta(prefix_name, Ao, theta, base_name = '.'):
     relief.save(prefix_name + "_relief_" + str(Ao).replace('.','_') + "_" + str(theta).replace('.','_'))
     
 def plotGrids(x_grid, y_grid, plot_string, **kwargs):
+    # With bins (e.g. bins = (100, 100), with the other JointHistogram.from_grids options such as log_x or hexagonal),
+    # plots the 2-D histogram of the cells with y >= 0 streamed over tiles, and returns the histogram instead of the
+    # vectors.
     
     import numpy as np
     
+    if kwargs.get('bins') is not None:
+        from dem import JointHistogram
+        bins = kwargs.pop('bins')
+        (kwargs['x_bins'], kwargs['y_bins']) = bins if np.ndim(bins) == 1 and len(bins) == 2 else (bins, bins)
+        histogram = JointHistogram.from_grids(x_grid, y_grid, mask = y_grid._griddata >= 0, **kwargs)
+        histogram.plot()
+        return histogram
+    
     x_vec = np.ndarray.flatten(x_grid._griddata)
     y_vec = np.ndarray.flatten(y_grid._griddata)
     
@@ -81,9 +92,18 @@ def plotGrids(x_grid, y_grid, plot_string, **kwargs):
 
     return x_vec, y_vec
 
-def extract_values_from_grid(x_grid, y_grid, ignore_zeros=False):
+def extract_values_from_grid(x_grid, y_grid, ignore_zeros=False, **kwargs):
+    # With bins, returns a JointHistogram of the two grids (streamed over tiles) rather than the vectors of values.
     
     import numpy as np
+    
+    if kwargs.get('bins') is not None:
+        from dem import JointHistogram
+        bins = kwargs.pop('bins')
+        (kwargs['x_bins'], kwargs['y_bins']) = bins if np.ndim(bins) == 1 and len(bins) == 2 else (bins, bins)
+        mask = np.logical_and(x_grid._griddata != 0, y_grid._griddata != 0) if ignore_zeros else None
+        return JointHistogram.from_grids(x_grid, y_grid, mask = mask, **kwargs)
+    
     x_vec = np.ndarray.flatten(x_grid._griddata)
     y_vec = np.ndarray.flatten(y_grid._griddata)
     if ignore_zeros:
@@ -94,9 +114,11 @@ def extract_values_from_grid(x_grid, y_grid, ignore_zeros=False):
     return x_vec, y_vec
         
 def create_density(x, y, x_boundaries, y_boundaries):
-    import numpy as np
-    H, xedges, yedges = np.histogram2d(x, y, bins = (x_boundaries, y_boundaries))
+    # x and y are vectors or aligned grids; the histogram is accumulated in tiles, as np.histogram2d would return it.
+    
+    from dem import JointHistogram
+    histogram = JointHistogram.from_grids(x, y, x_bins = x_boundaries, y_bins = y_boundaries)
     
-    return H, xedges, yedges
+    return histogram.histogram()
     
     
@@ -105,6 +105,208 @@ def best_ks_and_theta_with_wrss(elevation, flow_direction_or_length, area, outle
     
     return best_ks_and_theta_with_wrss_list(ld_list, de, xo = xo)
 
+_outlet_fit_state = None
+
+def _recursive_list_distance_scale(flow_direction):
+    
+    # distance_scale for every cell as map_values_to_recursive_list records it: set by the last upstream neighbor
+    # (in _upstream_neighbors order) that drains into the cell, and 1.0 for cells with no upstream neighbors.
+    
+    halo = flow_direction._halo_griddata()
+    (ny, nx) = flow_direction._griddata.shape
+    distance_scale = np.ones((ny, nx), dtype = np.float64)
+    for (di, dj, code) in flow_direction._upstream_neighbors:
+        distance_scale[halo[1+di:ny+1+di, 1+dj:nx+1+dj] == code] = 1.4142135623730951 if (di != 0 and dj != 0) else 1.0
+    return distance_scale.ravel()
+
+def _init_outlet_fit_worker(state):
+    
+    global _outlet_fit_state
+    _outlet_fit_state = state
+
+def _channel_network_for_outlet(index, state):
+    
+    # Cells upstream of the outlet with area >= Ao, found level by level through the donor lists.  Returns the flat
+    # cell indexes, the position of each cell's parent (-1 for the outlet), and the pre-order position and subtree
+    # size of each cell, which let sums along flow paths be taken with a single cumsum.
+    
+    area = state['area']
+    donor_offsets = state['donor_offsets']
+    donors = state['donors']
+    Ao = state['Ao']
+    
+    cells = [np.array([index])]
+    parents = [np.array([-1])]
+    first = 0
+    while True:
+        current = cells[-1]
+        starts = donor_offsets[current]
+        counts = donor_offsets[current+1] - starts
+        total = np.sum(counts)
+        if total == 0:
+            break
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        upstream = donors[positions]
+        parent = np.repeat(np.arange(first, first + len(current)), counts)
+        keep = area[upstream] >= Ao
+        if not np.any(keep):
+            break
+        first += len(current)
+        cells.append(upstream[keep])
+        parents.append(parent[keep])
+    
+    level_offsets = np.cumsum([0] + [len(level) for level in cells])
+    cells = np.concatenate(cells)
+    parents = np.concatenate(parents)
+    n = len(cells)
+    
+    size = np.ones(n, dtype = np.intp)
+    for level in range(len(level_offsets)-2, 0, -1):
+        nodes = np.arange(level_offsets[level], level_offsets[level+1])
+        np.add.at(size, parents[nodes], size[nodes])
+    
+    # Children of the same parent are contiguous within a level; each child starts after its parent and the
+    # subtrees of its earlier siblings:
+    
+    pre_order = np.zeros(n, dtype = np.intp)
+    for level in range(1, len(level_offsets)-1):
+        nodes = np.arange(level_offsets[level], level_offsets[level+1])
+        before = np.cumsum(size[nodes]) - size[nodes]
+        group_start = np.r_[True, parents[nodes][1:] != parents[nodes][:-1]]
+        before -= before[np.maximum.accumulate(np.where(group_start, np.arange(len(nodes)), 0))]
+        pre_order[nodes] = pre_order[parents[nodes]] + 1 + before
+    
+    return cells, parents, pre_order, size
+
+def _fit_outlet(task):
+    
+    (position, index, theta) = task
+    state = _outlet_fit_state
+    import scipy.optimize
+    
+    if index < 0 or state['area'][index] < state['Ao']:
+        return (position, 0.0, 0.0, 0.0, 0)
+    
+    (cells, parents, pre_order, size) = _channel_network_for_outlet(index, state)
+    n = len(cells)
+    e = state['elevation'][cells] - state['elevation'][index]
+    A = state['area'][cells]
+    A_parent = A[np.maximum(parents, 0)]
+    step = 0.5 * state['distance_scale'][cells] * state['de'][cells]
+    step[0] = 0.0
+    
+    def chi_for_theta(theta):
+        # chi at each cell is the sum of the steps along its flow path: add each step at the cell's pre-order
+        # position and remove it again after its subtree.
+        w = step * (A**(-theta) + A_parent**(-theta))
+        d = np.bincount(pre_order, w, n+1) - np.bincount(pre_order + size, w, n+1)
+        return np.cumsum(d)[pre_order]
+    
+    def ks_and_wrss(theta):
+        c = chi_for_theta(theta)
+        cc = np.dot(c, c)
+        if cc == 0:
+            return 0.0, None
+        ks = np.dot(c, e) / cc
+        return ks, np.sum(np.power(e - ks*c, 2))
+    
+    if n < 2 or ks_and_wrss(0.5)[1] is None:
+        return (position, 0.0, 0.0, 0.0, n)
+    
+    warnflag = 0
+    if theta is None:
+        (xopt, _, _, _, warnflag) = scipy.optimize.fmin(lambda theta: ks_and_wrss(theta[0])[1], np.array([0.5]), (), 1E-5, 1E-5, 100, 200, True, False, 0, None)
+        theta = xopt[0]
+    (ks, WRSS) = ks_and_wrss(theta)
+    SS = np.sum(np.power(e - np.mean(e), 2))
+    R2 = 1 - (WRSS / SS)
+    if warnflag == 1 or warnflag == 2:
+        R2 = 0.0
+    
+    return (position, ks, theta, R2, n)
+
+def best_ks_and_theta_for_outlets(elevation, flow_direction, area, outlets, xo = 500, theta = None, processes = None, resume_filename = None):
+    
+    # Batch version of best_ks_and_theta_with_wrss for many outlets.  The grids and the donor lists of the flow graph
+    # are built once and shared with a pool of worker processes (inherited without copying where fork is available).
+    # Each outlet's channel network is extracted once, and chi is then evaluated with array operations for each trial
+    # theta.  If theta is given, only ks is fit (as in utils.calc_ks_for_outlet).
+    #
+    # Returns a structured array with x, y, ks, theta, R2 and n (the number of channel cells) for each outlet.  If
+    # resume_filename is given, rows are appended to that CSV file as outlets complete, and outlets already in the
+    # file are not fit again.
+    
+    import os
+    import csv
+    
+    outlets = np.asarray(outlets, dtype = np.float64).reshape((-1, 2))
+    table = np.zeros(len(outlets), dtype = [('x', np.float64), ('y', np.float64), ('ks', np.float64), ('theta', np.float64), ('R2', np.float64), ('n', np.int64)])
+    table['x'] = outlets[:,0]
+    table['y'] = outlets[:,1]
+    
+    fields = ('outlet', 'x', 'y', 'ks', 'theta', 'R2', 'n')
+    done = set()
+    if resume_filename is not None and os.path.exists(resume_filename):
+        with open(resume_filename, 'r') as f:
+            for row in csv.DictReader(f):
+                position = int(row['outlet'])
+                table[position] = (float(row['x']), float(row['y']), float(row['ks']), float(row['theta']), float(row['R2']), int(row['n']))
+                done.add(position)
+    
+    (rows, cols) = flow_direction._xy_to_rowscols_array(outlets[:,0], outlets[:,1])
+    indexes = np.where(rows >= 0, rows * flow_direction._griddata.shape[1] + cols, -1)
+    tasks = [(position, indexes[position], theta) for position in range(len(outlets)) if position not in done]
+    if len(tasks) == 0:
+        return table
+    
+    # Donor lists are built from cells in topological order, so that the search upstream never enters a flow loop:
+    
+    receivers = flow_direction.receiver_indexes()
+    (cell_order, _) = flow_direction.topological_order()
+    has_receiver = np.sort(cell_order[receivers[cell_order] >= 0])
+    order = np.argsort(receivers[has_receiver], kind = 'stable')
+    state = {'area': np.asarray(area._griddata, dtype = np.float64).ravel(),
+             'elevation': np.asarray(elevation._griddata, dtype = np.float64).ravel(),
+             'de': np.ascontiguousarray(area._mean_pixel_dimension(), dtype = np.float64).ravel(),
+             'distance_scale': _recursive_list_distance_scale(flow_direction),
+             'donors': has_receiver[order],
+             'donor_offsets': np.searchsorted(receivers[has_receiver][order], np.arange(receivers.size + 1)),
+             'Ao': np.power(xo, 2.0)}
+    
+    writer = None
+    if resume_filename is not None:
+        new_file = not os.path.exists(resume_filename)
+        output = open(resume_filename, 'a', newline = '')
+        writer = csv.writer(output)
+        if new_file:
+            writer.writerow(fields)
+    
+    def record(result):
+        (position, ks, theta, R2, n) = result
+        table[position] = (outlets[position,0], outlets[position,1], ks, theta, R2, n)
+        if writer is not None:
+            writer.writerow((position, outlets[position,0], outlets[position,1], ks, theta, R2, n))
+            output.flush()
+    
+    try:
+        if processes == 1:
+            _init_outlet_fit_worker(state)
+            for task in tasks:
+                record(_fit_outlet(task))
+        else:
+            import multiprocessing
+            context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+            processes = processes if processes is not None else os.cpu_count()
+            chunksize = max(1, len(tasks) // (4 * processes))
+            with context.Pool(processes, initializer = _init_outlet_fit_worker, initargs = (state,)) as pool:
+                for result in pool.imap_unordered(_fit_outlet, tasks, chunksize = chunksize):
+                    record(result)
+    finally:
+        if writer is not None:
+            output.close()
+    
+    return table
+
 def hi(elevation, flow_direction, dA, outlet):
     ld_list = flow_direction.map_values_to_recursive_list(outlet, dA = dA, elevation = elevation)
     return hi_list(ld_list)
@@ -23,5 +23,11 @@ def calc_ks_for_outlet(outlet, theta, **kwargs):
         plt.plot([0, np.max(c)],[0, ks*np.max(c)], 'k-')
         
     return ret
-        
-    
\ No newline at end of file
+
+def calc_ks_for_outlets(outlets, theta, **kwargs):
+    # Fits ks at a fixed theta for many outlets at once; returns the table from best_ks_and_theta_for_outlets.
+    xo = kwargs.get('xo') if kwargs.get('xo') is not None else 500.0
+    
+    from demRecursionTools import best_ks_and_theta_for_outlets
+    return best_ks_and_theta_for_outlets(kwargs['elevation'], kwargs['flow_direction'], kwargs['area'], outlets, xo = xo, theta = theta,
+                                         processes = kwargs.get('processes'), resume_filename = kwargs.get('resume_filename'))